@@ -1,26 +1,95 @@
-import json
+import functools
 import os
-import hashlib
-from typing import Dict
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Union
+
+import httpx
+from openai import APIConnectionError, APIStatusError
+
+from chunker import ChunkCache, select_snippets
+from client_pool import ClientPool, parse_api_keys
+from context_builder import ContextBuilder, format_directory_entry, summary_entry_tokens
+from directory_tree import directory_tree, directory_hashes, directory_levels
+from file_index import FileIndex, extract_identifiers
+from file_watcher import ProjectWatcher
+from metrics import metrics, record_span, span
+from summary_store import SummaryStore, LazySummaries
+from utils import iter_project_files, stat_project_files, git_changed_files, git_head, git_project_files, \
+    is_git_repository, FileCache, RateLimiter, ResponseCache, CircuitBreaker, \
+    RetryPolicy, count_tokens, estimate_tokens, fingerprint, read_file_bytes, HASH_ALGORITHM, LEGACY_HASH_ALGORITHM
+
+DIRECTORY_PROMPT = "根据上面各文件和子目录的摘要，总结这个目录的整体功能、主要模块及它们之间的关系，总字数控制在300字以内，不要使用markdown格式。"
+# 摘要存储 meta 表中记录git扫描状态的键：{"commit": 上次扫描完成时的提交, "dirty": 当时与该提交不同的文件,
+# "file_types": 当时的文件类型}
+GIT_STATE_KEY = "git_scan"
+# 单次目录汇总请求输入的最大字符数，超出时先分组汇总再合并（map-reduce）
+DIRECTORY_INPUT_CHARS = 30000
+BATCH_SUMMARY_PROMPT = "分别总结上面的每个文件，每个文件的摘要控制在300字以内，不要使用markdown格式。如果是代码文件，简洁地列出其实现的功能与继承关系；如果是脚本或配置文件，说明其内容及用途。以JSON对象输出，键为文件的相对路径（与上面的写法完全相同），值为该文件的摘要文本，不要输出JSON以外的内容。"
+# 一次批量摘要请求最多包含的文件数（限制回答长度）
+BATCH_MAX_FILES = 10
+SUMMARY_PROMPT = "总结这个文件，总字数控制在300字以内，不要使用markdown格式。如果是代码文件，分析并总结代码内容，简洁地列出其实现的功能与继承关系；如果是脚本文件，详细说明其指令内容及如何运行。总字数控制在300字以内，不要使用markdown格式。"
 
-import chardet
-from openai import OpenAI
 
-from utils import scan_project_files
+def parse_batch_summaries(answer: str, files) -> Dict[str, str]:
+    """从批量摘要的回答中解析 {相对路径: 摘要}，容忍代码块标记和路径分隔符差异；无法解析时返回空字典"""
+    start, end = answer.find("{"), answer.rfind("}")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        data = json.loads(answer[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    normalized = {str(key).replace("\\", "/").strip(): value for key, value in data.items()}
+    summaries = {}
+    for rel_path in files:
+        value = normalized.get(rel_path.replace("\\", "/"))
+        if isinstance(value, str) and value.strip():
+            summaries[rel_path] = value.strip()
+    return summaries
+
+
+def is_retryable_error(error) -> bool:
+    """连接错误、超时、429 和 5xx 等暂时性错误值得重试；鉴权失败、参数错误等直接失败"""
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
 
 
 class API_manager:
-    def __init__(self, assistant_api_key: str, summarizer_api_key: str = None,
+    def __init__(self, assistant_api_key: Union[str, list], summarizer_api_key: Union[str, list] = None,
                  base_url: str = "https://api.deepseek.com",
-                 project_root: os.path = None, model: str = "deepseek-chat", file_types = None):
+                 project_root: os.path = None, model: str = "deepseek-chat", file_types = None,
+                 max_workers: int = 8, requests_per_minute: int = None, tokens_per_minute: int = None,
+                 file_cache_chars: int = 8 * 1024 * 1024, context_token_budget: int = 24000,
+                 llm_file_picker: bool = False, snippet_token_budget: int = 8000, response_cache_size: int = 256,
+                 directory_summaries: bool = True, max_retries: int = 5, request_timeout: float = 120.0,
+                 checkpoint_interval: float = 10.0, batch_file_tokens: int = 800, batch_token_budget: int = 6000,
+                 git_scan: bool = True):
         self.assistant_api_key = assistant_api_key
         if summarizer_api_key is None:
             summarizer_api_key = assistant_api_key
         self.summarizer_api_key = summarizer_api_key
         self.base_url = base_url
         self.model = model
-        self.assistant = OpenAI(api_key=self.assistant_api_key, base_url=self.base_url)
-        self.summarizer = OpenAI(api_key=self.summarizer_api_key, base_url=self.base_url)
+        # 每种角色可以有多个密钥（列表或逗号分隔），请求在密钥间按剩余额度分配；
+        # 所有客户端共享一个保持连接的 httpx.Client
+        # 重试由 RetryPolicy 统一处理（指数退避+抖动、Retry-After、熔断），关闭SDK自带的重试；
+        # request_timeout 为单次请求的超时时间（秒）
+        self.request_timeout = request_timeout
+        self.http_client = httpx.Client(timeout=request_timeout,
+                                        limits=httpx.Limits(max_connections=4 * max(1, max_workers) + 8,
+                                                            max_keepalive_connections=2 * max(1, max_workers) + 4))
+        self.assistant = ClientPool(self.assistant_api_key, self.base_url, request_timeout, self.http_client)
+        self.summarizer = ClientPool(self.summarizer_api_key, self.base_url, request_timeout, self.http_client)
+        self.assistant_retry = RetryPolicy(is_retryable_error, max_retries, circuit_breaker=CircuitBreaker())
+        self.summarizer_retry = RetryPolicy(is_retryable_error, max_retries, circuit_breaker=CircuitBreaker())
         self.project_root = project_root
 
         if file_types is None:
@@ -32,22 +101,132 @@ class API_manager:
         else:
             self.file_types = file_types
 
-        self.cached_files = {}
-        self.summary = {}
+        # 按需读取的文件内容缓存（LRU，按总字符数限制大小）
+        self.file_cache_chars = file_cache_chars
+        self.cached_files = FileCache(project_root, file_cache_chars) if project_root else None
+        # 摘要正文按需从摘要存储读取，启动时只加载摘要索引
+        self.summary = LazySummaries()
+        self.summary_index = {}
+
+        # 摘要生成的并发数与速率限制（每个摘要密钥的RPM/TPM，按密钥数放大；None表示不限制）
+        self.max_workers = max(1, max_workers)
+        keys = len(self.summarizer)
+        self.rate_limiter = RateLimiter(requests_per_minute and requests_per_minute * keys,
+                                        tokens_per_minute and tokens_per_minute * keys)
+        # 长时间扫描中每隔 checkpoint_interval 秒保存一次已生成的摘要，进程中断后从断点继续
+        self.checkpoint_interval = checkpoint_interval
+        # 预估不超过 batch_file_tokens 的小文件合并请求，每批不超过 batch_token_budget（0表示不合并）
+        self.batch_file_tokens = batch_file_tokens
+        self.batch_token_budget = batch_token_budget
 
-        # 添加摘要存储相关的设置
+        # 项目概览按与问题的相关度挑选摘要，总量不超过该token预算（None表示不限制）
+        self.context_token_budget = context_token_budget
+        # 本地文件检索索引，load_summary 时按项目加载
+        self.file_index = FileIndex()
+        self.context_builder = ContextBuilder(self.file_index)
+        # 是否让LLM对本地检索出的候选文件再做一次筛选
+        self.llm_file_picker = llm_file_picker
+        # load_files 时注入的代码块总量上限；代码块切分结果按内容哈希缓存
+        self.snippet_token_budget = snippet_token_budget
+        self.chunk_cache = ChunkCache()
+        # 最近一次 analyze 的统计信息（上下文token数、API用量等）
+        self.last_stats = {}
+        # 全部文件摘要超出 context_token_budget 时，逐级汇总生成目录摘要 {目录相对路径: {"hash", "summary", "tokens"}}
+        self.enable_directory_summaries = directory_summaries
+        # 项目根目录是git仓库时，完整扫描改为读取git索引，并只检查自上次扫描的提交以来变化的文件
+        self.git_scan = git_scan
+        self.directory_summary = {}
+        # 摘要或目录摘要每次变化后加一，项目概览的稳定部分只在它变化时重建
+        self.summary_generation = 0
+        # 相同的问题（相同的项目概览版本、对话历史和代码片段）直接返回缓存的回答，0表示不缓存
+        self.response_cache = ResponseCache(response_cache_size)
+
+        # 摘要存储位置；旧版的 summaries/ 目录和 summary_index.json 仅用于迁移
         self.summary_base_dir = os.path.join(project_root, ".aide_doc/summaries") if project_root else None
         self.summary_index_file = os.path.join(project_root, ".aide_doc/summary_index.json") if project_root else None
+        self.summary_db_file = os.path.join(project_root, ".aide_doc/summaries.db") if project_root else None
+        self.summary_store = None
+        self.dirty_summaries = set()
+        # 按内容哈希查找已有摘要：尚未保存的新摘要 {内容哈希: 摘要}，以及正在生成摘要的内容 {内容哈希: Event}
+        self.content_lock = threading.Lock()
+        self.content_summaries = {}
+        self.inflight_contents = {}
+        # 扫描、更新与保存摘要的互斥锁（后台监视线程与多个会话的聊天请求可能同时扫描）
+        self.scan_lock = threading.RLock()
+        # 会话各自的对话密钥池 {密钥元组: ClientPool}，与 self.assistant 共享 http_client；
+        # 由单独的锁保护，查找密钥池不会等待正在进行的扫描
+        self.pool_lock = threading.Lock()
+        self.session_pools = {}
+        self.watcher = None
+        self.file_index_file = os.path.join(project_root, ".aide_doc/file_index.json") if project_root else None
 
         # 初始化时尝试加载已有的摘要
         self.load_summary()
 
     def change_root(self, new_root: str):
+        restart_watcher = self.watcher is not None
+        self.stop_watcher()
         self.project_root = new_root
+        self.cached_files = FileCache(new_root, self.file_cache_chars)
         self.summary_base_dir = os.path.join(new_root, ".aide_doc/summaries")
         self.summary_index_file = os.path.join(new_root, ".aide_doc/summary_index.json")
+        self.summary_db_file = os.path.join(new_root, ".aide_doc/summaries.db")
+        self.file_index_file = os.path.join(new_root, ".aide_doc/file_index.json")
         # 重新加载新位置的摘要
         self.load_summary()
+        if restart_watcher:
+            self.start_watcher()
+
+    def assistant_pool(self, api_keys) -> ClientPool:
+        """
+        返回使用给定对话密钥的客户端池：与管理器自身的密钥相同时返回 self.assistant，
+        否则按密钥缓存一个共享 http_client 的客户端池（多个会话共用同一项目但各自使用自己的密钥）
+        """
+        keys = tuple(parse_api_keys(api_keys))
+        if not keys or keys == tuple(parse_api_keys(self.assistant_api_key)):
+            return self.assistant
+        with self.pool_lock:
+            if keys not in self.session_pools:
+                self.session_pools[keys] = ClientPool(keys, self.base_url, self.request_timeout, self.http_client)
+            return self.session_pools[keys]
+
+    def close(self):
+        """停止后台监视，保存摘要与检索索引并释放数据库连接和HTTP连接"""
+        self.stop_watcher()
+        with self.scan_lock:
+            self.save_summary()
+            self.file_index.save()
+            if self.summary_store is not None:
+                self.summary_store.close()
+                self.summary_store = None
+        self.http_client.close()
+
+    def start_watcher(self, debounce: float = 2.0, poll_interval: float = 30.0):
+        """启动后台文件监视，之后摘要在后台保持更新"""
+        if self.watcher is not None or not self.project_root or not os.path.isdir(self.project_root):
+            return
+        self.watcher = ProjectWatcher(self, debounce=debounce, poll_interval=poll_interval)
+        self.watcher.start()
+        # 在后台预先构建检索索引，避免第一次提问时等待
+        threading.Thread(target=self.file_index.load, name="FileIndexLoader", daemon=True).start()
+
+    def stop_watcher(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def watcher_stats(self) -> dict:
+        """后台监视状态（含等待重试的失败文件数 "failed"），未启动时返回空字典"""
+        if self.watcher is None:
+            return {}
+        stats = self.watcher.stats()
+        stats["failed"] = self.summary_store.failure_count() if self.summary_store is not None else 0
+        return stats
+
+    @property
+    def project_label(self) -> str:
+        """指标中区分项目的标签"""
+        return os.path.abspath(self.project_root) if self.project_root else ""
 
     def change_valid_file_types(self, new_types: [str]):
         self.file_types = new_types
@@ -59,193 +238,984 @@ class API_manager:
             self.model = model
 
     def calculate_file_hash(self, content: str) -> str:
-        """计算文件内容的哈希值"""
-        return hashlib.md5(content.encode('utf-8')).hexdigest()
+        """计算文本内容（按UTF-8编码）的指纹；扫描读取的文件直接使用原始字节的指纹，不经过这里"""
+        return fingerprint(content.encode('utf-8'))
+
+    @staticmethod
+    def same_content(entry: dict, current_hash: str, content: str, read_raw: Callable[[], bytes] = None) -> bool:
+        """
+        判断摘要索引条目记录的哈希是否与当前内容一致
+
+        旧版本的MD5哈希（或换用其他算法前记录的哈希）按条目记录的算法重新计算内容的哈希后比较，
+        一致时由调用方把条目升级为当前算法的指纹，不需要重新生成摘要。
+        旧版本以文本模式读取文件，换行符（\\r\\n、\\r）已被转换为 \\n，计算MD5前同样转换；
+        其他算法的指纹是对文件原始字节计算的，由 read_raw 重新读取原始字节（未提供时按UTF-8编码内容计算）
+        """
+        existing_hash = entry.get("hash")
+        if not existing_hash:
+            return False
+        algorithm = entry.get("hash_algorithm", LEGACY_HASH_ALGORITHM)
+        if algorithm == HASH_ALGORITHM:
+            return existing_hash == current_hash
+        if algorithm == LEGACY_HASH_ALGORITHM:
+            data = content.replace('\r\n', '\n').replace('\r', '\n').encode('utf-8')
+        elif read_raw is not None:
+            data = read_raw()
+        else:
+            data = content.encode('utf-8')
+        return fingerprint(data, algorithm) == existing_hash
 
     def load_summary(self):
-        """从文件加载摘要索引和内容"""
-        if not self.summary_base_dir or not self.summary_index_file:
+        """
+        从摘要存储加载摘要索引（首次使用时从旧的文件布局迁移）
+
+        摘要正文不在此时读取，由 LazySummaries 在用到时按需读取；检索索引也在第一次使用时才构建。
+        """
+        if not self.summary_db_file:
             return
 
-        # 确保目录存在
-        os.makedirs(self.summary_base_dir, exist_ok=True)
+        if self.summary_store is not None:
+            self.summary_store.close()
+        self.summary_store = SummaryStore(self.summary_db_file)
+        if len(self.summary_store) == 0:
+            self.summary_store.migrate_from_files(self.summary_index_file, self.summary_base_dir)
+        self.dirty_summaries = set()
 
-        # 加载索引文件
-        self.summary_index = {}
-        if os.path.exists(self.summary_index_file):
-            try:
-                with open(self.summary_index_file, 'r', encoding='utf-8') as f:
-                    self.summary_index = json.load(f)
-                    print(f"已加载摘要索引，包含 {len(self.summary_index)} 个文件")
-            except Exception as e:
-                print(f"无法加载摘要索引文件: {str(e)}")
-                self.summary_index = {}
-        else:
+        try:
+            self.summary_index = self.summary_store.load_index()
+            print(f"已加载摘要索引，包含 {len(self.summary_index)} 个文件")
+        except Exception as e:
+            print(f"无法加载摘要: {str(e)}")
             self.summary_index = {}
+        self.summary = LazySummaries(self.summary_store, self.summary_index)
+        self.directory_summary = self.summary_store.load_directories()
 
-        # 从摘要文件加载内容
-        self.summary = {}
-        for rel_path, data in self.summary_index.items():
-            # 构建摘要文件路径（保持原目录结构）
-            summary_path = os.path.join(self.summary_base_dir, rel_path + ".summary.txt")
-            summary_dir = os.path.dirname(summary_path)
-            if not os.path.exists(summary_dir):
-                os.makedirs(summary_dir, exist_ok=True)
+        # 旧版本保存的条目没有token数，补算一次（需要读取这些条目的摘要）
+        missing_tokens = [rel_path for rel_path, entry in self.summary_index.items() if "tokens" not in entry]
+        for rel_path in missing_tokens:
+            summary_text = self.summary.get(rel_path)
+            if summary_text is not None:
+                self.summary_index[rel_path]["tokens"] = summary_entry_tokens(rel_path, summary_text)
+                self.mark_dirty(rel_path)
+        self.save_summary()
 
-            if os.path.exists(summary_path):
-                try:
-                    with open(summary_path, 'r', encoding='utf-8') as f:
-                        self.summary[rel_path] = f.read()
-                except Exception as e:
-                    print(f"无法读取摘要文件 {summary_path}: {str(e)}")
+        self.file_index = FileIndex(self.file_index_file, self.summary_store.iter_summaries)
+        self.context_builder = ContextBuilder(self.file_index)
+        self.chunk_cache = ChunkCache(os.path.join(self.project_root, ".aide_doc/chunks"))
+
+    def mark_dirty(self, rel_path: str):
+        """标记摘要或索引条目已修改，下次 save_summary 时写入"""
+        self.dirty_summaries.add(rel_path)
+
+    def remove_summaries(self, rel_paths: list):
+        """
+        从摘要索引、检索索引和摘要存储中删除已不存在的文件；摘要正文仍按内容哈希保留，
+        文件被移动到别处时可以沿用，完整扫描结束时由 collect_garbage 回收不再被引用的摘要
+        """
+        if not rel_paths:
+            return
+        with self.scan_lock:
+            for rel_path in rel_paths:
+                self.summary_index.pop(rel_path, None)
+                self.summary.discard(rel_path)
+                self.file_index.remove(rel_path)
+                self.dirty_summaries.discard(rel_path)
+            if self.summary_store is not None:
+                self.summary_store.delete(rel_paths)
+                self.summary_store.clear_failures(rel_paths)
+            self.file_index.save()
+            self.summary_generation += 1
+            print(f"已删除 {len(rel_paths)} 个不存在的文件的摘要")
 
     def save_summary(self):
-        """保存摘要索引和内容到文件"""
-        if not self.summary_base_dir or not self.summary_index_file:
+        """把修改过的摘要索引条目和摘要写入摘要存储"""
+        with self.scan_lock:
+            if self.summary_store is None or not self.dirty_summaries:
+                return
+
+            dirty, self.dirty_summaries = self.dirty_summaries, set()
+            # 只有新生成的摘要需要写入正文，其余条目只更新索引字段
+            entries = {rel_path: (self.summary_index[rel_path], self.summary.unsaved_summary(rel_path))
+                       for rel_path in dirty if rel_path in self.summary_index}
+            try:
+                self.summary_store.upsert(entries)
+                self.summary.mark_saved(entries)
+                # 已写入存储的内容不必再保留在内存中
+                with self.content_lock:
+                    for entry, summary_text in entries.values():
+                        if summary_text is not None:
+                            self.content_summaries.pop(entry.get("hash"), None)
+                print(f"已保存 {len(entries)} 条摘要到 {self.summary_db_file}")
+            except Exception as e:
+                self.dirty_summaries |= dirty
+                print(f"保存摘要失败: {str(e)}")
+
+    def checkpoint(self, failures: dict, succeeded: list):
+        """保存已生成的摘要和检索索引，并更新失败队列；保存后清空传入的 failures 与 succeeded"""
+        self.save_summary()
+        self.file_index.save()
+        if self.summary_store is not None:
+            self.summary_store.record_failures(failures)
+            self.summary_store.clear_failures(succeeded)
+        failures.clear()
+        succeeded.clear()
+
+    def retry_failed(self, cancel_event: threading.Event = None) -> int:
+        """
+        重试已到重试时间的失败文件（由后台监视线程定期调用）；已删除或不再需要摘要的文件移出失败队列。
+        cancel_event 的含义同 refresh_files
+
+        返回:
+            int: 重试的文件数
+        """
+        if self.summary_store is None or not self.project_root:
+            return 0
+        due = self.summary_store.due_failures()
+        if not due:
+            return 0
+        present = {record.rel_path for record in stat_project_files(self.project_root, due, self.file_types)}
+        self.summary_store.clear_failures([rel_path for rel_path in due if os.path.normpath(rel_path) not in present])
+        if present:
+            print(f"重试 {len(present)} 个此前生成摘要失败的文件")
+            self.refresh_files(sorted(present), cancel_event=cancel_event)
+        return len(present)
+
+    def summarize_file(self, rel_path: str, content: str) -> str:
+        """为单个文件生成摘要（在线程池中调用，受速率限制）"""
+        system_content = "这是一个代码文件：" + content
+        # 预估输入与输出(约300字)的token数
+        self.rate_limiter.acquire(estimate_tokens(system_content) + estimate_tokens(SUMMARY_PROMPT) + 400)
+        return self.simple_talk(
+            system_content=system_content,
+            user_content=SUMMARY_PROMPT,
+            agent=self.summarizer,
+            model="deepseek-chat"
+        )
+
+    def summarize_directory(self, rel_dir: str, parts: list) -> str:
+        """
+        由目录下各文件和子目录的摘要生成目录摘要；输入超过 DIRECTORY_INPUT_CHARS 时
+        先把子项分组各自汇总，再汇总各组的结果
+        """
+        name = rel_dir.replace("\\", "/") or "项目根目录"
+        while True:
+            groups, group = [], ""
+            for part in parts:
+                if group and len(group) + len(part) > DIRECTORY_INPUT_CHARS:
+                    groups.append(group)
+                    group = ""
+                group += part
+            groups.append(group)
+            results = []
+            for text in groups:
+                system_content = f"这是目录 {name} 下各文件和子目录的摘要：\n" + text[:DIRECTORY_INPUT_CHARS]
+                self.rate_limiter.acquire(estimate_tokens(system_content) + estimate_tokens(DIRECTORY_PROMPT) + 400)
+                results.append(self.simple_talk(system_content=system_content, user_content=DIRECTORY_PROMPT,
+                                                agent=self.summarizer, model="deepseek-chat"))
+            if len(results) == 1:
+                return results[0]
+            parts = [f"[第{i + 1}部分]:\n{text}\n" for i, text in enumerate(results)]
+
+    def migrate_directory_hashes(self, old_hashes: Dict[str, str]):
+        """
+        文件条目的哈希升级为新算法的指纹后，同步更新目录摘要记录的目录哈希，避免目录摘要全部重新生成
+
+        只更新按旧的文件哈希计算出的目录哈希与记录一致的目录；同时有内容变化的目录保持原样，随后照常重新生成
+
+        参数:
+            old_hashes (dict): {相对路径: 升级前的哈希}
+        """
+        if not old_hashes or not self.directory_summary or self.summary_store is None:
             return
+        index = {rel_path: entry for rel_path, entry in list(self.summary_index.items()) if rel_path in self.summary}
+        tree = directory_tree(index)
+        file_hashes = {rel_path: entry.get("hash", "") for rel_path, entry in index.items()}
+        new_hashes = directory_hashes(tree, file_hashes)
+        file_hashes.update((rel_path, old_hash) for rel_path, old_hash in old_hashes.items() if rel_path in file_hashes)
+        old_directory_hashes = directory_hashes(tree, file_hashes)
+        directories = dict(self.directory_summary)
+        updated = {}
+        for rel_dir, entry in directories.items():
+            if rel_dir in tree and entry.get("hash") == old_directory_hashes[rel_dir] != new_hashes[rel_dir]:
+                directories[rel_dir] = updated[rel_dir] = dict(entry, hash=new_hashes[rel_dir])
+        if updated:
+            self.summary_store.upsert_directories(updated)
+            self.directory_summary = directories
+            print(f"已把 {len(updated)} 个目录摘要的哈希升级为 {HASH_ALGORITHM}")
 
-        # 确保目录存在
-        os.makedirs(self.summary_base_dir, exist_ok=True)
+    def update_directory_summaries(self, force: bool = False) -> int:
+        """
+        自底向上逐级汇总目录摘要：每个目录的摘要由其下文件与子目录的摘要生成，
+        只重新生成哈希变化的目录（即变更文件的各级上级目录），同一层的目录并发处理
 
-        # 保存摘要索引
-        try:
-            with open(self.summary_index_file, 'w', encoding='utf-8') as f:
-                json.dump(self.summary_index, f, indent=2, ensure_ascii=False)
-            print(f"已保存摘要索引到 {self.summary_index_file}")
-        except Exception as e:
-            print(f"保存摘要索引失败: {str(e)}")
+        全部文件摘要放得下 context_token_budget 时不需要目录摘要，直接返回（force 为 True 时仍然生成）
 
-        # 保存摘要内容（保持相对路径结构）
-        for rel_path, summary_text in self.summary.items():
-            if rel_path not in self.summary_index:
-                continue
+        返回:
+            int: 重新生成的目录摘要数
+        """
+        if self.summary_store is None or not self.enable_directory_summaries:
+            return 0
+        index = {rel_path: entry for rel_path, entry in list(self.summary_index.items()) if rel_path in self.summary}
+        total_tokens = sum(entry.get("tokens", 0) for entry in index.values())
+        if not force and (self.context_token_budget is None or total_tokens <= self.context_token_budget):
+            return 0
 
-            # 构建摘要文件路径
-            summary_path = os.path.join(self.summary_base_dir, rel_path + ".summary.txt")
-            summary_dir = os.path.dirname(summary_path)
+        tree = directory_tree(index)
+        hashes = directory_hashes(tree, {rel_path: entry.get("hash", "") for rel_path, entry in index.items()})
+        stale = [d for d in tree if self.directory_summary.get(d, {}).get("hash") != hashes[d]]
+        removed = [d for d in self.directory_summary if d not in tree]
+        directories = dict(self.directory_summary)
+        updated, failed = {}, set()
 
-            # 确保目录存在
-            if not os.path.exists(summary_dir):
-                os.makedirs(summary_dir, exist_ok=True)
+        def children(rel_dir):
+            """[(子项名称, 摘要)]"""
+            items = []
+            for rel_path in tree[rel_dir]["files"]:
+                summary_text = self.summary.get(rel_path)
+                if summary_text:
+                    items.append((os.path.basename(rel_path), summary_text))
+            for child in tree[rel_dir]["dirs"]:
+                if child in directories:
+                    items.append((os.path.basename(child) + "/", directories[child]["summary"]))
+            return items
 
-            try:
-                with open(summary_path, 'w', encoding='utf-8') as f:
-                    f.write(summary_text)
-            except Exception as e:
-                print(f"保存摘要到文件 {summary_path} 失败: {str(e)}")
+        done, total = 0, len(stale)
+        for level in directory_levels(stale):
+            # 子目录汇总失败时，上级目录留到下次再生成，避免以过期的子目录摘要记录新的哈希
+            failed.update(d for d in level if failed.intersection(tree[d]["dirs"]))
+            level = [d for d in level if d not in failed]
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(level)))) as executor:
+                futures = {}
+                for rel_dir in level:
+                    items = children(rel_dir)
+                    if len(items) == 1:
+                        # 只有一个子项的目录直接沿用子项的摘要，不调用API
+                        done += 1
+                        directories[rel_dir] = updated[rel_dir] = {"hash": hashes[rel_dir], "summary": items[0][1]}
+                    elif items:
+                        parts = [f"[{name}]:\n{summary_text}\n" for name, summary_text in items]
+                        futures[executor.submit(self.summarize_directory, rel_dir, parts)] = rel_dir
+                for future in as_completed(futures):
+                    rel_dir = futures[future]
+                    done += 1
+                    try:
+                        summary_text = future.result()
+                    except Exception as e:
+                        print(f"[{done}/{total}] 生成目录摘要失败({rel_dir or '.'}): {str(e)}")
+                        failed.add(rel_dir)
+                        continue
+                    directories[rel_dir] = updated[rel_dir] = {"hash": hashes[rel_dir], "summary": summary_text}
+                    print(f"[{done}/{total}] 更新目录【{rel_dir or '.'}】的摘要")
+        for rel_dir, entry in updated.items():
+            entry["tokens"] = count_tokens(format_directory_entry(rel_dir, entry["summary"]))
+        for rel_dir in removed:
+            directories.pop(rel_dir, None)
+
+        if updated or removed:
+            self.summary_store.upsert_directories(updated)
+            self.summary_store.delete_directories(removed)
+            # 替换为新字典，避免组装上下文的线程遍历时字典被修改
+            self.directory_summary = directories
+            self.summary_generation += 1
+            print(f"已更新 {len(updated)} 个目录摘要，删除 {len(removed)} 个")
+        return len(updated)
+
+    def summarize_batch(self, files: Dict[str, str]) -> Dict[str, str]:
+        """
+        在一次请求中为多个小文件生成摘要，要求模型输出以相对路径为键的JSON
+
+        返回:
+            dict: {相对路径: 摘要}，只包含能从回答中解析出摘要的文件
+        """
+        system_content = "以下是多个代码文件：\n" + "".join(
+            f"===== 文件: {rel_path} =====\n{content}\n" for rel_path, content in files.items())
+        self.rate_limiter.acquire(estimate_tokens(system_content) + estimate_tokens(BATCH_SUMMARY_PROMPT)
+                                  + 400 * len(files))
+        answer = self.simple_talk(
+            system_content=system_content,
+            user_content=BATCH_SUMMARY_PROMPT,
+            agent=self.summarizer,
+            model="deepseek-chat",
+            response_format={"type": "json_object"}
+        )
+        return parse_batch_summaries(answer, files)
+
+    def load_and_summarize_batch(self, files: Dict[str, Union[str, Callable[[], tuple]]], force_reload=False,
+                                 timings: dict = None) -> list:
+        """
+        读取一组文件并为其中内容有变化的文件生成摘要：多于一个文件时合并为一次请求，
+        回答中缺失或无法解析的文件再逐个请求
 
-    def update_summary(self, update_cache: Dict[str, str], force_reload = False) -> dict:
-        """更新摘要并自动保存到文件"""
-        new_summary = {}
+        files 的值为文件内容，或返回 (内容, 耗时信息) 的读取函数（如 ProjectFile.load，指纹在耗时信息的 "hash" 中）；
+        若提供 timings 字典，写入每个被读取文件的耗时 {相对路径: {read, decode, bytes, encoding}}
 
-        for rel_path, content in update_cache.items():
-            current_hash = self.calculate_file_hash(content)
+        内容相同的文件已有摘要（文件被移动、复制，或与其他文件重复）时直接沿用，不请求API；
+        同一内容正由其他线程生成摘要时等它完成，每份内容只请求一次
 
+        返回:
+            list: [(相对路径, 内容哈希, 摘要, 定义的标识符, 异常, 是否沿用已有摘要)]；内容未变化时摘要为None，
+                  二进制文件的哈希为None，只有逐个请求也失败的文件才带有异常
+        """
+        results, pending = [], {}
+        for rel_path, content in files.items():
+            read_raw = None
+            if callable(content):
+                content, timing = content()
+                current_hash = timing["hash"]
+                if timings is not None:
+                    timings[rel_path] = {key: timing[key] for key in ("read", "decode", "bytes", "encoding")}
+                if content is None:
+                    results.append((rel_path, None, None, None, None, False))
+                    continue
+                # 从磁盘读取的文件：换用哈希算法后按原始字节重新计算旧算法的指纹
+                read_raw = functools.partial(read_file_bytes, os.path.join(self.project_root, rel_path))
+            else:
+                current_hash = self.calculate_file_hash(content)
             # 检查文件是否已存在且未修改
-            existing_hash = self.summary_index.get(rel_path, {}).get("hash", "")
-            if (not force_reload) and existing_hash == current_hash:
-                # 文件未修改，使用现有摘要
-                if rel_path in self.summary:
-                    new_summary[rel_path] = self.summary[rel_path]
+            unchanged = (not force_reload) and self.same_content(self.summary_index.get(rel_path, {}),
+                                                                 current_hash, content, read_raw)
+            if unchanged:
+                results.append((rel_path, current_hash, None, None, None, False))
+            else:
+                pending[rel_path] = (current_hash, content)
+
+        reused, waiting, claimed = {}, {}, {}
+        for rel_path, (current_hash, content) in pending.items():
+            if force_reload:
+                claimed[rel_path] = (current_hash, content)
                 continue
-            print("更新【"+rel_path+"】的摘要：")
-            # 生成新的摘要
-            try:
-                new_summary[rel_path] = self.simple_talk(
-                    system_content="这是一个代码文件：" + content,
-                    user_content="总结这个文件，总字数控制在300字以内，不要使用markdown格式。如果是代码文件，分析并总结代码内容，简洁地列出其实现的功能与继承关系；如果是脚本文件，详细说明其指令内容及如何运行。总字数控制在300字以内，不要使用markdown格式。",
-                    agent=self.summarizer,
-                    model="deepseek-chat"
-                )
-                print(new_summary[rel_path])
-
-                # 更新摘要索引
-                self.summary_index[rel_path] = {
-                    "hash": current_hash,
-                    "modified": False  # 表示文件已处理
-                }
-            except Exception as e:
-                print(f"生成摘要失败({rel_path}): {str(e)}")
+            summary_text, event = self.claim_content(current_hash)
+            if summary_text is not None:
+                reused[rel_path] = summary_text
+            elif event is not None:
+                waiting[rel_path] = event
+            else:
+                claimed[rel_path] = (current_hash, content)
+
+        summaries, errors = {}, {}
+        try:
+            if len(claimed) > 1:
+                try:
+                    summaries = self.summarize_batch({rel_path: content for rel_path, (_, content) in claimed.items()})
+                except Exception as e:
+                    print(f"批量生成 {len(claimed)} 个文件的摘要失败，改为逐个生成: {str(e)}")
+                else:
+                    if len(summaries) < len(claimed):
+                        print(f"批量摘要中有 {len(claimed) - len(summaries)} 个文件未能解析，改为逐个生成")
+            for rel_path, (current_hash, content) in claimed.items():
+                if summaries.get(rel_path) is None:
+                    try:
+                        summaries[rel_path] = self.summarize_file(rel_path, content)
+                    except Exception as e:
+                        errors[rel_path] = e
+        finally:
+            if not force_reload:
+                for rel_path, (current_hash, _) in claimed.items():
+                    self.release_content(current_hash, summaries.get(rel_path))
+
+        for rel_path, event in waiting.items():
+            current_hash, content = pending[rel_path]
+            while True:
+                event.wait()
+                summary_text, event = self.claim_content(current_hash)
+                if summary_text is not None:
+                    reused[rel_path] = summary_text
+                    break
+                if event is None:
+                    # 先前生成该内容摘要的请求失败了，由本线程重新生成
+                    try:
+                        summaries[rel_path] = self.summarize_file(rel_path, content)
+                    except Exception as e:
+                        errors[rel_path] = e
+                    finally:
+                        self.release_content(current_hash, summaries.get(rel_path))
+                    break
+
+        for rel_path, (current_hash, content) in pending.items():
+            summary_text = reused.get(rel_path) or summaries.get(rel_path)
+            identifiers = extract_identifiers(rel_path, content) if summary_text is not None else None
+            results.append((rel_path, current_hash, summary_text, identifiers,
+                            errors.get(rel_path) if summary_text is None else None, rel_path in reused))
+        return results
+
+    def claim_content(self, content_hash: str):
+        """
+        查找内容哈希已有的摘要（尚未保存的新摘要或摘要存储中的摘要）
+
+        返回:
+            tuple: (已有的摘要, 需要等待的事件)；都为None时表示调用方已占用该内容，
+                   应为它生成摘要并在完成（或失败）后调用 release_content
+        """
+        with self.content_lock:
+            summary_text = self.content_summaries.get(content_hash)
+            if summary_text is None and self.summary_store is not None:
+                summary_text = self.summary_store.get_by_hash(content_hash)
+            if summary_text is not None:
+                return summary_text, None
+            event = self.inflight_contents.get(content_hash)
+            if event is not None:
+                return None, event
+            self.inflight_contents[content_hash] = threading.Event()
+            return None, None
+
+    def release_content(self, content_hash: str, summary_text: str = None):
+        """结束对内容的占用；summary_text 为生成的摘要（失败时为None），保存前供内容相同的其他文件沿用"""
+        with self.content_lock:
+            if summary_text is not None:
+                self.content_summaries[content_hash] = summary_text
+            event = self.inflight_contents.pop(content_hash, None)
+        if event is not None:
+            event.set()
+
+    def pack_batches(self, update_cache: Dict[str, Union[str, Callable[[], tuple]]], signatures: Dict[str, list]) -> list:
+        """
+        把小文件按路径顺序打包成若干批（每批预估不超过 batch_token_budget 个token、BATCH_MAX_FILES 个文件），
+        其余文件各自一组；文件大小取自内容或扫描时的签名，不需要先读取文件
+
+        返回:
+            list: [{相对路径: 内容或读取函数}]
+        """
+        groups, batch, batch_tokens = [], {}, 0
+        for rel_path in sorted(update_cache):
+            content = update_cache[rel_path]
+            if isinstance(content, str):
+                tokens = estimate_tokens(content)
+            elif rel_path in signatures:
+                tokens = signatures[rel_path][0] // 3  # 按字节数粗略估算
+            else:
+                tokens = None
+            if tokens is None or tokens > self.batch_file_tokens:
+                groups.append({rel_path: content})
                 continue
+            if batch and (batch_tokens + tokens > self.batch_token_budget or len(batch) >= BATCH_MAX_FILES):
+                groups.append(batch)
+                batch, batch_tokens = {}, 0
+            batch[rel_path] = content
+            batch_tokens += tokens
+        if batch:
+            groups.append(batch)
+        return groups
 
-        # 更新内存中的摘要
-        self.summary.update(new_summary)
+    def update_summary(self, update_cache: Dict[str, Union[str, Callable[[], tuple]]], force_reload = False,
+                       progress_callback=None, signatures: Dict[str, list] = None,
+                       cancel_event: threading.Event = None, stats: dict = None) -> dict:
+        """
+        更新摘要并自动保存到文件
 
-        # 保存到文件系统
-        self.save_summary()
+        update_cache 的值可以是文件内容，也可以是返回 (文件内容, 耗时信息) 的读取函数；后者在工作线程中
+        才读取文件，内容只在生成摘要期间驻留内存，指纹在读取时一并算出。
+        内容未变而哈希仍是旧算法的条目会升级为当前算法的指纹，不重新生成摘要。
+        文件由线程池并发处理（最多 max_workers 个请求同时进行），小文件打包成批，一次请求生成多个摘要；
+        progress_callback(完成数, 总数, 相对路径) 在每个文件完成后按完成顺序调用。
+        signatures 为扫描时得到的文件签名，会一并写入摘要索引供下次扫描跳过未修改的文件。
+        已生成的摘要每隔 checkpoint_interval 秒保存一次；重试后仍失败的文件记入失败队列，由 retry_failed 稍后重试。
+        cancel_event 被设置后不再发出新的请求，已完成的摘要照常保存，其余文件留到下次扫描。
+        若提供 stats 字典，会把 "summarized"（新生成的摘要数）、"reused"（沿用内容相同的文件已有摘要的文件数）、
+        "unchanged"（内容未变化的文件数）、"failed"（失败的文件数）累加进去，
+        并在 "file_timings" 中记录每个被读取文件的耗时 {相对路径: {read, decode, bytes, encoding}}。
+        """
+        with self.scan_lock:
+            if signatures is None:
+                signatures = {}
+            new_summary = {}
+            migrated = {}  # {相对路径: 升级前的哈希}
+            failures, succeeded = {}, []
+            last_checkpoint = time.monotonic()
+
+            total = len(update_cache)
+            done = unchanged = failed = reused_count = 0
+            timings = stats.setdefault("file_timings", {}) if stats is not None else None
+            if update_cache:
+                groups = self.pack_batches(update_cache, signatures) if self.batch_file_tokens > 0 \
+                    else [{rel_path: content} for rel_path, content in update_cache.items()]
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(groups))) as executor:
+                    futures = {executor.submit(self.load_and_summarize_batch, group, force_reload, timings): group
+                               for group in groups}
+                    cancelled = False
+                    remaining = len(futures)
+                    metrics.set("aide_summary_queue_depth", remaining, project=self.project_label)
+                    for future in as_completed(futures):
+                        remaining -= 1
+                        metrics.set("aide_summary_queue_depth", remaining, project=self.project_label)
+                        if future.cancelled():
+                            continue
+                        if not cancelled and cancel_event is not None and cancel_event.is_set():
+                            cancelled = True
+                            skipped = sum(f.cancel() for f in futures)
+                            print(f"已取消摘要更新，跳过 {skipped} 组尚未开始的文件")
+                        try:
+                            results = future.result()
+                        except Exception as e:
+                            # 读取文件等批量请求之外的错误，整组记为失败
+                            results = [(rel_path, None, None, None, e, False) for rel_path in futures[future]]
+                        for rel_path, current_hash, summary_text, identifiers, error, reused in results:
+                            done += 1
+                            if error is not None:
+                                print(f"[{done}/{total}] 生成摘要失败({rel_path}): {str(error)}")
+                                failures[rel_path] = f"{type(error).__name__}: {error}"
+                                failed += 1
+                            else:
+                                succeeded.append(rel_path)
+                                if current_hash is not None and summary_text is None:
+                                    # 文件未修改，保留现有摘要，只刷新签名与哈希算法
+                                    unchanged += 1
+                                    entry = self.summary_index.get(rel_path)
+                                    if entry is not None and entry.get("hash") != current_hash:
+                                        migrated[rel_path] = entry.get("hash", "")
+                                        entry.update(hash=current_hash, hash_algorithm=HASH_ALGORITHM)
+                                        # 摘要正文按内容哈希保存，在新的哈希下再写入一份（旧的由垃圾回收删除）
+                                        summary_text = self.summary.get(rel_path)
+                                        if summary_text is not None:
+                                            self.summary.put(rel_path, summary_text)
+                                        self.mark_dirty(rel_path)
+                                    if rel_path in signatures and entry is not None \
+                                            and entry.get("stat") != signatures[rel_path]:
+                                        entry["stat"] = signatures[rel_path]
+                                        self.mark_dirty(rel_path)
+                                elif current_hash is not None:
+                                    new_summary[rel_path] = summary_text
+                                    self.summary.put(rel_path, summary_text)
+                                    self.file_index.update(rel_path, summary_text, identifiers)
+                                    if reused:
+                                        reused_count += 1
+                                        print(f"[{done}/{total}] 【{rel_path}】与已有文件内容相同，沿用其摘要")
+                                    else:
+                                        print(f"[{done}/{total}] 更新【{rel_path}】的摘要")
+
+                                    # 更新摘要索引
+                                    self.summary_index[rel_path] = {
+                                        "hash": current_hash,
+                                        "hash_algorithm": HASH_ALGORITHM,
+                                        "modified": False,  # 表示文件已处理
+                                        "tokens": summary_entry_tokens(rel_path, summary_text)
+                                    }
+                                    if rel_path in signatures:
+                                        self.summary_index[rel_path]["stat"] = signatures[rel_path]
+                                    self.mark_dirty(rel_path)
+                            if progress_callback is not None:
+                                progress_callback(done, total, rel_path)
+                        if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                            self.checkpoint(failures, succeeded)
+                            last_checkpoint = time.monotonic()
+            if new_summary:
+                self.summary_generation += 1
+            if migrated:
+                print(f"已把 {len(migrated)} 个文件的哈希升级为 {HASH_ALGORITHM}（内容未变，沿用原有摘要）")
+                self.migrate_directory_hashes(migrated)
+            summarized = len(new_summary) - reused_count
+            for result, count in (("summarized", summarized), ("reused", reused_count), ("unchanged", unchanged),
+                                  ("failed", failed)):
+                metrics.inc("aide_summaries_total", count, project=self.project_label, result=result)
+            if stats is not None:
+                stats["summarized"] = stats.get("summarized", 0) + summarized
+                stats["reused"] = stats.get("reused", 0) + reused_count
+                stats["unchanged"] = stats.get("unchanged", 0) + unchanged
+                stats["failed"] = stats.get("failed", 0) + failed
 
-        return new_summary
+            # 保存到文件系统
+            self.checkpoint(failures, succeeded)
+
+            return new_summary
+
+    @staticmethod
+    def clean_history(chat_history) -> list:
+        """只保留可发送给API的对话历史（去掉界面上的思考过程等附加消息和多余字段）"""
+        history = []
+        for message in chat_history or []:
+            if not isinstance(message.get("content"), str):
+                continue
+            if (message.get("metadata") or {}).get("title"):
+                continue
+            history.append({"role": message["role"], "content": message["content"]})
+        return history
 
-    def simple_talk(self, system_content: str, user_content: str, history_messages: list = None, agent=None,model=None) -> str:
+    def build_messages(self, system_content: str, user_content: str, history_messages: list = None) -> list:
         if len(system_content) > 65000:
             system_content = system_content[:65000]
-        if agent is None:
-            agent = self.assistant
-        if model is None:
-            model = self.model
         if history_messages is None:
             history_messages = []
         messages = [{"role": "system", "content": system_content}] + history_messages
         messages.append({"role": "user", "content": user_content})
-        response = agent.chat.completions.create(model=model,messages=messages,stream=False)
-        print("response: ")
-        print(response.choices[0].message.content)
+        return messages
+
+    @staticmethod
+    def add_usage(usage: dict, response_usage) -> None:
+        """把一次请求的token用量累加到 usage 字典；cached_tokens 为命中服务端上下文缓存的输入token数"""
+        if usage is None or response_usage is None:
+            return
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            usage[key] = usage.get(key, 0) + (getattr(response_usage, key, 0) or 0)
+        # DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 返回 prompt_tokens_details.cached_tokens
+        cached = getattr(response_usage, "prompt_cache_hit_tokens", None)
+        if cached is None:
+            cached = getattr(getattr(response_usage, "prompt_tokens_details", None), "cached_tokens", None)
+        usage["cached_tokens"] = usage.get("cached_tokens", 0) + (cached or 0)
+
+    def record_call(self, agent, model: str, seconds: float, response_usage=None, error: Exception = None) -> None:
+        """记录一次API请求的耗时、结果与token用量（按项目、角色、模型统计）"""
+        role = "summarizer" if agent is self.summarizer else "assistant"
+        labels = {"project": self.project_label, "role": role, "model": model}
+        metrics.inc("aide_api_requests_total", status="ok" if error is None else "error", **labels)
+        metrics.observe("aide_api_request_seconds", seconds, role=role, model=model)
+        usage = {}
+        self.add_usage(usage, response_usage)
+        for kind, key in (("prompt", "prompt_tokens"), ("completion", "completion_tokens"), ("cached", "cached_tokens")):
+            if usage.get(key):
+                metrics.inc("aide_tokens_total", usage[key], kind=kind, **labels)
+
+    def simple_talk(self, system_content: str, user_content: str, history_messages: list = None, agent=None,model=None,
+                    usage: dict = None, response_format: dict = None) -> str:
+        """单次对话请求；若提供 usage 字典，会把本次请求的token用量累加进去；response_format 用于要求JSON输出"""
+        if agent is None:
+            agent = self.assistant
+        if model is None:
+            model = self.model
+        messages = self.build_messages(system_content, user_content, history_messages)
+        retry = self.summarizer_retry if agent is self.summarizer else self.assistant_retry
+        options = {"response_format": response_format} if response_format is not None else {}
+        start = time.perf_counter()
+        try:
+            response = retry.call(agent.create, model=model, messages=messages, stream=False, **options)
+        except Exception as e:
+            self.record_call(agent, model, time.perf_counter() - start, error=e)
+            raise
+        self.record_call(agent, model, time.perf_counter() - start, getattr(response, "usage", None))
+        self.add_usage(usage, getattr(response, "usage", None))
         return response.choices[0].message.content
 
-    def analyze(self, user_input: str, chat_history, scan_files: bool = None, load_files: bool = None):
+    def stream_talk(self, system_content: str, user_content: str, history_messages: list = None, agent=None, model=None,
+                    usage: dict = None, cancel_event: threading.Event = None):
+        """
+        流式对话请求，逐段产出 ("reasoning", 文本) 或 ("content", 文本)
+
+        reasoning 为 deepseek-reasoner 等模型返回的思考过程；若提供 usage 字典，流结束时累加token用量。
+        cancel_event 被设置或生成器被关闭时立即关闭连接，服务端随之停止生成。
+        """
+        if agent is None:
+            agent = self.assistant
+        if model is None:
+            model = self.model
+        messages = self.build_messages(system_content, user_content, history_messages)
+        # 只重试建立连接阶段的失败，已开始输出后出错直接抛出
+        retry = self.summarizer_retry if agent is self.summarizer else self.assistant_retry
+        start = time.perf_counter()
+        try:
+            stream = retry.call(agent.create, model=model, messages=messages, stream=True,
+                                stream_options={"include_usage": True})
+        except Exception as e:
+            self.record_call(agent, model, time.perf_counter() - start, error=e)
+            raise
+        response_usage, error = None, None
+        try:
+            for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                if getattr(chunk, "usage", None) is not None:
+                    response_usage = chunk.usage
+                self.add_usage(usage, getattr(chunk, "usage", None))
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                reasoning = getattr(delta, "reasoning_content", None)
+                if reasoning:
+                    yield "reasoning", reasoning
+                if delta.content:
+                    yield "content", delta.content
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            stream.close()
+            self.record_call(agent, model, time.perf_counter() - start, response_usage, error)
+
+    def git_scan_plan(self):
+        """
+        git 仓库中代替遍历目录的扫描计划：有上次扫描记录的提交（且文件类型未变）时，只检查自该提交以来
+        变化的文件、未跟踪的文件、上次扫描时与提交不同的文件和失败队列中的文件；否则从git索引读取全部文件
+
+        返回:
+            tuple: (要检查的相对路径列表, 是否为全部文件, 扫描完成后要记录的状态)；
+                   不是git仓库或git不可用时返回 (None, True, None)，由调用方遍历目录
+        """
+        if not self.git_scan or not self.project_root or not is_git_repository(self.project_root):
+            return None, True, None
+        try:
+            head = git_head(self.project_root)
+            file_types = sorted(self.file_types) if self.file_types is not None else None
+            state = {"commit": head, "file_types": file_types,
+                     "dirty": git_changed_files(self.project_root, head) if head else []}
+            last = self.summary_store.get_meta(GIT_STATE_KEY) if self.summary_store is not None else None
+            if last and last.get("commit") and head and last.get("file_types") == file_types and self.summary_index:
+                changed = git_changed_files(self.project_root, last["commit"])
+                # 失败队列中的文件不论是否到了重试时间都一并检查（命令行模式没有后台监视线程来重试）
+                failed = self.summary_store.due_failures(now=float("inf"))
+                return sorted(set(changed) | set(last.get("dirty", [])) | set(failed)), False, state
+            return git_project_files(self.project_root), True, state
+        except ValueError as e:
+            # 上次记录的提交已不存在（如变基后被回收）等情况
+            print(f"无法使用git扫描，改为遍历目录: {str(e)}")
+            return None, True, None
+
+    def refresh_files(self, rel_paths: list = None, progress_callback=None, cancel_event: threading.Event = None,
+                      stats: dict = None) -> int:
+        """
+        检查文件变化并更新摘要；rel_paths 为 None 时检查整个项目，否则只检查给定的相对路径
+
+        项目根目录是git仓库时，检查整个项目不再遍历目录：首次从git索引读取已跟踪和未被忽略的文件，
+        之后只检查自上次扫描记录的提交以来的变化（git diff）、未跟踪的文件和上次与提交不同的文件，
+        扫描的开销与改动的多少成正比，而不是与仓库大小成正比
+
+        progress_callback、cancel_event 与 stats 的含义同 update_summary；取消后不再汇总目录摘要。
+        stats 中另外记录 "scanned"（检查的文件数）、"changed"（签名变化的文件数）、"removed"（已删除而移出索引的文件数）、
+        "directories"（重新生成的目录摘要数）、"collected"（完整扫描后回收的不再被引用的摘要数）与
+        "scan_mode"（walk/git/git-incremental）。
+        文件被移动或复制时，新路径沿用内容相同的已有摘要，不请求API
+
+        返回:
+            int: 签名发生变化、被重新检查的文件数
+        """
+        with self.scan_lock, span("scan", project=self.project_label, full=rel_paths is None) as scan_attrs:
+            # 签名(大小, 修改时间, inode)未变化的文件不会被读取；
+            # 其余文件只传入读取函数，由 update_summary 在工作线程中按需读取
+            known_signatures = {rel_path: data["stat"] for rel_path, data in self.summary_index.items() if "stat" in data}
+            git_paths, git_full, git_state = self.git_scan_plan() if rel_paths is None else (None, True, None)
+            if rel_paths is not None:
+                scan_mode = "paths"
+                records = stat_project_files(self.project_root, rel_paths, self.file_types, known_signatures)
+            elif git_paths is not None:
+                scan_mode = "git" if git_full else "git-incremental"
+                records = stat_project_files(self.project_root, git_paths, self.file_types, known_signatures)
+            else:
+                scan_mode = "walk"
+                records = iter_project_files(self.project_root, self.file_types, known_signatures)
+            scan_attrs["mode"] = scan_mode
+            signatures = {}
+            modified_files = {}
+            with span("scan.walk"):
+                for record in records:
+                    signatures[record.rel_path] = record.signature
+                    if record.changed:
+                        modified_files[record.rel_path] = record.load
+            scan_attrs.update(files=len(signatures), changed=len(modified_files))
+            metrics.inc("aide_scan_files_total", len(signatures), project=self.project_label)
+            metrics.inc("aide_scan_changed_files_total", len(modified_files), project=self.project_label)
+
+            # 更新摘要
+            if modified_files:
+                with span("scan.summarize", files=len(modified_files)):
+                    self.update_summary(modified_files, signatures=signatures, progress_callback=progress_callback,
+                                        cancel_event=cancel_event, stats=stats)
+                print(f"已检查 {len(modified_files)} 个变更文件的摘要")
+            # 已删除（或被移走）的文件移出索引
+            if rel_paths is not None:
+                candidates = rel_paths
+            elif git_paths is not None and not git_full:
+                candidates = git_paths
+            else:
+                candidates = list(self.summary_index)
+            removed = [rel_path for rel_path in candidates if rel_path in self.summary_index
+                       and rel_path not in signatures
+                       and not os.path.isfile(os.path.join(self.project_root, rel_path))]
+            self.remove_summaries(removed)
+            if stats is not None:
+                stats["scanned"] = stats.get("scanned", 0) + len(signatures)
+                stats["changed"] = stats.get("changed", 0) + len(modified_files)
+                stats["removed"] = stats.get("removed", 0) + len(removed)
+                stats["scan_mode"] = scan_mode
+            if cancel_event is not None and cancel_event.is_set():
+                return len(modified_files)
+            if git_state is not None and self.summary_store is not None:
+                # 生成失败的文件留在失败队列中，之后的增量扫描会再次检查，不影响记录的提交
+                self.summary_store.set_meta(GIT_STATE_KEY, git_state)
+            # 沿变更文件的上级目录更新目录摘要（目录哈希未变化时不调用API）
+            with span("scan.directories") as directory_attrs:
+                directories = directory_attrs["updated"] = self.update_directory_summaries()
+            if stats is not None:
+                stats["directories"] = stats.get("directories", 0) + directories
+            if rel_paths is None and self.summary_store is not None:
+                # 只在完整扫描后回收：分批处理的移动事件中，旧路径可能先于新路径被删除
+                collected = self.summary_store.collect_garbage()
+                if collected:
+                    print(f"已回收 {collected} 条不再被引用的摘要")
+                chunks = self.chunk_cache.collect_garbage(entry.get("hash") for entry in self.summary_index.values())
+                if chunks:
+                    print(f"已回收 {chunks} 份不再被引用的代码块切分结果")
+                if stats is not None:
+                    stats["collected"] = stats.get("collected", 0) + collected
+            return len(modified_files)
+
+    def pick_files(self, user_input: str, query: str, chat_history=None, limit: int = 5, usage: dict = None,
+                   system_prompt: str = None) -> list:
+        """
+        从本地文件索引中检索与问题相关的文件；开启 llm_file_picker 时再由LLM从候选中筛选
+
+        system_prompt 为回答时使用的系统提示词，筛选请求沿用它作为前缀以命中服务端的上下文缓存。
+        """
+        candidates = self.file_index.search(query, limit=limit * 3 if self.llm_file_picker else limit)
+        if not self.llm_file_picker or len(candidates) <= 1:
+            return candidates[:limit]
+
+        candidate_content = "".join(f"[{path}]:\n{self.summary.get(path, '')}\n-----\n" for path in candidates)
+        if system_prompt is None:
+            system_prompt = "以下是项目文件的信息概览：\n"
+        user_content = (user_input + "\n\n以下是与问题可能相关的候选文件：\n" + candidate_content +
+                        f"\n从上面的候选文件中只列出回答我的问题所需要参考的关键文件（最多{limit}个，越少越好）的相对路径，每行一个。")
+        try:
+            answer = self.simple_talk(system_content=system_prompt, history_messages=chat_history,
+                                      user_content=user_content, agent=self.assistant, model="deepseek-chat", usage=usage)
+        except Exception as e:
+            print(f"LLM筛选文件失败，使用本地检索结果: {str(e)}")
+            return candidates[:limit]
+        # 只接受候选列表中的路径，按其在回答中出现的位置排序
+        normalized = answer.replace("\\", "/")
+        positions = {path: normalized.find(path.replace("\\", "/")) for path in candidates}
+        picked = sorted((path for path, pos in positions.items() if pos >= 0), key=positions.get)
+        return picked[:limit] if picked else candidates[:limit]
+
+    def prepare_analysis(self, user_input: str, chat_history, scan_files: bool = None, load_files: bool = None,
+                         stats: dict = None):
+        """
+        扫描（可选）、组装项目概览并拉取相关代码片段；统计信息写入 stats（未提供时写入 self.last_stats），
+        其中 "timings" 为各阶段耗时（秒）
+
+        返回:
+            tuple: (系统提示词, 用户输入, 对话历史, 读取的文件列表, token用量字典)
+        """
+        chat_history = self.clean_history(chat_history)
+        if stats is None:
+            stats = self.last_stats = {}
+        timings = stats.setdefault("timings", {})
         if scan_files is None:
-            if len(self.summary.keys()) == 0:
+            if len(self.summary) == 0:
                 scan_files = True
             else:
                 scan_files = False
-        project_content = ""
         if scan_files:
             # 项目根目录检查
             if not self.project_root or not os.path.isdir(self.project_root):
-                return "错误：未设置有效项目根目录"
+                raise ValueError("错误：未设置有效项目根目录")
 
-            text_files = scan_project_files(self.project_root, text_extensions=self.file_types)
-            modified_files = {}
-
-            # 对比缓存文件
-            for rel_path, content in text_files.items():
-                if rel_path in self.summary_index and self.summary_index[rel_path]['hash'] == self.calculate_file_hash(content):
-                    continue
-                modified_files[rel_path] = content
-
-            self.cached_files = text_files
-            # 更新摘要
-            if modified_files:
-                self.update_summary(modified_files)
-                print(f"已更新 {len(modified_files)} 个文件的摘要")
-        # 构建项目内容概述
-        for key, value in self.summary.items():
-            project_content += f"[{key}]:\n{value}\n-----\n"
-        print(f"已加载 {len(self.summary)} 个文件的摘要")
+            if self.watcher is not None and self.watcher.is_alive():
+                # 后台监视已在运行：只请求一次后台扫描，不阻塞本次请求
+                self.watcher.request_scan()
+            else:
+                with span("analyze.scan", timings):
+                    self.refresh_files()
+        # 构建项目内容概述：按与问题（及最近的提问）的相关度在token预算内挑选摘要
+        recent_questions = [m["content"] for m in chat_history[-4:] if m["role"] == "user"]
+        query = " ".join(recent_questions + [user_input])
+        # 稳定部分放在系统提示词中作为固定前缀；相关摘要随本次问题发送
+        with span("analyze.context", timings) as context_attrs:
+            project_content, relevant_content, context_stats = self.context_builder.build(
+                self.summary_index, self.summary, query, self.context_token_budget, self.summary_generation,
+                self.directory_summary)
+            context_attrs.update(context_stats)
+        system_prompt = "以下是项目文件的信息概览：\n" + project_content + "\n请根据以上信息回答用户的问题。"
+        usage = {}
+        stats.update(context=context_stats, usage=usage)
+        print(f"已加载 {context_stats['summaries']}/{context_stats['total_summaries']} 个文件的摘要、"
+              f"{context_stats['directories']} 个目录摘要，"
+              f"约 {context_stats['context_tokens']} tokens（概览版本 {context_stats['context_version']}）")
 
+        file_pths = []
         if load_files:
-            user_input_temp = user_input + "\n\n只列出回答我的问题所需要参考的关键项目代码文件（最多5个，越少越好）的相对路径，路径前后不要加上\"和\"，第一个路径前加上[, 最后一个路径后加上]，以\",\"分隔。示例格式：\"[\\relpath\\A.py,\\relpath\\B.java]\""
-            system_prompt = "以下是项目文件的信息概览：\n" + project_content + "\n请根据以上信息回答用户的问题。"
-            file_pths = self.simple_talk(system_content=system_prompt, history_messages=chat_history, user_content=user_input_temp, agent=self.assistant, model="deepseek-chat")
-            file_pths = [file.strip() for file in file_pths.split("[")[1].split("]")[0].split(",")]
-            if len(file_pths) > 5: file_pths = file_pths[:5]
+            with span("analyze.pick_files", timings) as pick_attrs:
+                file_pths = pick_attrs["files"] = self.pick_files(user_input, query, chat_history, usage=usage,
+                                                                  system_prompt=system_prompt)
             print(file_pths)
-            user_input += "\n以下是参考用的项目代码文件：\n"
-            for file in file_pths:
-                file_path = os.path.join(self.project_root, file)
-                try:
-                    with open(file_path, 'rb') as f:
-                        raw_data = f.read()
-                        encoding = chardet.detect(raw_data)['encoding'] or 'utf-8'
-                    # 使用检测到的编码读取文件内容
-                    with open(file_path, 'r', encoding=encoding, errors='replace') as f:
-                        content = f.read()
-                        user_input += file + ": \n" + content + "\n\n"
-                except Exception as e:
-                    user_input += f"{file}:文件读取失败: {str(e)}\n"
-            system_prompt = "以下是项目文件的信息概览：\n" + project_content + "\n请根据以上信息回答用户的问题。"
-            return self.simple_talk(system_content=system_prompt, history_messages=chat_history,
-                                    user_content=user_input, agent=self.assistant), file_pths
-        else:
-            system_prompt = "以下是项目文件的信息概览：\n" + project_content + "\n请根据以上信息回答用户的问题。"
-            return self.simple_talk(system_content=system_prompt, history_messages=chat_history, user_content=user_input, agent=self.assistant), []
\ No newline at end of file
+            # 只注入与问题相关的函数/类/章节代码块，而不是整个文件
+            contents, hashes = {}, {}
+            notes = ""
+            with span("analyze.snippets", timings) as snippet_attrs:
+                for file in file_pths:
+                    try:
+                        content, hashes[file] = self.cached_files.load(file)
+                        if content is None:
+                            notes += f"{file}:二进制文件，已跳过\n"
+                        else:
+                            contents[file] = content
+                    except Exception as e:
+                        notes += f"{file}:文件读取失败: {str(e)}\n"
+                snippets, snippet_stats = select_snippets(contents, query, self.snippet_token_budget,
+                                                          self.chunk_cache, self.calculate_file_hash, hashes=hashes)
+                snippet_attrs.update(snippet_stats)
+            stats["snippets"] = snippet_stats
+            print(f"注入 {snippet_stats['snippets']}/{snippet_stats['total_snippets']} 个代码块，"
+                  f"约 {snippet_stats['snippet_tokens']}/{snippet_stats['full_file_tokens']} tokens")
+            user_input += "\n以下是参考用的项目代码片段：\n" + snippets + notes
+        if relevant_content:
+            user_input += "\n以下是与问题相关的文件摘要：\n" + relevant_content
+        return system_prompt, user_input, chat_history, file_pths, usage
+
+    def analyze(self, user_input: str, chat_history, scan_files: bool = None, load_files: bool = None,
+                model: str = None, agent=None, stats: dict = None):
+        """
+        回答关于项目的问题；model、agent（对话客户端池）与 stats（统计信息输出字典）供多个会话共用同一管理器时
+        各自指定，未提供时使用管理器的设置并把统计信息写入 self.last_stats
+        """
+        if stats is None:
+            stats = self.last_stats = {}
+        model = model or self.model
+        try:
+            with span("analyze.prepare", model=model):
+                system_prompt, user_input, chat_history, file_pths, usage = self.prepare_analysis(
+                    user_input, chat_history, scan_files, load_files, stats)
+        except ValueError as e:
+            return str(e), []
+        cache_key = self.response_cache.key(model, self.build_messages(system_prompt, user_input, chat_history))
+        cached = self.response_cache.get(cache_key)
+        stats["cached_response"] = cached is not None
+        if cached is not None:
+            return cached["content"], file_pths
+        with span("analyze.answer", stats["timings"], model=model):
+            answer = self.simple_talk(system_content=system_prompt, history_messages=chat_history,
+                                      user_content=user_input, agent=agent or self.assistant, model=model, usage=usage)
+        self.response_cache.put(cache_key, {"reasoning": "", "content": answer})
+        return answer, file_pths
+
+    def analyze_stream(self, user_input: str, chat_history, scan_files: bool = None, load_files: bool = None,
+                       model: str = None, agent=None, stats: dict = None, cancel_event: threading.Event = None):
+        """
+        analyze 的流式版本：先产出 ("files", 读取的文件列表)，之后逐段产出 ("reasoning"/"content", 文本)；
+        cancel_event 被设置后中止回答，不完整的回答不会被缓存
+        """
+        if stats is None:
+            stats = self.last_stats = {}
+        model = model or self.model
+        try:
+            with span("analyze.prepare", model=model):
+                system_prompt, user_input, chat_history, file_pths, usage = self.prepare_analysis(
+                    user_input, chat_history, scan_files, load_files, stats)
+        except ValueError as e:
+            yield "files", []
+            yield "content", str(e)
+            return
+        yield "files", file_pths
+        cache_key = self.response_cache.key(model, self.build_messages(system_prompt, user_input, chat_history))
+        cached = self.response_cache.get(cache_key)
+        stats["cached_response"] = cached is not None
+        if cached is not None:
+            if cached["reasoning"]:
+                yield "reasoning", cached["reasoning"]
+            yield "content", cached["content"]
+            return
+        answer = {"reasoning": "", "content": ""}
+        # 生成器在各次 yield 之间可能换线程执行，不能用 span 包住，结束时再记录
+        start_wall, start = time.time(), time.perf_counter()
+        first_token = None
+        try:
+            for kind, text in self.stream_talk(system_content=system_prompt, history_messages=chat_history,
+                                               user_content=user_input, agent=agent or self.assistant, model=model,
+                                               usage=usage, cancel_event=cancel_event):
+                if first_token is None:
+                    first_token = stats["timings"]["first_token"] = time.perf_counter() - start
+                answer[kind] += text
+                yield kind, text
+        finally:
+            stats["timings"]["answer"] = time.perf_counter() - start
+            record_span("analyze.answer", start_wall, stats["timings"]["answer"], model=model,
+                        first_token=first_token, cancelled=cancel_event is not None and cancel_event.is_set())
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        # 只缓存完整接收的回答（中途停止时不会执行到这里）
+        self.response_cache.put(cache_key, answer)
@@ -0,0 +1,771 @@
+"""
+性能基准脚本：在本地启动一个兼容 OpenAI 接口的假服务器，无需真实密钥即可测量摘要生成等热点路径
+
+用法:
+    python benchmark.py summary --files 200 --latency 0.2 --workers 1,4,8,16
+    python benchmark.py ignore --packages 300 --depth 4
+    python benchmark.py startup --files 50000
+    python benchmark.py batch --small 200 --large 20
+    python benchmark.py gradio --users 16 --latency 0.5
+    python benchmark.py suite --files 2000 --output results.json --baseline baseline.json
+
+suite 在合成项目上依次测量各热点路径，结果写入JSON；提供 --baseline 时与之前的结果比较，
+有指标变差超过 --tolerance 时以退出码1结束，可放在CI中检查性能回退。
+"""
+import argparse
+import asyncio
+import collections
+import fnmatch
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_BATCH_FILE_RE = re.compile(r"^===== 文件: (.+) =====$", re.MULTILINE)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """模拟 /chat/completions 接口，按配置的延迟返回固定回复；要求JSON输出时按批量摘要的格式回答"""
+
+    latency = 0.1
+    # 流式回复中相邻两段之间的间隔（秒）
+    chunk_delay = 0.0
+    # 已见过的系统提示词，模拟 DeepSeek 的前缀缓存（prompt_cache_hit_tokens）
+    seen_prefixes = set()
+    # 收到的请求数，用列表以便各线程共享同一计数
+    request_count = [0]
+    aborted = [0]
+    # 每秒最多处理的请求数，超出的请求返回429并附带 retry-after-ms（0为不限）
+    rate_limit = 0
+    # 随机返回500错误的请求比例（由 rng 决定，固定种子时可复现）
+    error_rate = 0.0
+    rng = random.Random(0)
+    state_lock = threading.Lock()
+    # 最近一秒内已接受的请求时间
+    request_times = collections.deque()
+    rate_limited = [0]
+    errors = [0]
+    # 成功回复的请求计费的输入token数
+    prompt_tokens = [0]
+
+    def usage(self, request, prompt_chars, completion_tokens):
+        messages = request.get("messages", [])
+        system = messages[0].get("content") or "" if messages else ""
+        with self.state_lock:
+            hit = len(system) // 3 if system in self.seen_prefixes else 0
+            self.seen_prefixes.add(system)
+            self.prompt_tokens[0] += prompt_chars // 3
+        return {"prompt_tokens": prompt_chars // 3, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_chars // 3 + completion_tokens,
+                "prompt_cache_hit_tokens": hit, "prompt_cache_miss_tokens": prompt_chars // 3 - hit}
+
+    def check_limits(self):
+        """按配置注入错误或限流，返回 (状态码, 响应头)；正常处理的请求返回None"""
+        with self.state_lock:
+            if self.error_rate and self.rng.random() < self.error_rate:
+                self.errors[0] += 1
+                return 500, {}
+            if self.rate_limit:
+                now = time.monotonic()
+                while self.request_times and now - self.request_times[0] >= 1.0:
+                    self.request_times.popleft()
+                if len(self.request_times) >= self.rate_limit:
+                    self.rate_limited[0] += 1
+                    wait_ms = int((1.0 - (now - self.request_times[0])) * 1000) + 1
+                    return 429, {"retry-after-ms": str(wait_ms), "x-ratelimit-remaining-requests": "0"}
+                self.request_times.append(now)
+        return None
+
+    def send_error_response(self, status, headers):
+        message = "Rate limit reached" if status == 429 else "Injected server error"
+        body = json.dumps({"error": {"message": message, "type": "fake_error", "code": status}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        self.request_count[0] += 1
+        rejected = self.check_limits()
+        if rejected is not None:
+            self.send_error_response(*rejected)
+            return
+        time.sleep(self.latency)
+        prompt_chars = sum(len(m.get("content") or "") for m in request.get("messages", []))
+        if request.get("stream"):
+            self.send_stream(request, prompt_chars)
+            return
+        content = "这是一个模拟的摘要。"
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            system = request["messages"][0].get("content") or ""
+            content = json.dumps({path: f"{path} 的模拟摘要。" for path in _BATCH_FILE_RE.findall(system)},
+                                 ensure_ascii=False)
+        body = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": self.usage(request, prompt_chars, 10)
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, request, prompt_chars):
+        """以 SSE 形式逐字返回回复，最后附带用量信息"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": request.get("model", "fake")}
+        for piece in ["这是", "一个", "模拟的", "回答。"]:
+            chunk = dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+            try:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            except OSError:
+                # 客户端中止了回答
+                self.aborted[0] += 1
+                return
+            time.sleep(self.chunk_delay)
+        usage = self.usage(request, prompt_chars, 4)
+        try:
+            self.wfile.write(f"data: {json.dumps(dict(base, choices=[], usage=usage))}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except OSError:
+            self.aborted[0] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_server(latency=0.1, chunk_delay=0.0, rate_limit=0, error_rate=0.0, seed=0):
+    """在后台线程启动假服务器，返回 (server, base_url)；各计数器在 server.RequestHandlerClass 上"""
+    handler = type("Handler", (FakeOpenAIHandler,), {
+        "latency": latency, "chunk_delay": chunk_delay, "rate_limit": rate_limit, "error_rate": error_rate,
+        "rng": random.Random(seed), "state_lock": threading.Lock(), "request_times": collections.deque(),
+        "seen_prefixes": set(), "request_count": [0], "aborted": [0], "rate_limited": [0], "errors": [0],
+        "prompt_tokens": [0],
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def make_files(count, size=2000):
+    """生成 {相对路径: 内容} 的合成文件"""
+    return {
+        os.path.join(f"pkg{i % 10}", f"module_{i}.py"): f"# module {i}\n" + "x = 1\n" * (size // 6)
+        for i in range(count)
+    }
+
+
+def bench_summary(args):
+    from API_manager import API_manager
+
+    server, base_url = start_fake_server(args.latency)
+    files = make_files(args.files)
+    print(f"文件数: {args.files} | 模拟延迟: {args.latency}s")
+    print(f"{'workers':>8} {'耗时(s)':>10} {'文件/秒':>10}")
+    try:
+        for workers in [int(w) for w in args.workers.split(",")]:
+            with tempfile.TemporaryDirectory() as root:
+                manager = API_manager(assistant_api_key="fake", base_url=base_url,
+                                      project_root=root, max_workers=workers, batch_file_tokens=0)
+                start = time.perf_counter()
+                manager.update_summary(files)
+                elapsed = time.perf_counter() - start
+            print(f"{workers:>8} {elapsed:>10.2f} {args.files / elapsed:>10.1f}")
+    finally:
+        server.shutdown()
+
+
+def bench_batch(args):
+    from API_manager import API_manager
+
+    server, base_url = start_fake_server(args.latency)
+    # 大量小文件（配置、__init__.py、短模块）混合少量大文件
+    files = make_files(args.small, size=600)
+    files.update({os.path.join("core", f"engine_{i}.py"): f"# engine {i}\n" + "y = 2\n" * 1500
+                  for i in range(args.large)})
+    print(f"小文件: {args.small} | 大文件: {args.large} | 模拟延迟: {args.latency}s | workers: {args.workers}")
+    print(f"{'模式':<8} {'请求数':>8} {'耗时(s)':>10} {'摘要数':>8}")
+    try:
+        for mode, batch_file_tokens in (("single", 0), ("batch", 800)):
+            with tempfile.TemporaryDirectory() as root:
+                manager = API_manager(assistant_api_key="fake", base_url=base_url, project_root=root,
+                                      max_workers=args.workers, batch_file_tokens=batch_file_tokens)
+                server.RequestHandlerClass.request_count[0] = 0
+                start = time.perf_counter()
+                manager.update_summary(files)
+                elapsed = time.perf_counter() - start
+                requests = server.RequestHandlerClass.request_count[0]
+            print(f"{mode:<8} {requests:>8} {elapsed:>10.2f} {len(manager.summary):>8}")
+    finally:
+        server.shutdown()
+
+
+def bench_gradio(args):
+    """通过 Gradio 队列模拟多个用户同时提问：逐个处理 vs 并发处理，并测量停止按钮中止回答所需的时间"""
+    import functools
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor
+    from gradio_client import Client
+    import gradio_app
+    from API_manager import API_manager
+    from manager_registry import ManagerRegistry
+
+    server, base_url = start_fake_server(args.latency, args.chunk_delay)
+    # 测试用的假密钥写入临时的历史记录，不改动真实的 history_information/
+    gradio_app.PROJECTS_HISTORY_FILE = os.path.join(tempfile.mkdtemp(), "projects_history.json")
+    gradio_app.registry = ManagerRegistry(manager_factory=functools.partial(API_manager, base_url=base_url))
+    root = tempfile.mkdtemp()
+    for rel_path, content in make_files(args.files, size=600).items():
+        os.makedirs(os.path.join(root, os.path.dirname(rel_path)), exist_ok=True)
+        with open(os.path.join(root, rel_path), "w", encoding="utf-8") as f:
+            f.write(content)
+    gradio_app.demo.launch(prevent_thread_lock=True, quiet=True)
+    url = gradio_app.demo.local_url
+
+    def connect():
+        client = Client(url, verbose=False)
+        client.predict("fake", "fake", root, ".py", "deepseek-chat", api_name="/initialize_manager")
+        return client
+
+    def user(i):
+        client = connect()
+        start = time.perf_counter()
+        # 每个用户的问题不同，避免命中本地回答缓存
+        client.predict(f"第{i}个问题：这个项目做什么？", [], False, False, api_name="/handle_chat")
+        return time.perf_counter() - start
+
+    print(f"用户数: {args.users} | 模拟延迟: {args.latency}s + {args.chunk_delay}s/段 | 文件数: {args.files}")
+    print(f"{'模式':<12} {'总耗时(s)':>10} {'请求/秒':>10} {'p50(s)':>8} {'p95(s)':>8}")
+    try:
+        connect().predict(api_name="/scan_project")
+        for mode, parallel in (("serial", 1), ("concurrent", args.users)):
+            with ThreadPoolExecutor(parallel) as pool:
+                start = time.perf_counter()
+                latencies = sorted(pool.map(user, range(args.users)))
+                elapsed = time.perf_counter() - start
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            print(f"{mode:<12} {elapsed:>10.2f} {args.users / elapsed:>10.2f} "
+                  f"{statistics.median(latencies):>8.2f} {p95:>8.2f}")
+
+        # 停止按钮会取消事件对应的 asyncio 任务；回答开始输出后取消，测量服务端连接被关闭所需的时间
+        session = {"project_root": root, "assistant_api_key": ["fake"], "summarizer_api_key": ["fake"],
+                   "file_types": [".py"], "model": "deepseek-chat"}
+
+        async def answer():
+            async for _ in gradio_app.chat_with_ai("请停止这个回答", [], False, False, session):
+                pass
+
+        async def stop_answer():
+            aborted = server.RequestHandlerClass.aborted[0]
+            task = asyncio.ensure_future(answer())
+            await asyncio.sleep(args.latency + args.chunk_delay * 1.5)
+            start = time.perf_counter()
+            task.cancel()
+            while server.RequestHandlerClass.aborted[0] == aborted and time.perf_counter() - start < 10:
+                await asyncio.sleep(0.01)
+            return time.perf_counter() - start
+
+        print(f"停止回答: {asyncio.run(stop_answer()):.2f}s 后服务端连接关闭")
+    finally:
+        gradio_app.demo.close()
+        gradio_app.registry.close()
+        server.shutdown()
+
+
+def legacy_should_ignore(path, ignore_patterns):
+    """旧版逐模式 fnmatch 的忽略判断，作为对比基线"""
+    parts = path.replace(os.sep, "/").split("/")
+    for pattern in ignore_patterns:
+        pattern = pattern.rstrip("/")
+        if any(fnmatch.fnmatch(part, pattern) for part in parts):
+            return True
+    return False
+
+
+def make_node_modules_tree(root, packages, depth, patterns):
+    """生成 node_modules 风格的深层目录树，包含 .gitignore"""
+    with open(os.path.join(root, ".gitignore"), "w", encoding="utf-8") as f:
+        f.write("\n".join(patterns) + "\n")
+    for p in range(packages):
+        path = os.path.join(root, "vendor", f"pkg{p}", *[f"lib{d}" for d in range(depth)])
+        os.makedirs(path, exist_ok=True)
+        for name in ("index.js", "util.js", "README.md", "debug.log"):
+            with open(os.path.join(path, name), "w", encoding="utf-8") as f:
+                f.write("x")
+
+
+def bench_ignore(args):
+    from utils import DEFAULT_IGNORE_PATTERNS, GitIgnoreMatcher, read_gitignore
+
+    patterns = ["*.log", "*.tmp", "dist/", "coverage/", "**/__snapshots__", "/build", "*.min.js"] + \
+               [f"generated_{i}/" for i in range(args.patterns)]
+    with tempfile.TemporaryDirectory() as root:
+        make_node_modules_tree(root, args.packages, args.depth, patterns)
+        ignore_patterns = read_gitignore(os.path.join(root, ".gitignore")) + DEFAULT_IGNORE_PATTERNS
+
+        # 旧实现：目录与文件都对每条模式、每级路径做 fnmatch
+        start = time.perf_counter()
+        legacy = 0
+        for dirpath, dirs, files in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            dirs[:] = [d for d in dirs if not legacy_should_ignore(os.path.join(rel, d), ignore_patterns)]
+            legacy += sum(legacy_should_ignore(os.path.join(rel, f), ignore_patterns) for f in files)
+        legacy_time = time.perf_counter() - start
+
+        # 新实现：每个目录项只做一次合并正则匹配
+        start = time.perf_counter()
+        matcher = GitIgnoreMatcher(root)
+        compiled = 0
+        for dirpath, dirs, files in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            rel = "" if rel == "." else rel
+            matcher.load_directory(rel)
+            dirs[:] = [d for d in dirs if not matcher.is_ignored(os.path.join(rel, d), is_dir=True)]
+            compiled += sum(matcher.is_ignored(os.path.join(rel, f)) for f in files)
+        compiled_time = time.perf_counter() - start
+        print(f"目录层数: {args.depth + 2} | 模式数: {len(ignore_patterns)}")
+
+    print(f"fnmatch 逐模式: {legacy_time:.3f}s (忽略 {legacy})")
+    print(f"编译正则:       {compiled_time:.3f}s (忽略 {compiled})")
+    print(f"加速比: {legacy_time / compiled_time:.1f}x")
+
+
+def make_summary_store(root, count):
+    """直接写入 count 条合成摘要（约300字）到 .aide_doc/summaries.db"""
+    from context_builder import summary_entry_tokens
+    from summary_store import SummaryStore
+
+    store = SummaryStore(os.path.join(root, ".aide_doc/summaries.db"))
+    words = ["解析", "配置", "请求", "缓存", "数据库", "索引", "线程", "接口", "文件", "日志"]
+    for start in range(0, count, 5000):
+        entries = {}
+        for i in range(start, min(start + 5000, count)):
+            rel_path = f"pkg{i % 100}/sub{i % 7}/module_{i}.py"
+            summary_text = f"模块{i}实现了" + "".join(words[(i + j) % len(words)] for j in range(120)) + f"，定义 handler_{i}。"
+            entry = {"hash": f"{i:032x}", "modified": False, "stat": [len(summary_text), i, i],
+                     "tokens": summary_entry_tokens(rel_path, summary_text)}
+            entries[rel_path] = (entry, summary_text)
+        store.upsert(entries)
+    store.close()
+
+
+def peak_rss_mb():
+    """
+    当前进程的内存峰值（MB）
+
+    Linux 上读取 /proc/self/status 的 VmHWM：子进程的 ru_maxrss 会继承 fork 时父进程的峰值，
+    由大进程启动的子进程测不准；其他系统退回 ru_maxrss（macOS 以字节、Linux 以 KiB 为单位）
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 / 1024 if sys.platform == "darwin" else max_rss / 1024
+
+
+def startup_child(args):
+    """在独立进程中测量启动耗时与内存峰值，结果以JSON输出到标准输出"""
+    import contextlib
+    import io
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.mode == "eager":
+            # 旧的加载方式：读入全部摘要正文并立即建立检索索引
+            from context_builder import BM25Index
+            from summary_store import SummaryStore
+            store = SummaryStore(os.path.join(args.root, ".aide_doc/summaries.db"))
+            index, summary = store.load_all()
+            bm25 = BM25Index()
+            for rel_path, summary_text in summary.items():
+                bm25.add(rel_path, rel_path + " " + summary_text)
+            startup = time.perf_counter() - start
+            startup_rss = peak_rss_mb()
+            first_query = 0.0
+        else:
+            from API_manager import API_manager
+            manager = API_manager(assistant_api_key="fake", project_root=args.root)
+            startup = time.perf_counter() - start
+            startup_rss = peak_rss_mb()
+            # 第一次提问时才构建检索索引并读取被选中的摘要
+            start = time.perf_counter()
+            manager.prepare_analysis("handler_42 的数据库缓存是怎么实现的", [], scan_files=False)
+            first_query = time.perf_counter() - start
+    print(json.dumps({"startup": startup, "first_query": first_query,
+                      "startup_rss_mb": startup_rss, "max_rss_mb": peak_rss_mb()}))
+
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        make_summary_store(root, args.files)
+        print(f"摘要数: {args.files} | 生成合成摘要库耗时 {time.perf_counter() - start:.1f}s")
+        print(f"{'加载方式':<8} {'启动(s)':>8} {'启动内存(MB)':>12} {'首次提问(s)':>12} {'内存峰值(MB)':>12}")
+        for mode in ("eager", "lazy"):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "startup-child", "--mode", mode, "--root", root],
+                capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:<8} {result['startup']:>8.2f} {result['startup_rss_mb']:>12.1f} "
+                  f"{result['first_query']:>12.2f} {result['max_rss_mb']:>12.1f}")
+
+
+# 合成项目中各类文件的扩展名及比例
+SYNTHETIC_TYPES = [(".py", 0.6), (".js", 0.25), (".md", 0.15)]
+
+# .gitignore 中的基础规则，覆盖常见写法（通配、目录、根目录锚定、**、否定）；
+# 其余规则按序号生成，模拟大型项目中冗长的忽略列表
+GITIGNORE_BASE = ["*.log", "build/", "/dist", "node_modules/", "**/__snapshots__", "*.min.js", "!keep.log"]
+GITIGNORE_TEMPLATES = ["tmp_{i}/", "**/cache_{i}/**", "gen_{i}_*.py", "docs/**/*.bak{i}", "/out_{i}", "*.g{i}.js"]
+
+# 合成文件统一的修改时间（2020-09-13），使重新扫描时签名可信、结果可复现
+SYNTHETIC_MTIME_NS = 1_600_000_000 * 10 ** 9
+
+
+def make_source(rng, index, ext, size):
+    """生成约 size 字符、带中文注释的合成源码"""
+    if ext == ".md":
+        header = [f"# 模块 {index} 说明", "", "本文档描述缓存、索引与请求处理的流程。", ""]
+        block = lambda n: [f"## 第{n}节", f"handler_{index}_{n} 负责解析配置并写入数据库，重试 {rng.randint(1, 9)} 次。", ""]
+    elif ext == ".js":
+        header = [f"// 模块 {index}：自动生成的基准测试文件", "const cache = new Map();", ""]
+        block = lambda n: [f"// 处理第{n}类请求并缓存结果", f"function handler_{index}_{n}(value) {{",
+                           f"  return cache.get(value) ?? value * {rng.randint(1, 99)};", "}", ""]
+    else:
+        header = [f"# 模块 {index}：自动生成的基准测试文件", "import os", ""]
+        block = lambda n: [f"def handler_{index}_{n}(value):", f'    """处理第{n}类请求并返回缓存中的结果"""',
+                           f"    return value * {rng.randint(1, 99)}", ""]
+    lines, length, n = header, sum(len(line) + 1 for line in header), 0
+    while length < size:
+        for line in block(n):
+            lines.append(line)
+            length += len(line) + 1
+        n += 1
+    return "\n".join(lines) + "\n"
+
+
+def write_synthetic_file(path, content, encoding):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding=encoding, newline="\n") as f:
+        f.write(content)
+    os.utime(path, ns=(SYNTHETIC_MTIME_NS, SYNTHETIC_MTIME_NS))
+    return os.path.getsize(path)
+
+
+def make_project(root, files=1000, size=3000, depth=3, fanout=4, encodings=("utf-8",), gitignore=20, seed=0):
+    """
+    在 root 下生成可复现的合成项目（相同参数与种子生成相同的内容）
+
+    参数:
+        files (int): 需要生成摘要的文件数，另有约 files/5 个会被 .gitignore 忽略的文件
+        size (int): 文件大小的中位数（字符），实际大小呈对数正态分布
+        depth (int): 目录最大深度，每层有 fanout 个子目录
+        encodings (list): 文件编码，按序号轮流使用（如 utf-8、gbk、utf-16）
+        gitignore (int): 根目录 .gitignore 的规则数；约四分之一的一级目录另有自己的 .gitignore
+
+    返回:
+        dict: {"files", "ignored", "bytes", "gitignore_rules"}
+    """
+    rng = random.Random(seed)
+    extensions = [ext for ext, _ in SYNTHETIC_TYPES]
+    weights = [weight for _, weight in SYNTHETIC_TYPES]
+    rules = (GITIGNORE_BASE + [GITIGNORE_TEMPLATES[i % len(GITIGNORE_TEMPLATES)].format(i=i)
+                               for i in range(max(0, gitignore - len(GITIGNORE_BASE)))])[:max(gitignore, 1)]
+    with open(os.path.join(root, ".gitignore"), "w", encoding="utf-8") as f:
+        f.write("\n".join(rules) + "\n")
+    for d in range(0, fanout, 4):
+        os.makedirs(os.path.join(root, "src", f"pkg{d}"), exist_ok=True)
+        with open(os.path.join(root, "src", f"pkg{d}", ".gitignore"), "w", encoding="utf-8") as f:
+            f.write(f"*.bak\nlocal_{d}/\n!important.bak\n")
+
+    total_bytes = 0
+    for i in range(files):
+        parts = [f"pkg{rng.randrange(fanout)}" for _ in range(rng.randint(0, depth))]
+        ext = rng.choices(extensions, weights)[0]
+        file_size = min(size * 20, max(64, int(rng.lognormvariate(math.log(max(size, 64)), 0.8))))
+        path = os.path.join(root, "src", *parts, f"module_{i}{ext}")
+        total_bytes += write_synthetic_file(path, make_source(rng, i, ext, file_size),
+                                            encodings[i % len(encodings)])
+
+    # 会被忽略的文件：构建产物、日志、依赖目录、快照等，检验忽略规则的匹配与目录剪枝
+    ignored_paths = ["build/out_{i}.py", "dist/bundle_{i}.js", "src/debug_{i}.log", "node_modules/lib{i}/index.js",
+                     "src/__snapshots__/snap_{i}.js", "src/app_{i}.min.js", "src/pkg0/local_0/notes_{i}.md"]
+    ignored = files // 5
+    for i in range(ignored):
+        rel_path = ignored_paths[i % len(ignored_paths)].format(i=i)
+        total_bytes += write_synthetic_file(os.path.join(root, *rel_path.split("/")),
+                                            make_source(rng, i, os.path.splitext(rel_path)[1], size), "utf-8")
+    return {"files": files, "ignored": ignored, "bytes": total_bytes, "gitignore_rules": len(rules)}
+
+
+# 回归比较用的指标：1 表示越大越好，-1 表示越小越好
+SUITE_METRICS = {
+    "walk_seconds": -1,
+    "scan_seconds": -1,
+    "hash_mb_per_second": 1,
+    "index_seconds": -1,
+    "index_files_per_second": 1,
+    "index_prompt_tokens": -1,
+    "save_seconds": -1,
+    "startup_seconds": -1,
+    "rescan_seconds": -1,
+    "analyze_seconds": -1,
+    "analyze_prompt_tokens": -1,
+    "child_startup_seconds": -1,
+    "child_first_query_seconds": -1,
+    "child_max_rss_mb": -1,
+    "max_rss_mb": -1,
+}
+# 耗时差异小于该值（秒）时不计为回退，避免毫秒级的指标因计时抖动误报
+NOISE_FLOOR_SECONDS = 0.02
+
+
+def compare_results(results, baseline, tolerance):
+    """逐项与基线比较，打印对比表，返回变差超过 tolerance（比例）的指标名列表"""
+    regressions = []
+    print(f"{'指标':<28} {'基线':>12} {'本次':>12} {'变化':>8}")
+    for name, direction in SUITE_METRICS.items():
+        old, new = baseline.get(name), results.get(name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = change * -direction > tolerance
+        if name.endswith("_seconds") and abs(new - old) < NOISE_FLOOR_SECONDS:
+            worse = False
+        if worse:
+            regressions.append(name)
+        print(f"{name:<28} {old:>12.3f} {new:>12.3f} {change:>+7.0%}{'  <- 变差' if worse else ''}")
+    return regressions
+
+
+def bench_suite(args):
+    import contextlib
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+    from API_manager import API_manager
+    from utils import iter_project_files
+
+    file_types = [ext for ext, _ in SYNTHETIC_TYPES]
+    encodings = [e.strip() for e in args.encodings.split(",") if e.strip()]
+    config = {key: getattr(args, key) for key in
+              ("files", "size", "depth", "fanout", "gitignore", "seed", "latency", "rate_limit", "error_rate", "workers",
+               "git")}
+    config["encodings"] = encodings
+    results = {}
+    root = tempfile.mkdtemp(prefix="aide_bench_")
+    server, base_url = start_fake_server(args.latency, rate_limit=args.rate_limit, error_rate=args.error_rate,
+                                         seed=args.seed)
+    handler = server.RequestHandlerClass
+    quiet = contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext()
+    try:
+        start = time.perf_counter()
+        project = make_project(root, args.files, args.size, args.depth, args.fanout, encodings, args.gitignore, args.seed)
+        if args.git:
+            # 把合成项目提交到git仓库，扫描改为读取git索引，重新扫描只检查变化的文件
+            for git_args in (["init", "-q"], ["add", "-A"],
+                             ["-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-q", "-m", "init"]):
+                subprocess.run(["git", "-C", root, *git_args], check=True, capture_output=True)
+        print(f"合成项目: {project['files']} 个文件（另有 {project['ignored']} 个被忽略）| "
+              f"{project['bytes'] / 1024 / 1024:.1f} MB | {project['gitignore_rules']} 条忽略规则 | "
+              f"编码 {','.join(encodings)} | 生成耗时 {time.perf_counter() - start:.1f}s")
+
+        with quiet:
+            # 遍历与忽略规则匹配（不读取内容）
+            start = time.perf_counter()
+            walked = sum(1 for _ in iter_project_files(root, file_types))
+            results["walk_seconds"] = time.perf_counter() - start
+            results["walked_files"] = walked
+
+            # 冷扫描：遍历、读取并解码全部文件（与 refresh_files 相同，记录的 load() 在工作线程中执行）
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.workers) as pool:
+                loaded = pool.map(lambda record: (record.rel_path, record.load()[0]), iter_project_files(root, file_types))
+                contents = {rel_path: content for rel_path, content in loaded if content is not None}
+            results["scan_seconds"] = time.perf_counter() - start
+
+            # 内容哈希
+            manager = API_manager(assistant_api_key="fake", base_url=base_url, project_root=root,
+                                  file_types=file_types, max_workers=args.workers)
+            start = time.perf_counter()
+            for content in contents.values():
+                manager.calculate_file_hash(content)
+            hash_seconds = time.perf_counter() - start
+            content_mb = sum(len(content.encode("utf-8")) for content in contents.values()) / 1024 / 1024
+            results["hash_mb_per_second"] = content_mb / hash_seconds if hash_seconds else 0.0
+            del contents
+
+            # 全量生成摘要（经由假服务器，包含限流与注入错误后的重试）
+            stats = {}
+            start = time.perf_counter()
+            manager.refresh_files(stats=stats)
+            results["index_seconds"] = time.perf_counter() - start
+            results["index_files_per_second"] = stats.get("summarized", 0) / results["index_seconds"]
+            results.update(index_summarized=stats.get("summarized", 0), index_failed=stats.get("failed", 0),
+                           index_requests=handler.request_count[0], index_rate_limited=handler.rate_limited[0],
+                           index_errors=handler.errors[0], index_prompt_tokens=handler.prompt_tokens[0])
+
+            start = time.perf_counter()
+            for rel_path in manager.summary_index:
+                manager.mark_dirty(rel_path)
+            manager.save_summary()
+            results["save_seconds"] = time.perf_counter() - start
+            manager.close()
+
+            # 重新打开项目（加载摘要索引）并做一次无变化的重新扫描
+            start = time.perf_counter()
+            manager = API_manager(assistant_api_key="fake", base_url=base_url, project_root=root,
+                                  file_types=file_types, max_workers=args.workers)
+            results["startup_seconds"] = time.perf_counter() - start
+            start = time.perf_counter()
+            stats = {}
+            manager.refresh_files(stats=stats)
+            results["rescan_seconds"] = time.perf_counter() - start
+            results["rescan_changed"] = stats.get("changed", 0)
+            results["rescan_mode"] = stats.get("scan_mode")
+
+            # 提问：组装上下文、挑选文件并注入代码片段
+            stats = {}
+            start = time.perf_counter()
+            manager.analyze("handler_42 的缓存是怎么实现的？", [], scan_files=False, load_files=True, stats=stats)
+            results["analyze_seconds"] = time.perf_counter() - start
+            results["analyze_prompt_tokens"] = stats.get("usage", {}).get("prompt_tokens", 0)
+            manager.close()
+
+        # 在新进程中测量启动与首次提问的耗时和内存峰值
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "startup-child", "--mode", "lazy", "--root", root],
+            capture_output=True, text=True, check=True
+        ).stdout
+        child = json.loads(output.strip().splitlines()[-1])
+        results.update(child_startup_seconds=child["startup"], child_first_query_seconds=child["first_query"],
+                       child_max_rss_mb=child["max_rss_mb"])
+        results["max_rss_mb"] = peak_rss_mb()
+    finally:
+        server.shutdown()
+        if not args.keep:
+            import shutil
+            shutil.rmtree(root, ignore_errors=True)
+        else:
+            print(f"合成项目保留在: {root}")
+
+    print(f"{'指标':<28} {'结果':>12}")
+    for name, value in results.items():
+        print(f"{name:<28} {value:>12.3f}" if isinstance(value, float) else f"{name:<28} {value:>12}")
+    report = {"config": config, "project": project,
+              "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                              "cpus": os.cpu_count()},
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("警告：基线的配置与本次不同，比较结果仅供参考")
+        regressions = compare_results(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print(f"性能回退（超过 {args.tolerance:.0%}）: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="项目小精灵性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    summary = sub.add_parser("summary", help="摘要生成吞吐量随并发数的变化")
+    summary.add_argument("--files", type=int, default=200)
+    summary.add_argument("--latency", type=float, default=0.2)
+    summary.add_argument("--workers", default="1,4,8,16")
+    summary.set_defaults(func=bench_summary)
+
+    ignore = sub.add_parser("ignore", help="忽略规则匹配：fnmatch 循环 vs 编译正则")
+    ignore.add_argument("--packages", type=int, default=300)
+    ignore.add_argument("--depth", type=int, default=4)
+    ignore.add_argument("--patterns", type=int, default=40)
+    ignore.set_defaults(func=bench_ignore)
+
+    startup = sub.add_parser("startup", help="大项目启动：全部读入 vs 按需读取摘要")
+    startup.add_argument("--files", type=int, default=50000)
+    startup.set_defaults(func=bench_startup)
+
+    batch = sub.add_parser("batch", help="小文件合并请求：逐个请求 vs 批量请求")
+    batch.add_argument("--small", type=int, default=200)
+    batch.add_argument("--large", type=int, default=20)
+    batch.add_argument("--latency", type=float, default=0.5)
+    batch.add_argument("--workers", type=int, default=8)
+    batch.set_defaults(func=bench_batch)
+
+    gradio = sub.add_parser("gradio", help="多个用户同时提问：Gradio 队列逐个处理 vs 并发处理")
+    gradio.add_argument("--users", type=int, default=16)
+    gradio.add_argument("--files", type=int, default=50)
+    gradio.add_argument("--latency", type=float, default=0.5)
+    gradio.add_argument("--chunk-delay", type=float, default=0.2)
+    gradio.set_defaults(func=bench_gradio)
+
+    suite = sub.add_parser("suite", help="在合成项目上测量各热点路径，可与基线结果比较")
+    suite.add_argument("--files", type=int, default=2000)
+    suite.add_argument("--size", type=int, default=3000, help="文件大小的中位数（字符）")
+    suite.add_argument("--depth", type=int, default=4, help="目录最大深度")
+    suite.add_argument("--fanout", type=int, default=4, help="每层子目录数")
+    suite.add_argument("--encodings", default="utf-8,gbk,utf-16", help="文件编码，逗号分隔，按序号轮流使用")
+    suite.add_argument("--gitignore", type=int, default=40, help="根目录 .gitignore 的规则数")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--latency", type=float, default=0.05, help="假服务器每个请求的延迟（秒）")
+    suite.add_argument("--rate-limit", type=int, default=0, help="假服务器每秒接受的请求数，超出返回429（0为不限）")
+    suite.add_argument("--error-rate", type=float, default=0.0, help="假服务器随机返回500的请求比例")
+    suite.add_argument("--workers", type=int, default=8)
+    suite.add_argument("--git", action="store_true", help="把合成项目提交到git仓库（测量基于git的增量扫描）")
+    suite.add_argument("--output", help="把配置与结果写入该JSON文件")
+    suite.add_argument("--baseline", help="与该JSON文件（之前的 --output）比较")
+    suite.add_argument("--tolerance", type=float, default=0.2, help="允许变差的比例，超过时退出码为1")
+    suite.add_argument("--keep", action="store_true", help="保留生成的合成项目")
+    suite.add_argument("--verbose", action="store_true", help="显示被测代码的输出")
+    suite.set_defaults(func=bench_suite)
+
+    # 供 startup 在子进程中调用，单独测量每种加载方式的内存
+    child = sub.add_parser("startup-child")
+    child.add_argument("--mode", choices=["eager", "lazy"], required=True)
+    child.add_argument("--root", required=True)
+    child.set_defaults(func=startup_child)
+
+    args = parser.parse_args()
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
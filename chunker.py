@@ -0,0 +1,233 @@
+import ast
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from context_builder import BM25Index
+from utils import count_tokens
+
+# 非Python源码中顶格书写的定义行（函数、类、结构体等）视为代码块的起点
+_BOUNDARY_RE = re.compile(
+    r"^(?:export\s+|public\s+|private\s+|protected\s+|static\s+|async\s+|abstract\s+|final\s+|default\s+)*"
+    r"(?:def|class|function|interface|struct|enum|func|fn|impl|trait|module|namespace)\b"
+    r"|^[A-Za-z_][\w<>\[\],*&:\s]*\([^;]*\)\s*(?:const\s*)?\{?\s*$"
+)
+_MARKDOWN_HEADING_RE = re.compile(r"^#{1,6}\s")
+_NAME_RE = re.compile(r"(?:def|class|function|interface|struct|enum|func|fn|impl|trait|module|namespace)\s+([\w$]+)"
+                      r"|([A-Za-z_]\w*)\s*\(")
+
+
+def _chunk(name, kind, start, end):
+    return {"name": name, "kind": kind, "start": start, "end": end}
+
+
+def _split_long(name, kind, start, end, max_lines):
+    """超过 max_lines 的块均匀切分为若干段"""
+    length = end - start + 1
+    if length <= max_lines:
+        return [_chunk(name, kind, start, end)]
+    parts = -(-length // max_lines)
+    size = -(-length // parts)
+    return [_chunk(f"{name}#{i + 1}", kind, s, min(s + size - 1, end))
+            for i, s in enumerate(range(start, end + 1, size))]
+
+
+def _node_start(node):
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [d.lineno for d in decorators])
+
+
+def _python_chunks(content, max_lines):
+    tree = ast.parse(content)
+    lines = content.splitlines()
+    definitions = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    chunks = []
+    cursor = 1
+
+    def add_gap(start, end, name):
+        # 定义之间只有空行时不单独成块
+        if end >= start and any(line.strip() for line in lines[start - 1:end]):
+            chunks.extend(_split_long(name, "section", start, end, max_lines))
+
+    for node in tree.body:
+        if not isinstance(node, definitions):
+            continue
+        start, end = _node_start(node), node.end_lineno
+        add_gap(cursor, start - 1, "module")
+        if isinstance(node, ast.ClassDef) and end - start + 1 > max_lines:
+            # 过大的类拆分为类头和各个方法
+            inner = cursor = start
+            for child in node.body:
+                if not isinstance(child, definitions):
+                    continue
+                child_start = _node_start(child)
+                add_gap(inner, child_start - 1, node.name)
+                chunks.extend(_split_long(f"{node.name}.{child.name}", "method", child_start, child.end_lineno, max_lines))
+                inner = child.end_lineno + 1
+            add_gap(inner, end, node.name)
+        else:
+            kind = "class" if isinstance(node, ast.ClassDef) else "function"
+            chunks.extend(_split_long(node.name, kind, start, end, max_lines))
+        cursor = end + 1
+    add_gap(cursor, len(lines), "module")
+    return chunks
+
+
+def _heuristic_chunks(rel_path, lines, max_lines):
+    """按定义行（Markdown按标题）切分，得到近似的函数/类/章节块"""
+    is_markdown = rel_path.lower().endswith((".md", ".markdown"))
+    boundaries = []
+    for number, line in enumerate(lines, 1):
+        if is_markdown:
+            if _MARKDOWN_HEADING_RE.match(line):
+                boundaries.append((number, line.lstrip("#").strip()))
+        elif _BOUNDARY_RE.match(line):
+            match = _NAME_RE.search(line)
+            boundaries.append((number, (match.group(1) or match.group(2)) if match else line.strip()[:40]))
+
+    chunks = []
+    if not boundaries or boundaries[0][0] > 1:
+        first = boundaries[0][0] - 1 if boundaries else len(lines)
+        chunks.extend(_split_long("header", "section", 1, first, max_lines))
+    for i, (start, name) in enumerate(boundaries):
+        end = boundaries[i + 1][0] - 1 if i + 1 < len(boundaries) else len(lines)
+        chunks.extend(_split_long(name, "section" if is_markdown else "definition", start, end, max_lines))
+    return [c for c in chunks if c["end"] >= c["start"]]
+
+
+def chunk_source(rel_path, content, max_lines=120):
+    """
+    将源文件切分为函数/类/章节等代码块
+
+    返回:
+        list: [{"name", "kind", "start", "end"}]，行号从1开始且包含 end
+    """
+    lines = content.splitlines()
+    if not lines:
+        return []
+    if rel_path.endswith(".py"):
+        try:
+            return _python_chunks(content, max_lines)
+        except (SyntaxError, ValueError):
+            pass
+    return _heuristic_chunks(rel_path, lines, max_lines)
+
+
+class ChunkCache:
+    """
+    按文件内容哈希缓存切分结果（.aide_doc/chunks/），只保存行号范围，内容相同的文件不再重复解析
+
+    内存中最多保留 max_entries 份切分结果（LRU）；磁盘上不再被摘要索引引用的结果由 collect_garbage 删除
+    """
+
+    def __init__(self, cache_dir=None, max_lines=120, max_entries=1024):
+        self.cache_dir = cache_dir
+        self.max_lines = max_lines
+        self.max_entries = max_entries
+        self.memory = OrderedDict()  # {内容哈希: 切分结果}，最近使用的在末尾
+        self.lock = threading.Lock()
+
+    def get(self, rel_path, content, content_hash):
+        with self.lock:
+            chunks = self.memory.get(content_hash)
+            if chunks is not None:
+                self.memory.move_to_end(content_hash)
+                return chunks
+        cache_file = self._cache_file(content_hash)
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    chunks = json.load(f)
+            except Exception as e:
+                print(f"无法读取代码块缓存 {cache_file}: {str(e)}")
+        if chunks is None:
+            chunks = chunk_source(rel_path, content, self.max_lines)
+            if cache_file:
+                try:
+                    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                    with open(cache_file, 'w', encoding='utf-8') as f:
+                        json.dump(chunks, f)
+                except Exception as e:
+                    print(f"保存代码块缓存失败 {cache_file}: {str(e)}")
+        with self.lock:
+            self.memory[content_hash] = chunks
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+        return chunks
+
+    def _cache_file(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash[:2], content_hash + ".json") if self.cache_dir else None
+
+    def collect_garbage(self, live_hashes):
+        """删除不在 live_hashes（摘要索引中的内容哈希）里的切分结果，返回删除的文件数"""
+        live_hashes = set(live_hashes)
+        with self.lock:
+            for content_hash in [h for h in self.memory if h not in live_hashes]:
+                del self.memory[content_hash]
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return 0
+        removed = 0
+        for dirpath, _, files in os.walk(self.cache_dir):
+            for name in files:
+                content_hash, ext = os.path.splitext(name)
+                if ext == ".json" and content_hash not in live_hashes:
+                    try:
+                        os.remove(os.path.join(dirpath, name))
+                        removed += 1
+                    except OSError as e:
+                        print(f"删除代码块缓存失败 {name}: {str(e)}")
+        return removed
+
+
+def select_snippets(files, query, token_budget, chunk_cache, hash_function, whole_file_tokens=1500, hashes=None):
+    """
+    从若干文件中挑选与问题最相关的代码块，总量不超过 token_budget
+
+    参数:
+        files (dict): {相对路径: 文件内容}
+        hash_function: 计算内容哈希的函数，用作代码块缓存的键（hashes 中没有该文件时使用）
+        hashes (dict): {相对路径: 原始字节的内容指纹}，与摘要索引中的哈希一致，代码块缓存据此回收
+        whole_file_tokens (int): 不超过该token数的小文件整体注入，不再切分
+
+    返回:
+        tuple: (注入用的文本, 统计信息字典)
+    """
+    index = BM25Index()
+    pieces = {}  # {(相对路径, 序号): (标题, 文本, token数)}
+    full_tokens = 0
+    for rel_path, content in files.items():
+        tokens = count_tokens(content)
+        full_tokens += tokens
+        if tokens <= whole_file_tokens:
+            pieces[(rel_path, 0)] = (f"{rel_path}:", content, tokens)
+            index.add((rel_path, 0), rel_path + " " + content)
+            continue
+        lines = content.splitlines()
+        content_hash = (hashes or {}).get(rel_path) or hash_function(content)
+        for number, chunk in enumerate(chunk_cache.get(rel_path, content, content_hash)):
+            text = "\n".join(lines[chunk["start"] - 1:chunk["end"]])
+            title = f"{rel_path} [{chunk['kind']} {chunk['name']}, 第{chunk['start']}-{chunk['end']}行]:"
+            pieces[(rel_path, number)] = (title, text, count_tokens(text))
+            index.add((rel_path, number), f"{chunk['name']} {chunk['name']} {text}")
+
+    # 只按相关度装入命中的块；一个都没有命中时按文件内顺序装入
+    scores = index.score(query)
+    ranked = sorted(scores, key=lambda key: (-scores[key], key)) if scores else sorted(pieces)
+    selected, used = [], 0
+    for key in ranked:
+        tokens = pieces[key][2]
+        if used + tokens > token_budget:
+            continue
+        selected.append(key)
+        used += tokens
+
+    text = "".join(f"{pieces[key][0]}\n{pieces[key][1]}\n\n" for key in sorted(selected))
+    stats = {
+        "snippets": len(selected),
+        "total_snippets": len(pieces),
+        "snippet_tokens": used,
+        "full_file_tokens": full_tokens,
+    }
+    return text, stats
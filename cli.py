@@ -0,0 +1,148 @@
+"""
+命令行批量模式：不启动界面，直接扫描项目并生成或更新摘要（.aide_doc），可在定时任务中预先生成摘要
+
+用法:
+    python cli.py index <项目根目录> [--changed-since <git提交>] [--workers 8]
+    python -m cli index <项目根目录> --json
+
+密钥从 --api-key 或环境变量 DEEPSEEK_API_KEY 读取（多个密钥用逗号分隔）。
+退出码: 0 全部成功；1 有文件生成摘要失败（已记入失败队列，下次运行时重试）；2 参数或环境错误。
+使用 --json 时标准输出只有一行JSON，扫描过程的日志写到标准错误
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+from API_manager import API_manager
+from client_pool import parse_api_keys
+from metrics import metrics, set_trace_file
+from utils import git_changed_files
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+def index(args):
+    # --json 时扫描过程中的日志（包括工作线程的输出）改写到标准错误，标准输出只留给统计信息
+    with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+        stats = build_index(args)
+    if stats is None:
+        return EXIT_USAGE
+    if args.json:
+        print(json.dumps(stats, ensure_ascii=False))
+    else:
+        print(f"检查 {stats['scanned']} 个文件 | 变更 {stats['changed']} | 新摘要 {stats['summarized']} | "
+              f"沿用相同内容的摘要 {stats['reused']} | 内容未变 {stats['unchanged']} | 已删除 {stats['removed']} | "
+              f"失败 {stats['failed']} | 目录摘要 {stats['directories']} | 扫描方式 {stats['scan_mode']} | "
+              f"用时 {stats['elapsed']:.2f}s | {stats['files_per_second']} 个文件/秒")
+        if stats["pending_failures"]:
+            print(f"失败队列中共有 {stats['pending_failures']} 个文件，下次运行时重试")
+    return EXIT_FAILED if stats["failed"] or stats["pending_failures"] else EXIT_OK
+
+
+def build_index(args):
+    """扫描项目并生成或更新摘要，返回统计信息；参数或环境错误时输出原因并返回None"""
+    api_keys = parse_api_keys(args.api_key or os.environ.get("DEEPSEEK_API_KEY"))
+    summarizer_keys = parse_api_keys(args.summarizer_key or os.environ.get("DEEPSEEK_SUMMARIZER_API_KEY")) or api_keys
+    if not api_keys:
+        print("错误：必须通过 --api-key 或环境变量 DEEPSEEK_API_KEY 提供API密钥", file=sys.stderr)
+        return None
+    if not os.path.isdir(args.root):
+        print(f"错误：项目目录不存在: {args.root}", file=sys.stderr)
+        return None
+    file_types = [ft.strip() for ft in args.file_types.split(",") if ft.strip()] if args.file_types else None
+
+    if args.trace:
+        set_trace_file(args.trace)
+    rel_paths = None
+    if args.changed_since:
+        try:
+            rel_paths = git_changed_files(args.root, args.changed_since)
+        except ValueError as e:
+            print(f"错误：{str(e)}", file=sys.stderr)
+            return None
+
+    manager = API_manager(
+        assistant_api_key=api_keys,
+        summarizer_api_key=summarizer_keys,
+        base_url=args.base_url,
+        project_root=args.root,
+        file_types=file_types,
+        max_workers=args.workers,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        directory_summaries=not args.no_directories,
+        git_scan=not args.no_git,
+    )
+    stats = {}
+    start = time.perf_counter()
+    try:
+        if rel_paths is not None:
+            # 失败队列中的文件不一定在变更列表里，一并重试
+            retry = manager.summary_store.due_failures(now=float("inf"))
+            rel_paths = sorted(set(rel_paths) | set(retry))
+            print(f"自 {args.changed_since} 以来有 {len(rel_paths) - len(retry)} 个文件变化，"
+                  f"另有 {len(retry)} 个失败待重试的文件")
+        manager.refresh_files(rel_paths, stats=stats)
+        stats["pending_failures"] = manager.summary_store.failure_count()
+    finally:
+        manager.close()
+    elapsed = time.perf_counter() - start
+    if args.metrics_file:
+        # Prometheus textfile 格式，可由 node_exporter 的 textfile collector 采集
+        tmp_file = args.metrics_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(metrics.render())
+        os.replace(tmp_file, args.metrics_file)
+
+    stats = {
+        "scanned": stats.get("scanned", 0),
+        "changed": stats.get("changed", 0),
+        "summarized": stats.get("summarized", 0),
+        "reused": stats.get("reused", 0),
+        "unchanged": stats.get("unchanged", 0),
+        "removed": stats.get("removed", 0),
+        "failed": stats.get("failed", 0),
+        "directories": stats.get("directories", 0),
+        "pending_failures": stats.get("pending_failures", 0),
+        "scan_mode": stats.get("scan_mode", "walk"),
+        "elapsed": round(elapsed, 3),
+        "files_per_second": round(stats.get("changed", 0) / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="项目小精灵命令行模式")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = sub.add_parser("index", help="扫描项目并生成或更新文件摘要")
+    index_parser.add_argument("root", help="项目根目录")
+    index_parser.add_argument("--changed-since", metavar="REV",
+                              help="只检查自该git提交以来变化的文件（含未提交的修改和未跟踪的文件）")
+    index_parser.add_argument("--api-key", help="API密钥，多个用逗号分隔（默认读取 DEEPSEEK_API_KEY）")
+    index_parser.add_argument("--summarizer-key",
+                              help="生成摘要用的API密钥（默认读取 DEEPSEEK_SUMMARIZER_API_KEY，否则同 --api-key）")
+    index_parser.add_argument("--base-url", default="https://api.deepseek.com")
+    index_parser.add_argument("--file-types", help="要处理的文件扩展名，逗号分隔（默认使用内置列表）")
+    index_parser.add_argument("--workers", type=int, default=8, help="并发请求数")
+    index_parser.add_argument("--rpm", type=int, help="每个密钥每分钟的请求数上限")
+    index_parser.add_argument("--tpm", type=int, help="每个密钥每分钟的token数上限")
+    index_parser.add_argument("--no-directories", action="store_true", help="不生成目录摘要")
+    index_parser.add_argument("--no-git", action="store_true",
+                              help="不使用git索引，总是遍历目录（默认在git仓库中只检查上次扫描以来变化的文件）")
+    index_parser.add_argument("--json", action="store_true", help="以一行JSON输出统计信息")
+    index_parser.add_argument("--trace", metavar="FILE", help="把各阶段耗时以JSONL追加写入该文件")
+    index_parser.add_argument("--metrics-file", metavar="FILE", help="结束时把指标以Prometheus文本格式写入该文件")
+    index_parser.set_defaults(func=index)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import math
+import re
+import threading
+import time
+
+from openai import OpenAI, APIStatusError
+
+from utils import retry_after_seconds
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_api_keys(keys):
+    """把以逗号、分号、空白或换行分隔的多个密钥（或密钥列表）拆分为去重后的列表"""
+    if keys is None:
+        return []
+    if isinstance(keys, str):
+        keys = re.split(r"[,;\s]+", keys)
+    result = []
+    for key in keys:
+        key = key.strip()
+        if key and key not in result:
+            result.append(key)
+    return result
+
+
+def parse_duration(value):
+    """解析 x-ratelimit-reset-* 响应头中的时长（如 "1s"、"6m0s"、"20ms"），返回秒数或None"""
+    if not value:
+        return None
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _header_int(headers, name):
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class _KeyState:
+    def __init__(self, api_key, client):
+        self.api_key = api_key
+        self.client = client
+        self.remaining_requests = None  # 响应头中的剩余额度，未知时为None
+        self.remaining_tokens = None
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.last_used = 0.0
+
+
+class ClientPool:
+    """
+    同一角色（对话或摘要）的多个API密钥组成的客户端池
+
+    每次请求选择剩余额度（响应头 x-ratelimit-remaining-*）最多、在途请求最少的密钥，
+    额度相同时轮流使用；被限流(429)或鉴权失败的密钥冷却一段时间，本次请求立即换用其他密钥。
+    传入共享的 httpx.Client 时，所有密钥复用同一组保持连接(keep-alive)。
+    """
+
+    def __init__(self, api_keys, base_url, timeout=120.0, http_client=None, cooldown=30.0):
+        api_keys = parse_api_keys(api_keys)
+        if not api_keys:
+            raise ValueError("至少需要一个API密钥")
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        # 重试由调用方统一处理，关闭SDK自带的重试
+        self.keys = [_KeyState(key, OpenAI(api_key=key, base_url=base_url, timeout=timeout, max_retries=0,
+                                           http_client=http_client))
+                     for key in api_keys]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _available(self, exclude=()):
+        now = time.monotonic()
+        return [k for k in self.keys if k.cooldown_until <= now and k not in exclude]
+
+    def _pick(self, exclude=()):
+        with self.lock:
+            now = time.monotonic()
+            available = self._available(exclude)
+            if not available:
+                # 全部在冷却中时使用最早结束冷却的密钥，由调用方的重试逻辑处理可能的429
+                state = min(self.keys, key=lambda k: k.cooldown_until)
+            else:
+                def rank(k):
+                    requests = math.inf if k.remaining_requests is None else k.remaining_requests - k.in_flight
+                    tokens = math.inf if k.remaining_tokens is None else k.remaining_tokens
+                    return -requests, k.in_flight, -tokens, k.last_used
+                state = min(available, key=rank)
+            state.in_flight += 1
+            state.last_used = now
+            return state
+
+    def _record(self, state, headers):
+        with self.lock:
+            state.in_flight -= 1
+            state.remaining_requests = _header_int(headers, "x-ratelimit-remaining-requests")
+            state.remaining_tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+            # 额度用尽时冷却到额度重置
+            reset = None
+            if state.remaining_requests == 0:
+                reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if state.remaining_tokens == 0:
+                reset = max(reset or 0, parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0)
+            if reset:
+                state.cooldown_until = time.monotonic() + reset
+
+    def _penalize(self, state, error):
+        with self.lock:
+            state.in_flight -= 1
+            status = getattr(error, "status_code", None)
+            if status == 429:
+                wait = retry_after_seconds(error)
+                state.cooldown_until = time.monotonic() + (wait if wait is not None else self.cooldown)
+            elif status in (401, 403):
+                # 密钥无效或无权限，长时间停用
+                state.cooldown_until = time.monotonic() + 20 * self.cooldown
+                print(f"API密钥 {self.mask(state.api_key)} 鉴权失败，暂停使用")
+            elif status is not None and status >= 500:
+                state.cooldown_until = time.monotonic() + min(self.cooldown, 5.0)
+
+    @staticmethod
+    def mask(api_key):
+        return api_key[:6] + "…" + api_key[-4:] if len(api_key) > 12 else "…"
+
+    def create(self, **kwargs):
+        """
+        用选中的密钥调用 chat.completions.create，参数与返回值相同（stream=True 时返回流）
+        """
+        tried = []
+        while True:
+            state = self._pick(tried)
+            try:
+                raw = state.client.chat.completions.with_raw_response.create(**kwargs)
+            except APIStatusError as e:
+                self._penalize(state, e)
+                tried.append(state)
+                # 只是这个密钥被限流或无效时，换用其他未冷却的密钥；都不可用时交给调用方重试
+                with self.lock:
+                    failover = e.status_code in (401, 403, 429) and self._available(tried)
+                if failover:
+                    continue
+                raise
+            except Exception:
+                with self.lock:
+                    state.in_flight -= 1
+                raise
+            self._record(state, raw.headers)
+            return raw.parse()
@@ -0,0 +1,273 @@
+import hashlib
+import math
+import os
+import re
+from collections import Counter
+
+from utils import count_tokens
+
+_WORD_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[\u4e00-\u9fff]+")
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def tokenize(text):
+    """
+    将文本切分为检索词：英文标识符转小写并按驼峰/下划线拆分，中文按相邻二字切分
+    """
+    terms = []
+    for word in _WORD_RE.findall(text):
+        if '\u4e00' <= word[0] <= '\u9fff':
+            if len(word) == 1:
+                terms.append(word)
+            else:
+                terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+            continue
+        lower = word.lower()
+        terms.append(lower)
+        parts = [p.lower() for piece in word.split('_') for p in _CAMEL_RE.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(p for p in parts if len(p) > 1)
+    return terms
+
+
+def format_summary_entry(rel_path, summary_text):
+    """单个文件摘要在提示词中的格式"""
+    return f"[{rel_path}]:\n{summary_text}\n-----\n"
+
+
+class BM25Index:
+    """
+    可增量更新的 BM25 倒排索引，文档为 {键: 文本}
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # {键: 文档包含的检索词}，删除文档时使用
+        self.lengths = {}
+        self.postings = {}  # {检索词: {键: 词频}}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, key):
+        return key in self.docs
+
+    def add(self, key, text):
+        self.add_terms(key, Counter(tokenize(text)))
+
+    def add_terms(self, key, terms):
+        self.remove(key)
+        # 词频已保存在倒排表中，这里只保留检索词元组以节省内存
+        self.docs[key] = tuple(terms)
+        self.lengths[key] = sum(terms.values())
+        self.total_length += self.lengths[key]
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[key] = tf
+
+    def remove(self, key):
+        terms = self.docs.pop(key, None)
+        if terms is None:
+            return
+        self.total_length -= self.lengths.pop(key)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(key, None)
+                if not posting:
+                    del self.postings[term]
+
+    def score(self, query):
+        """返回 {键: 得分}，只包含得分大于0的文档"""
+        n = len(self.docs)
+        if n == 0:
+            return {}
+        avg_length = self.total_length / n or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            df = len(posting)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for key, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[key] / avg_length)
+                scores[key] = scores.get(key, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query, limit=5):
+        """返回得分最高的若干个键"""
+        scores = self.score(query)
+        return sorted(scores, key=lambda key: (-scores[key], key))[:limit]
+
+
+def format_directory_entry(rel_dir, summary_text):
+    """目录摘要在提示词中的格式，项目根目录为 ./"""
+    name = rel_dir.replace("\\", "/") or "."
+    return f"[{name}/ 目录]:\n{summary_text}\n-----\n"
+
+
+def summary_entry_tokens(rel_path, summary_text):
+    """单个摘要条目在提示词中占用的token数（保存在摘要索引的 "tokens" 字段中）"""
+    return count_tokens(format_summary_entry(rel_path, summary_text))
+
+
+def directory_outline(rel_paths, token_budget):
+    """按目录统计文件数的项目结构概览，按路径排序，超出 token_budget 的部分省略"""
+    counts = Counter(os.path.dirname(rel_path.replace("\\", "/")) or "." for rel_path in rel_paths)
+    lines, used = [], 0
+    for directory in sorted(counts):
+        line = f"{directory}/ ({counts[directory]} 个文件)\n"
+        tokens = count_tokens(line)
+        if used + tokens > token_budget:
+            lines.append(f"……（共 {len(counts)} 个目录）\n")
+            break
+        lines.append(line)
+        used += tokens
+    return "".join(lines)
+
+
+def directory_block(directories, token_budget):
+    """
+    从项目根目录开始逐层（广度优先）装入目录摘要，直到超出 token_budget
+
+    参数:
+        directories (dict): {目录相对路径: {"summary", "tokens"}}
+
+    返回:
+        tuple: (选中的目录列表, token数)
+    """
+    children = {}
+    for rel_dir in directories:
+        if rel_dir:
+            children.setdefault(os.path.dirname(rel_dir), []).append(rel_dir)
+    level = [""] if "" in directories else children.get("", [])
+    selected, used = [], 0
+    while level:
+        next_level = []
+        for rel_dir in sorted(level):
+            tokens = directories[rel_dir]["tokens"]
+            if used + tokens > token_budget:
+                return selected, used
+            selected.append(rel_dir)
+            used += tokens
+            next_level.extend(children.get(rel_dir, []))
+        level = next_level
+    return selected, used
+
+
+class ContextBuilder:
+    """
+    按与问题的相关度挑选文件摘要，在token预算内组装项目概览
+
+    项目概览分为两部分：
+    - 稳定部分：与问题无关，只在摘要变化后重建，并带有按内容计算的版本号，放在系统提示词的开头，
+      使多轮对话和不同问题的请求共享同一前缀，命中服务端的上下文缓存；
+      全部摘要放得下预算时就是按路径排序的全部摘要，否则是从根目录开始逐层展开的目录摘要
+      （占预算的1/3；没有目录摘要时为按目录统计的项目结构）；
+    - 相关部分：全部摘要放不下时，在剩余预算内按相关度挑选的文件摘要和更深层的目录摘要，随问题一起发送。
+      目录的相关度是其下所有文件得分之和：问题宽泛时得分分散，目录摘要排在前面；
+      问题具体时得分集中在少数文件上，会选中这些文件及其所在的各级目录。
+    每个条目的token数取自摘要索引，只读取最终选中的摘要正文。
+    """
+
+    def __init__(self, index):
+        # 检索索引（如 FileIndex），只需提供 score 方法
+        self.index = index
+        self.cached = None  # ((generation, token_budget), 稳定部分, 版本号, 各条目token数, 稳定部分中的目录)
+
+    @staticmethod
+    def entry_tokens(summary_index, summary):
+        tokens = {}
+        for rel_path, entry in list(summary_index.items()):
+            if rel_path not in summary:
+                continue
+            if "tokens" not in entry:
+                entry["tokens"] = summary_entry_tokens(rel_path, summary[rel_path])
+            tokens[rel_path] = entry["tokens"]
+        return tokens
+
+    def project_block(self, summary_index, summary, token_budget, generation=None, directories=None):
+        """
+        返回与问题无关的稳定部分
+
+        参数:
+            generation: 摘要（含目录摘要）的修改代数，未变化时直接复用上次的结果；为None时总是重建
+            directories (dict): {目录相对路径: {"summary", "tokens"}}，没有时传入None
+
+        返回:
+            tuple: (稳定部分文本, 版本号, {相对路径: token数}, 稳定部分中的目录列表)
+        """
+        key = (generation, token_budget)
+        if generation is not None and self.cached is not None and self.cached[0] == key:
+            return self.cached[1:]
+        tokens = self.entry_tokens(summary_index, summary)
+        block_dirs = []
+        if token_budget is None or sum(tokens.values()) <= token_budget:
+            block = "".join(format_summary_entry(rel_path, summary[rel_path]) for rel_path in sorted(tokens))
+        elif directories:
+            block_dirs, _ = directory_block(directories, token_budget // 3)
+            block = "".join(format_directory_entry(rel_dir, directories[rel_dir]["summary"]) for rel_dir in block_dirs)
+        else:
+            block = "项目结构（目录/文件数）：\n" + directory_outline(tokens, token_budget // 4)
+        version = hashlib.sha256(block.encode('utf-8')).hexdigest()[:16]
+        self.cached = (key, block, version, tokens, block_dirs)
+        return block, version, tokens, block_dirs
+
+    def build(self, summary_index, summary, question, token_budget, generation=None, directories=None):
+        """
+        参数:
+            summary_index (dict): {相对路径: 摘要索引条目}，条目中的 "tokens" 为格式化后的token数
+            summary (Mapping): {相对路径: 摘要}，可以是按需读取的 LazySummaries
+            generation, directories: 见 project_block
+
+        返回:
+            tuple: (稳定部分文本, 相关部分文本, 统计信息字典)
+        """
+        block, version, tokens, block_dirs = self.project_block(summary_index, summary, token_budget,
+                                                                generation, directories)
+        total_tokens = sum(tokens.values())
+        selected_dirs = []
+        if token_budget is None or total_tokens <= token_budget:
+            selected, used = list(tokens), total_tokens
+            relevant = ""
+        else:
+            scores = self.index.score(question)
+            # 候选条目: (得分, 是否为目录, 路径, token数)
+            candidates = [(scores.get(rel_path, 0.0), False, rel_path, tokens[rel_path]) for rel_path in tokens]
+            if directories:
+                # 目录得分为其下所有文件得分之和；稳定部分中已有的目录不再重复
+                dir_scores = {}
+                for rel_path, score in scores.items():
+                    rel_dir = os.path.dirname(rel_path)
+                    while True:
+                        dir_scores[rel_dir] = dir_scores.get(rel_dir, 0.0) + score
+                        if not rel_dir:
+                            break
+                        rel_dir = os.path.dirname(rel_dir)
+                shown = set(block_dirs)
+                for rel_dir, score in dir_scores.items():
+                    if rel_dir in directories and rel_dir not in shown:
+                        candidates.append((score, True, rel_dir, directories[rel_dir]["tokens"]))
+            # 稳定部分之外的预算按相关度从高到低装入（得分相同时目录在前），放不下的条目跳过，继续尝试更短的条目
+            candidates.sort(key=lambda c: (-c[0], not c[1], c[2]))
+            selected, used = [], count_tokens(block)
+            for _, is_dir, path, cost in candidates:
+                if used + cost > token_budget:
+                    continue
+                (selected_dirs if is_dir else selected).append(path)
+                used += cost
+            # 按路径排序输出（目录在前），使相同选择得到相同的提示词
+            relevant = "".join(format_directory_entry(rel_dir, directories[rel_dir]["summary"])
+                               for rel_dir in sorted(selected_dirs))
+            relevant += "".join(format_summary_entry(rel_path, summary[rel_path]) for rel_path in sorted(selected))
+
+        stats = {
+            "summaries": len(selected),
+            "total_summaries": len(tokens),
+            "directories": len(block_dirs) + len(selected_dirs),
+            "context_tokens": used,
+            "context_version": version,
+        }
+        return block, relevant, stats
@@ -0,0 +1,55 @@
+import hashlib
+import os
+
+
+def directory_tree(rel_paths):
+    """
+    由文件相对路径构建目录树
+
+    返回:
+        dict: {目录相对路径: {"dirs": [子目录], "files": [文件]}}，项目根目录为 ""，子项按路径排序
+    """
+    tree = {}
+
+    def node(directory):
+        if directory not in tree:
+            tree[directory] = {"dirs": [], "files": []}
+            if directory:
+                node(os.path.dirname(directory))["dirs"].append(directory)
+        return tree[directory]
+
+    for rel_path in sorted(rel_paths):
+        node(os.path.dirname(rel_path))["files"].append(rel_path)
+    for entry in tree.values():
+        entry["dirs"].sort()
+    return tree
+
+
+def directory_depth(directory):
+    return directory.count(os.sep) + 1 if directory else 0
+
+
+def directory_levels(directories):
+    """按深度分组，最深的一组在前（自底向上汇总的处理顺序）"""
+    levels = {}
+    for directory in directories:
+        levels.setdefault(directory_depth(directory), []).append(directory)
+    return [sorted(levels[depth]) for depth in sorted(levels, reverse=True)]
+
+
+def directory_hashes(tree, file_hashes):
+    """
+    自底向上计算每个目录的哈希（由其下文件的内容哈希与子目录的哈希得到），
+    文件变化时只有它的各级上级目录的哈希会改变
+
+    参数:
+        file_hashes (dict): {相对路径: 内容哈希}
+    """
+    hashes = {}
+    for level in directory_levels(tree):
+        for directory in level:
+            entry = tree[directory]
+            lines = [f"f {os.path.basename(p)} {file_hashes.get(p, '')}" for p in entry["files"]]
+            lines += [f"d {os.path.basename(d)} {hashes[d]}" for d in entry["dirs"]]
+            hashes[directory] = hashlib.sha256("\n".join(lines).encode('utf-8')).hexdigest()
+    return hashes
@@ -0,0 +1,137 @@
+import ast
+import json
+import os
+import re
+import threading
+
+from context_builder import BM25Index
+
+# 非Python文件中常见的函数/类型定义
+_DEFINITION_RE = re.compile(
+    r"\b(?:def|class|function|interface|struct|enum|trait|type|module|func|fn)\s+([A-Za-z_$][\w$]*)"
+    r"|^[ \t]*(?:[\w<>\[\],*&:]+\s+)+\**([A-Za-z_]\w*)\s*\([^;{}]*\)\s*(?:const\s*)?(?:throws\s+[\w.,\s]+)?\{",
+    re.MULTILINE
+)
+_SCRIPT_FUNCTION_RE = re.compile(r"^\s*([A-Za-z_][\w-]*)\s*\(\)\s*\{", re.MULTILINE)
+_CONTROL_WORDS = {"if", "for", "while", "switch", "catch", "return", "else", "new", "sizeof"}
+
+
+def extract_identifiers(rel_path, content):
+    """
+    提取源文件中定义的函数名与类名：Python 使用 ast，其他语言使用正则启发式
+    """
+    if rel_path.endswith(".py"):
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError, SystemError):
+            # SystemError: 部分 Python 版本在多线程同时解析大文件时会误报，改用正则提取
+            pass
+        else:
+            return sorted({node.name for node in ast.walk(tree)
+                           if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))})
+    names = set()
+    for match in _DEFINITION_RE.finditer(content):
+        name = match.group(1) or match.group(2)
+        if name and name not in _CONTROL_WORDS:
+            names.add(name)
+    if rel_path.endswith((".sh", ".bash")):
+        names.update(_SCRIPT_FUNCTION_RE.findall(content))
+    return sorted(names)
+
+
+class FileIndex:
+    """
+    持久化的本地文件检索索引（.aide_doc/file_index.json）
+
+    每个文件以 路径 + 摘要 + 源码中定义的标识符 建立 BM25 倒排索引，
+    摘要变化时增量更新，用于在不调用LLM的情况下挑选与问题相关的文件。
+    索引文件只保存标识符；倒排索引在第一次使用时由 summary_source 提供的摘要构建，
+    启动时不必读取全部摘要。
+    """
+
+    VERSION = 2
+
+    def __init__(self, index_file=None, summary_source=None):
+        self.index_file = index_file
+        # 返回 (相对路径, 摘要) 迭代器的函数，用于首次使用时构建倒排索引
+        self.summary_source = summary_source
+        self.index = BM25Index()
+        self.files = {}  # {相对路径: 定义的标识符列表}
+        self.loaded = False
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def document(rel_path, summary_text, identifiers):
+        # 路径和标识符各重复一次，提高其相对摘要正文的权重
+        path_terms = rel_path.replace("\\", "/").replace("/", " ")
+        names = " ".join(identifiers)
+        return f"{path_terms} {path_terms} {names} {names} {summary_text}"
+
+    def load(self):
+        """读取保存的标识符并由摘要构建倒排索引（只执行一次）"""
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            saved = {}
+            if self.index_file and os.path.exists(self.index_file):
+                try:
+                    with open(self.index_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    if data.get("version") == self.VERSION:
+                        saved = data.get("files", {})
+                except Exception as e:
+                    print(f"无法加载文件索引: {str(e)}")
+            if self.summary_source is None:
+                return
+            for rel_path, summary_text in self.summary_source():
+                identifiers = saved.get(rel_path, [])
+                self.files[rel_path] = identifiers
+                self.index.add(rel_path, self.document(rel_path, summary_text, identifiers))
+            # 摘要存储中已不存在的文件不再写回
+            self.dirty = self.dirty or len(saved) != len(self.files)
+
+    def save(self):
+        if not self.index_file or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        with self.lock:
+            payload = json.dumps({"version": self.VERSION, "files": self.files}, ensure_ascii=False)
+            self.dirty = False
+        tmp_file = self.index_file + ".tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_file, self.index_file)
+        except Exception as e:
+            print(f"保存文件索引失败: {str(e)}")
+
+    def update(self, rel_path, summary_text, identifiers=None):
+        """更新单个文件；identifiers 为 None 时保留已有的标识符"""
+        with self.lock:
+            self.load()
+            if identifiers is None:
+                identifiers = self.files.get(rel_path, [])
+            self.files[rel_path] = identifiers
+            self.index.add(rel_path, self.document(rel_path, summary_text, identifiers))
+            self.dirty = True
+
+    def remove(self, rel_path):
+        with self.lock:
+            self.load()
+            if self.files.pop(rel_path, None) is not None:
+                self.index.remove(rel_path)
+                self.dirty = True
+
+    def score(self, query):
+        """返回 {相对路径: 相关度得分}"""
+        with self.lock:
+            self.load()
+            return self.index.score(query)
+
+    def search(self, query, limit=5):
+        """返回与问题最相关的文件相对路径"""
+        with self.lock:
+            self.load()
+            return self.index.search(query, limit)
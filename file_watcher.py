@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+
+from utils import GitIgnoreMatcher
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+class _EventHandler:
+    """把 watchdog 事件转交给 ProjectWatcher（watchdog 只要求处理器提供 dispatch 方法）"""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def dispatch(self, event):
+        # 只关心写入类事件；读取文件产生的 opened/closed_no_write 事件会导致重复扫描
+        if event.event_type not in ("created", "modified", "moved", "deleted", "closed"):
+            return
+        paths = [event.src_path, getattr(event, "dest_path", None)]
+        if event.is_directory:
+            # 目录被移动或删除时无法逐个列出受影响的文件，改为一次完整扫描
+            if event.event_type in ("moved", "deleted"):
+                self.watcher.request_scan()
+            return
+        for path in paths:
+            if path:
+                self.watcher.notify(path)
+
+
+class ProjectWatcher:
+    """
+    后台监视项目文件变化并更新摘要，使聊天请求不必等待扫描
+
+    安装了 watchdog 时使用系统文件事件(inotify等)，否则每隔 poll_interval 秒做一次签名扫描；
+    同一批修改在 debounce 秒内没有新事件后才处理。每隔 retry_interval 秒重试失败队列中已到时间的文件。
+    stop() 会取消正在进行的扫描（已在请求中的摘要完成后返回），未处理的文件下次扫描时继续。
+    """
+
+    def __init__(self, manager, debounce=2.0, poll_interval=30.0, retry_interval=60.0):
+        self.manager = manager
+        self.root = os.path.abspath(manager.project_root)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.matcher = GitIgnoreMatcher(self.root)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.processing = 0
+        self.last_event = 0.0
+        # 启动时先做一次完整扫描，补上程序未运行期间的修改
+        self.scan_requested = True
+        self.scanning = False
+        # 停止监视时同时作为扫描的取消信号
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.observer = None
+
+    @property
+    def mode(self):
+        return "watchdog" if self.observer is not None else "polling"
+
+    def start(self):
+        if Observer is not None:
+            try:
+                self.observer = Observer()
+                self.observer.schedule(_EventHandler(self), self.root, recursive=True)
+                self.observer.start()
+            except Exception as e:
+                print(f"无法启动文件监视，改用定时扫描: {str(e)}")
+                self.observer = None
+        self.thread = threading.Thread(target=self._run, name="ProjectWatcher", daemon=True)
+        self.thread.start()
+        print(f"已启动项目文件监视（{self.mode}）: {self.root}")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join(timeout=5)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def notify(self, path):
+        """记录一个发生变化的文件（绝对路径）"""
+        rel_path = os.path.relpath(path, self.root)
+        if rel_path.startswith(".."):
+            return
+        _, ext = os.path.splitext(rel_path)
+        if self.manager.file_types is not None and ext.lower() not in self.manager.file_types:
+            return
+        if self.matcher.is_path_ignored(rel_path):
+            return
+        with self.lock:
+            self.pending.add(os.path.normpath(rel_path))
+            self.last_event = time.monotonic()
+
+    def request_scan(self):
+        """请求一次完整的后台扫描（立即返回）"""
+        with self.lock:
+            self.scan_requested = True
+
+    def stats(self):
+        """返回 {"mode", "pending": 等待处理的文件数, "processing": 正在更新的文件数, "scanning": 是否在完整扫描}"""
+        with self.lock:
+            return {
+                "mode": self.mode,
+                "pending": len(self.pending),
+                "processing": self.processing,
+                "scanning": self.scanning,
+            }
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        next_retry = time.monotonic() + self.retry_interval
+        while not self.stop_event.wait(0.5):
+            now = time.monotonic()
+            if now >= next_retry:
+                next_retry = now + self.retry_interval
+                try:
+                    self.manager.retry_failed(cancel_event=self.stop_event)
+                except Exception as e:
+                    print(f"重试失败文件出错: {str(e)}")
+            batch = None
+            with self.lock:
+                if self.observer is None and now >= next_poll:
+                    self.scan_requested = True
+                    next_poll = now + self.poll_interval
+                full_scan = self.scan_requested
+                if full_scan:
+                    self.scan_requested = False
+                    self.scanning = True
+                elif self.pending and now - self.last_event >= self.debounce:
+                    batch, self.pending = sorted(self.pending), set()
+                    self.processing = len(batch)
+            if not full_scan and batch is None:
+                continue
+            try:
+                self.manager.refresh_files(None if full_scan else batch, cancel_event=self.stop_event)
+            except Exception as e:
+                print(f"后台更新摘要失败: {str(e)}")
+            finally:
+                with self.lock:
+                    self.scanning = False
+                    self.processing = 0
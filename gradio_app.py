@@ -1,10 +1,14 @@
+import asyncio
 import json
 import sys
+import threading
 
 import gradio as gr
 from gradio.components.chatbot import ChatMessage
 
-from API_manager import API_manager
+from client_pool import parse_api_keys
+from manager_registry import ManagerRegistry
+from metrics import start_metrics_server
 import time
 import os
 
@@ -22,14 +26,121 @@ os.makedirs(PROJECTS_HISTORY_DIR, exist_ok=True)
 PROJECTS_HISTORY_FILE = os.path.join(PROJECTS_HISTORY_DIR, "projects_history.json")
 
 
-# API管理器实例
-api_manager: API_manager = None
+# 按项目共享的API管理器；每个浏览器会话的设置保存在 gr.State 中
+registry = ManagerRegistry()
+# 各类事件同时处理的数量上限（超出的请求在队列中等待）；聊天请求大部分时间在等待API，可以较多
+CHAT_CONCURRENCY = 16
+SCAN_CONCURRENCY = 4
+CONFIG_CONCURRENCY = 2
+QUEUE_MAX_SIZE = 128
+# 扫描进度刷新间隔（秒）
+SCAN_PROGRESS_INTERVAL = 0.5
+# Prometheus 指标端口（http://127.0.0.1:端口/metrics），0 表示不发布
+METRICS_PORT = int(os.environ.get("AIDE_METRICS_PORT", "9464"))
+
+_DONE = object()
+
+
+async def iterate_in_thread(iterator, cancel_event):
+    """
+    在工作线程中逐项取出同步生成器的结果，事件循环不被阻塞；
+    任务被取消（停止按钮）或提前结束时设置 cancel_event，等当前一项取完后关闭生成器
+    """
+    pending = None
+    try:
+        while True:
+            pending = asyncio.ensure_future(asyncio.to_thread(next, iterator, _DONE))
+            item = await asyncio.shield(pending)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        cancel_event.set()
+        if pending is not None and not pending.done():
+            await asyncio.wait([pending])
+        await asyncio.to_thread(iterator.close)
+
+
+class ScanJob:
+    """在后台线程中执行的完整扫描：记录进度，可随时取消；浏览器断开后扫描仍会继续"""
+
+    def __init__(self, manager, on_finish=None):
+        self.manager = manager
+        self.on_finish = on_finish
+        self.cancel_event = threading.Event()
+        self.done, self.total, self.current = 0, 0, ""
+        self.changed = None
+        self.error = None
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, name="ScanJob", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _progress(self, done, total, rel_path):
+        self.done, self.total, self.current = done, total, rel_path
+
+    def _run(self):
+        try:
+            self.changed = self.manager.refresh_files(progress_callback=self._progress, cancel_event=self.cancel_event)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.on_finish is not None:
+                self.on_finish()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def status(self):
+        elapsed = time.time() - self.started
+        if self.running():
+            if self.cancel_event.is_set():
+                return f"正在停止扫描…（已完成 {self.done}/{self.total}）"
+            if not self.total:
+                return f"正在检查文件变化… {elapsed:.0f}s"
+            return f"扫描中: {self.done}/{self.total} | {self.current} | {elapsed:.0f}s"
+        if self.error is not None:
+            return f"扫描失败: {str(self.error)}"
+        if self.cancel_event.is_set():
+            return f"扫描已停止，已更新 {self.done}/{self.total} 个文件，其余文件下次扫描时继续"
+        return f"扫描完成: 检查了 {self.changed or 0} 个变更文件，用时 {elapsed:.1f}s"
+
+
+# 正在进行或最近一次的扫描 {项目路径: ScanJob}；同一项目同时只运行一个扫描，各会话看到同一份进度
+scan_jobs = {}
+scan_jobs_lock = threading.Lock()
 
 PROJECTS_HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history_information/projects_history.json")
 
-def initialize_manager(api_key_assistant, api_key_summarize, project_root, file_types, model_choice, load_history=True):
-    """初始化API管理器"""
-    global api_manager
+
+def start_scan_job(key, api_manager):
+    """返回项目正在进行的扫描，没有时启动一个新的扫描（在工作线程中调用）"""
+    with scan_jobs_lock:
+        job = scan_jobs.get(key)
+        if job is None or not job.running() or job.manager is not api_manager:
+            # 扫描期间项目不会被当作空闲项目关闭
+            registry.acquire(key)
+            job = scan_jobs[key] = ScanJob(api_manager, on_finish=lambda: registry.release(key)).start()
+        return job
+
+def session_manager(session):
+    """
+    返回会话所用项目的管理器（项目被关闭后自动重新加载），会话未配置时返回None；
+    返回的项目已被标记为正在使用，用完后需调用 registry.release(session["project_root"])
+    """
+    if not session:
+        return None
+    return registry.get(session["project_root"], session["assistant_api_key"], session["summarizer_api_key"],
+                        session["file_types"], model=session["model"])
+
+async def initialize_manager(api_key_assistant, api_key_summarize, project_root, file_types, model_choice, session,
+                       load_history=True):
+    """初始化本会话的项目设置，同一项目的管理器在会话间共享"""
 
     # 如果选择了加载历史配置
     if load_history and project_root:
@@ -40,34 +151,33 @@ def initialize_manager(api_key_assistant, api_key_summarize, project_root, file_
 
             if history:
                 # 使用历史配置
-                api_key_assistant = history["assistant_api_key"]
-                api_key_summarize = history["summarizer_api_key"]
+                api_key_assistant, api_key_summarize = history_api_keys(history)
                 file_types = ",".join(history["file_types"])
         except Exception as e:
             print(f"加载历史配置失败: {str(e)}")
 
     if not api_key_assistant.strip() or not api_key_summarize.strip():
-        return "错误：必须提供API密钥", {}
+        return "错误：必须提供API密钥", {}, session
 
     if not project_root or not os.path.exists(project_root):
-        return "错误：项目目录不存在", {}
+        return "错误：项目目录不存在", {}, session
 
+    api_manager = None
     try:
-        if api_manager is None:
-            api_manager = API_manager(
-                assistant_api_key=api_key_assistant,
-                summarizer_api_key=api_key_summarize,
-                project_root=project_root,
-                file_types=[ft.strip() for ft in file_types.split(",")] if file_types.strip() else None,
-                model=model_choice
-            )
-            print("API管理器初始化成功")
-            status = "API管理器初始化成功"
-        else:
-            api_manager.change_root(project_root)
-            api_manager.change_valid_file_types([ft.strip() for ft in file_types.split(",")])
-            api_manager.change_model(model_choice)
-            status = "设置已更新"
+        status = "设置已更新" if session else "API管理器初始化成功"
+        session = {
+            "project_root": os.path.abspath(project_root),
+            "assistant_api_key": parse_api_keys(api_key_assistant),
+            "summarizer_api_key": parse_api_keys(api_key_summarize),
+            "file_types": [ft.strip() for ft in file_types.split(",")] if file_types.strip() else None,
+            "model": model_choice,
+        }
+        # 首次加载项目需要读取摘要索引，放到工作线程中执行
+        api_manager = await asyncio.to_thread(session_manager, session)
+        if session["file_types"] is not None and set(session["file_types"]) != set(api_manager.file_types or []):
+            # 文件类型属于项目，已加载的项目不随单个会话的设置改变
+            status += "（项目已加载，沿用加载时的文件类型，项目关闭后重新加载时生效）"
+        print(status)
 
         file_count = len(api_manager.summary_index) if hasattr(api_manager, 'summary_index') else 0
 
@@ -77,9 +187,19 @@ def initialize_manager(api_key_assistant, api_key_summarize, project_root, file_
             preview["示例文件"] = list(api_manager.summary_index.keys())[0]
         print("preview:", preview)
         save_project_to_history(project_root, api_key_assistant, api_key_summarize, file_types)
-        return f"{status} | 已加载{file_count}个文件摘要", [list(api_manager.summary_index.keys()).__str__(), status]
+        return (f"{status} | 已加载{file_count}个文件摘要", [list(api_manager.summary_index.keys()).__str__(), status],
+                session)
     except Exception as e:
-        return f"初始化失败: {str(e)}", {}
+        return f"初始化失败: {str(e)}", {}, session
+    finally:
+        if api_manager is not None:
+            await asyncio.to_thread(registry.release, session["project_root"])
+
+def history_api_keys(project_data):
+    """返回历史记录中 (对话密钥, 摘要密钥) 的逗号分隔文本，兼容只保存了单个密钥的旧记录"""
+    def keys(role):
+        return ",".join(project_data.get(f"{role}_api_keys") or parse_api_keys(project_data.get(f"{role}_api_key")))
+    return keys("assistant"), keys("summarizer")
 
 def load_projects_history():
     """加载项目历史记录"""
@@ -101,8 +221,8 @@ def save_project_to_history(project_root, api_key_assistant, api_key_summarize,
     project_path = os.path.abspath(project_root)
 
     projects_history[project_path] = {
-        "assistant_api_key": api_key_assistant,
-        "summarizer_api_key": api_key_summarize,
+        "assistant_api_keys": parse_api_keys(api_key_assistant),
+        "summarizer_api_keys": parse_api_keys(api_key_summarize),
         "file_types": [ft.strip() for ft in file_types.split(",")] if file_types.strip() else [],
         "last_used": time.strftime("%Y-%m-%d %H:%M:%S")
     }
@@ -113,32 +233,87 @@ def save_project_to_history(project_root, api_key_assistant, api_key_summarize,
     except Exception as e:
         print(f"保存项目历史记录失败: {str(e)}")
 
-def chat_with_ai(message, chat_history, scan_files, load_files):
-    """处理用户聊天请求并返回AI响应"""
-    if api_manager is None:
-        return "请先初始化API设置！"
+async def chat_with_ai(message, chat_history, scan_files, load_files, session):
+    """
+    处理用户聊天请求，流式产出 (思考过程, 回答) 的累计文本
+
+    最后一次产出的回答末尾附带统计信息（首字时间、总时间等）；
+    阻塞的扫描与API请求在工作线程中执行，任务被取消时中止正在进行的回答
+    """
+    if not session:
+        yield "", "请先初始化API设置！"
+        return
 
+    reasoning, answer = "", ""
+    acquired = False
+    cancel_event = threading.Event()
     try:
+        # 回答期间项目不会被当作空闲项目关闭；注册表与密钥池的锁可能被其他线程占用，不在事件循环中等待
+        api_manager = await asyncio.to_thread(session_manager, session)
+        acquired = True
+        agent = await asyncio.to_thread(api_manager.assistant_pool, session["assistant_api_key"])
+        # 模型、对话密钥和统计信息属于本会话，不修改共享的管理器
+        stats = {}
         start_time = time.time()
-        response, extra = api_manager.analyze(user_input=message, chat_history=chat_history, scan_files=scan_files, load_files=load_files)
+        first_token_time = None
+        extra = []
+        stream = api_manager.analyze_stream(user_input=message, chat_history=chat_history,
+                                            scan_files=scan_files, load_files=load_files,
+                                            model=session["model"], stats=stats, cancel_event=cancel_event,
+                                            agent=agent)
+        async for kind, text in iterate_in_thread(stream, cancel_event):
+            if kind == "files":
+                extra = text
+                continue
+            if first_token_time is None:
+                first_token_time = time.time() - start_time
+            if kind == "reasoning":
+                reasoning += text
+            else:
+                answer += text
+            yield reasoning, answer
         elapsed = time.time() - start_time
+        if first_token_time is None:
+            first_token_time = elapsed
 
         file_count = len(api_manager.summary) if hasattr(api_manager, 'summary') else 0
-        status = f"\n\n[统计] 响应时间: {elapsed:.2f}s | 文件摘要数: {file_count}"
+        context = stats.get("context", {})
+        usage = stats.get("usage", {})
+        status = (f"\n\n[统计] 首字时间: {first_token_time:.2f}s | 总时间: {elapsed:.2f}s"
+                  f" | 文件摘要数: {context.get('summaries', file_count)}/{file_count}")
+        if stats.get("cached_response"):
+            status += " | 本地缓存的回答"
+        timings = stats.get("timings", {})
+        stages = [(name, timings[key]) for key, name in (("scan", "扫描"), ("context", "上下文"),
+                                                        ("pick_files", "选文件"), ("snippets", "代码片段"),
+                                                        ("answer", "回答")) if key in timings]
+        if stages:
+            status += " | 耗时: " + " / ".join(f"{name} {seconds:.2f}s" for name, seconds in stages)
+        if usage:
+            status += (f" | tokens: 输入 {usage.get('prompt_tokens', 0)}（缓存命中 {usage.get('cached_tokens', 0)}）"
+                       f" / 输出 {usage.get('completion_tokens', 0)}")
+        watcher = api_manager.watcher_stats()
+        if watcher:
+            stale = watcher["pending"] + watcher["processing"]
+            status += f" | 待更新摘要: {stale}" + ("（扫描中）" if watcher["scanning"] else "")
+            if watcher["failed"]:
+                status += f" | 失败待重试: {watcher['failed']}"
         if load_files:
             status += f" | 读取代码文件：{extra}"
 
-        return response + status
+        yield reasoning, answer + status
     except Exception as e:
-        return f"请求处理失败: {str(e)}"
+        yield reasoning, answer + f"\n\n请求处理失败: {str(e)}"
+    finally:
+        if acquired:
+            await asyncio.to_thread(registry.release, session["project_root"])
 
 # 创建界面
 with gr.Blocks(title="项目小精灵", theme=gr.themes.Soft()) as demo:
     gr.Markdown("# 智能项目助手")
 
-    # 持久化存储状态
-    api_key_state = gr.State()
-    project_root_state = gr.State()
+    # 本会话的项目设置（项目根目录、密钥、文件类型、模型），各浏览器会话互不影响
+    session_state = gr.State(None)
 
     # API配置面板
     with gr.Tab("控制面板"):
@@ -148,12 +323,12 @@ with gr.Blocks(title="项目小精灵", theme=gr.themes.Soft()) as demo:
                 api_key_assistant = gr.Textbox(
                     label="API密钥01",
                     type="password",
-                    placeholder="输入您的DeepSeek API密钥"
+                    placeholder="输入您的DeepSeek API密钥（多个密钥用逗号分隔）"
                 )
                 api_key_summarize = gr.Textbox(
                     label="API密钥02",
                     type="password",
-                    placeholder="输入您的DeepSeek API密钥"
+                    placeholder="输入您的DeepSeek API密钥（多个密钥用逗号分隔）"
                 )
 
                 project_root = gr.Textbox(
@@ -204,6 +379,7 @@ with gr.Blocks(title="项目小精灵", theme=gr.themes.Soft()) as demo:
 
         with gr.Row():
             scan_btn = gr.Button("扫描项目", variant="secondary")
+            stop_scan_btn = gr.Button("停止扫描", variant="secondary")
             reset_btn = gr.Button("重置配置", variant="stop")
 
     # 聊天助手面板
@@ -225,63 +401,109 @@ with gr.Blocks(title="项目小精灵", theme=gr.themes.Soft()) as demo:
                 container=False
             )
             submit_btn = gr.Button("发送", variant="primary")
+            stop_btn = gr.Button("停止", variant="stop")
 
     # ===== 事件处理 =====
 
     # 配置按钮处理
     config_btn.click(
         initialize_manager,
-        inputs=[api_key_assistant, api_key_summarize, project_root, file_types, model_choice],
-        outputs=[status_display, summary_preview]
+        inputs=[api_key_assistant, api_key_summarize, project_root, file_types, model_choice, session_state],
+        outputs=[status_display, summary_preview, session_state],
+        concurrency_limit=CONFIG_CONCURRENCY,
+        concurrency_id="config"
     )
 
 
-    # 扫描按钮处理
-    def update_summary_preview():
+    def update_summary_preview(api_manager):
         """更新摘要预览"""
         if api_manager and hasattr(api_manager, 'summary_index'):
             preview_data = [
                 [f"{i + 1}. {k[:20]}...", "已加载"]
                 for i, k in enumerate(list(api_manager.summary_index.keys())[:10])
             ]
-            return "摘要已加载", preview_data
+            pools = f"密钥: 对话 {len(api_manager.assistant)} 个 / 摘要 {len(api_manager.summarizer)} 个"
+            watcher = api_manager.watcher_stats()
+            if watcher:
+                return (f"摘要已加载 | {pools} | 后台监视({watcher['mode']}): 等待更新 {watcher['pending']} 个，"
+                        f"正在更新 {watcher['processing']} 个，失败待重试 {watcher['failed']} 个"
+                        + ("，扫描中" if watcher["scanning"] else "")), preview_data
+            return f"摘要已加载 | {pools}", preview_data
         return "请先配置API设置", [["配置未初始化", ""]]
 
 
+    # 扫描按钮处理：扫描在后台任务中执行，这里只定时推送进度
+    async def scan_project(session):
+        if not session:
+            yield "请先配置API设置", [["配置未初始化", ""]]
+            return
+        api_manager = await asyncio.to_thread(session_manager, session)
+        try:
+            job = await asyncio.to_thread(start_scan_job, registry.key(session["project_root"]), api_manager)
+            while job.running():
+                yield job.status(), gr.skip()
+                await asyncio.sleep(SCAN_PROGRESS_INTERVAL)
+            status, preview_data = update_summary_preview(api_manager)
+            yield f"{job.status()} | {status}", preview_data
+        finally:
+            await asyncio.to_thread(registry.release, session["project_root"])
+
+
     scan_btn.click(
-        update_summary_preview,
-        inputs=[],
-        outputs=[status_display, summary_preview]
+        scan_project,
+        inputs=[session_state],
+        outputs=[status_display, summary_preview],
+        concurrency_limit=SCAN_CONCURRENCY,
+        concurrency_id="scan"
+    )
+
+
+    def stop_scan(session):
+        job = scan_jobs.get(registry.key(session["project_root"])) if session else None
+        if job is None or not job.running():
+            return "当前没有正在进行的扫描"
+        job.cancel()
+        return job.status()
+
+
+    stop_scan_btn.click(
+        stop_scan,
+        inputs=[session_state],
+        outputs=[status_display]
     )
 
 
     # 重置配置
     def reset_config():
-        global api_manager
-        api_manager = None
-        return "配置已重置，请重新设置", [["配置已重置", ""]]
+        # 只清除本会话的设置；共享的项目管理器空闲后由 registry 关闭
+        registry.evict_idle()
+        return "配置已重置，请重新设置", [["配置已重置", ""]], None
 
 
     reset_btn.click(
         reset_config,
         inputs=[],
-        outputs=[status_display, summary_preview]
+        outputs=[status_display, summary_preview, session_state]
     )
 
 
-    def handle_chat(message, chat_history, scan_files, load_files):
+    async def handle_chat(message, chat_history, scan_files, load_files, session):
+        history = list(chat_history)
         # 第一步：添加用户消息和占位符消息，并立即显示
         chat_history += [{"role": "user", "content": message}, {"role": "assistant", "content": "等待响应。。。"}]
         # 立即显示更新后的聊天记录（包含占位符）
         yield chat_history
 
-        # 获取AI响应
-        bot_response = chat_with_ai(message, chat_history, scan_files, load_files)
-
-        # 替换占位符为实际响应
-        chat_history[-1]["content"] = bot_response
-        # 返回更新后的聊天记录
-        yield chat_history
+        # 流式获取AI响应，思考过程显示在可折叠的消息中
+        thinking = None
+        async for reasoning, answer in chat_with_ai(message, history, scan_files, load_files, session):
+            if reasoning and thinking is None:
+                thinking = {"role": "assistant", "content": "", "metadata": {"title": "思考过程"}}
+                chat_history.insert(len(chat_history) - 1, thinking)
+            if thinking is not None:
+                thinking["content"] = reasoning
+            chat_history[-1]["content"] = answer or "等待响应。。。"
+            yield chat_history
 
 
     # 添加刷新历史项目的函数
@@ -300,11 +522,12 @@ with gr.Blocks(title="项目小精灵", theme=gr.themes.Soft()) as demo:
         actual_path = project_path.split(" (最后使用:")[0].strip()
         projects_history = load_projects_history()
         project_data = projects_history.get(actual_path, {})
+        assistant_keys, summarizer_keys = history_api_keys(project_data)
 
         return (
             gr.Textbox(value=actual_path),  # 项目路径
-            gr.Textbox(value=project_data.get("assistant_api_key", "")),  # API密钥01
-            gr.Textbox(value=project_data.get("summarizer_api_key", "")),  # API密钥02
+            gr.Textbox(value=assistant_keys),  # API密钥01
+            gr.Textbox(value=summarizer_keys),  # API密钥02
             gr.Checkbox(value=True)  # 加载历史配置
         )
 
@@ -331,21 +554,30 @@ with gr.Blocks(title="项目小精灵", theme=gr.themes.Soft()) as demo:
         outputs=[history_projects]
     )
 
-    # 绑定聊天事件
-    msg.submit(
-        handle_chat,
-        inputs=[msg, chatbot, scan_files, load_files],
-        outputs=[chatbot]
-    )
+    # 绑定聊天事件（回车与发送按钮共用同一并发上限）
+    chat_events = [
+        trigger(
+            handle_chat,
+            inputs=[msg, chatbot, scan_files, load_files, session_state],
+            outputs=[chatbot],
+            concurrency_limit=CHAT_CONCURRENCY,
+            concurrency_id="chat"
+        )
+        for trigger in (msg.submit, submit_btn.click)
+    ]
 
-    submit_btn.click(
-        handle_chat,
-        inputs=[msg, chatbot, scan_files, load_files],
-        outputs=[chatbot]
-    )
+    # 停止按钮：取消正在进行的回答，工作线程随之关闭与API的连接
+    stop_btn.click(None, None, None, cancels=chat_events)
+
+demo.queue(max_size=QUEUE_MAX_SIZE, default_concurrency_limit=CONFIG_CONCURRENCY)
 
 # 启动应用
 if __name__ == "__main__":
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_PORT)
+        except OSError as e:
+            print(f"无法发布指标（端口 {METRICS_PORT}）: {str(e)}")
     demo.launch(
         server_port=7860,
         share=False
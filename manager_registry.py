@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from API_manager import API_manager
+
+
+class _ProjectEntry:
+    def __init__(self):
+        self.manager = None
+        self.error = None
+        self.ready = threading.Event()  # 管理器创建完成（或失败）后设置
+        self.active = 0  # 正在使用该项目的请求数
+        self.last_used = time.monotonic()
+
+
+class ManagerRegistry:
+    """
+    按项目根目录共享的 API_manager 注册表
+
+    同一项目的所有会话共用一个管理器（摘要存储、检索索引、后台监视只加载一份），
+    会话各自的模型、对话密钥和统计信息由调用方保存在会话状态中。
+    摘要密钥和文件类型属于项目，由首次加载项目时的设置决定，项目关闭后重新加载时才会改变。
+    最多同时加载 max_projects 个项目，超出时按最近使用顺序关闭空闲的项目；
+    空闲超过 idle_timeout 秒的项目也会被关闭，下次使用时重新加载。
+    self.lock 只保护项目表，创建与关闭管理器都在锁外进行；被淘汰的项目在后台线程中关闭（取消后台扫描、保存摘要），
+    不阻塞触发淘汰的请求，同一项目重新加载前会等待它关闭完成。同一项目的扫描与保存由管理器的 scan_lock 串行执行。
+    """
+
+    def __init__(self, max_projects=4, idle_timeout=3600.0, manager_factory=API_manager):
+        self.max_projects = max(1, max_projects)
+        self.idle_timeout = idle_timeout
+        self.manager_factory = manager_factory
+        self.lock = threading.Lock()
+        self.projects = OrderedDict()  # {项目绝对路径: _ProjectEntry}，最近使用的在末尾
+        self.closing = {}  # {项目绝对路径: 正在后台关闭该项目的线程}
+
+    def __len__(self):
+        return len(self.projects)
+
+    @staticmethod
+    def key(project_root):
+        return os.path.normcase(os.path.abspath(project_root))
+
+    def get(self, project_root, assistant_api_key, summarizer_api_key=None, file_types=None, **kwargs):
+        """
+        返回项目的管理器，尚未加载时创建并启动后台监视；已加载时沿用原有的摘要密钥和文件类型
+
+        返回时项目已被标记为正在使用（同 acquire），调用方用完后必须调用 release，否则项目不会被关闭。
+        同一项目同时只创建一次：先在项目表中放入占位项，在锁外创建管理器，其他请求等待它创建完成。
+        kwargs 为创建管理器时的其他参数（如 model）
+        """
+        key = self.key(project_root)
+        with self.lock:
+            entry = self.projects.get(key)
+            creating = entry is None
+            if creating:
+                entry = self.projects[key] = _ProjectEntry()
+            else:
+                self.projects.move_to_end(key)
+            # 在锁内标记为正在使用，返回给调用方之前不会被其他请求触发的淘汰关闭（创建期间同样如此）
+            entry.active += 1
+            entry.last_used = time.monotonic()
+            evicted = [] if creating else self._evict()
+        self._close(evicted)
+        if creating:
+            return self._create(key, entry, project_root, assistant_api_key, summarizer_api_key, file_types, kwargs)
+        entry.ready.wait()
+        if entry.error is not None:
+            raise entry.error
+        return entry.manager
+
+    def _create(self, key, entry, project_root, assistant_api_key, summarizer_api_key, file_types, kwargs):
+        with self.lock:
+            closing = self.closing.get(key)
+        if closing is not None:
+            # 等待刚被淘汰的同一项目保存完摘要，再从摘要存储重新加载
+            closing.join()
+        try:
+            manager = self.manager_factory(assistant_api_key=assistant_api_key,
+                                           summarizer_api_key=summarizer_api_key,
+                                           project_root=project_root, file_types=file_types, **kwargs)
+            manager.start_watcher()
+        except Exception as e:
+            entry.error = e
+            with self.lock:
+                if self.projects.get(key) is entry:
+                    del self.projects[key]
+            entry.ready.set()
+            raise
+        entry.manager = manager
+        entry.ready.set()
+        with self.lock:
+            entry.last_used = time.monotonic()
+            # 创建期间注册表已被关闭时，新建的管理器不再登记
+            orphaned = self.projects.get(key) is not entry
+            evicted = [(key, manager)] if orphaned else self._evict()
+            if not orphaned:
+                print(f"已加载项目: {key}（共 {len(self.projects)} 个）")
+        self._close(evicted)
+        if orphaned:
+            raise RuntimeError(f"加载项目期间注册表已关闭: {key}")
+        return manager
+
+    def acquire(self, project_root):
+        """
+        为已持有的项目再增加一次使用标记（使用期间不会被关闭），需与 release 配对；
+        调用方应已通过 get 持有该项目，项目未加载时抛出 KeyError
+        """
+        key = self.key(project_root)
+        with self.lock:
+            entry = self.projects.get(key)
+            if entry is None:
+                raise KeyError(f"项目未加载: {key}")
+            entry.active += 1
+            entry.last_used = time.monotonic()
+
+    def release(self, project_root):
+        with self.lock:
+            entry = self.projects.get(self.key(project_root))
+            if entry is not None:
+                entry.active = max(0, entry.active - 1)
+                entry.last_used = time.monotonic()
+
+    def _evict(self):
+        """在持有 self.lock 时调用，移出需要关闭的项目并返回 [(项目路径, 管理器)]"""
+        now = time.monotonic()
+        evicted = []
+        for key, entry in list(self.projects.items()):
+            if entry.active:
+                continue
+            over_limit = len(self.projects) > self.max_projects
+            idle = self.idle_timeout is not None and now - entry.last_used > self.idle_timeout
+            if over_limit or idle:
+                evicted.append((key, self.projects.pop(key).manager))
+                print(f"关闭空闲项目: {key}")
+        return evicted
+
+    def _close(self, evicted):
+        """在后台线程中关闭被淘汰的项目，立即返回"""
+        for key, manager in evicted:
+            if manager is None:
+                # 仍在创建中的项目，由创建它的请求负责关闭
+                continue
+            thread = threading.Thread(target=self._close_manager, args=(key, manager), name="ManagerClose", daemon=True)
+            with self.lock:
+                self.closing[key] = thread
+                thread.start()
+
+    def _close_manager(self, key, manager):
+        try:
+            manager.close()
+        except Exception as e:
+            print(f"关闭项目失败: {str(e)}")
+        finally:
+            with self.lock:
+                if self.closing.get(key) is threading.current_thread():
+                    del self.closing[key]
+
+    def evict_idle(self):
+        """关闭空闲超时的项目，返回关闭的数量"""
+        with self.lock:
+            evicted = self._evict()
+        self._close(evicted)
+        return len(evicted)
+
+    def close(self):
+        """关闭全部项目，等待后台关闭的项目完成后返回"""
+        with self.lock:
+            evicted = [(key, entry.manager) for key, entry in self.projects.items()]
+            self.projects.clear()
+        self._close(evicted)
+        with self.lock:
+            closing = list(self.closing.values())
+        for thread in closing:
+            thread.join()
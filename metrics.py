@@ -0,0 +1,207 @@
+"""
+运行指标与追踪：计数器/仪表/直方图以 Prometheus 文本格式输出（/metrics），
+各阶段耗时可同时写入 JSONL 追踪文件（每行一个 span）
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 耗时直方图的桶（秒）
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# {指标名: (类型, 说明)}
+METRICS = {
+    "aide_scan_files_total": ("counter", "扫描时检查的文件数"),
+    "aide_scan_changed_files_total": ("counter", "签名变化、需要重新检查的文件数"),
+    "aide_file_read_bytes_total": ("counter", "读取的文件字节数"),
+    "aide_file_read_seconds": ("histogram", "读取单个文件的耗时，stage=read/decode"),
+    "aide_hash_seconds": ("histogram", "计算内容指纹的耗时"),
+    "aide_summary_queue_depth": ("gauge", "等待生成摘要的请求组数"),
+    "aide_summaries_total": ("counter", "摘要更新结果，result=summarized/reused/unchanged/failed"),
+    "aide_api_requests_total": ("counter", "API请求数，status=ok/error"),
+    "aide_api_request_seconds": ("histogram", "单次API请求的耗时（流式请求到接收完毕）"),
+    "aide_tokens_total": ("counter", "API用量token数，kind=prompt/completion/cached"),
+    "aide_stage_seconds": ("histogram", "各处理阶段的耗时"),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+class Metrics:
+    """线程安全的指标注册表"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # {(指标名, 标签): 值}
+        self.histograms = {}  # {(指标名, 标签): [各桶计数, 总和, 次数]}
+
+    def inc(self, name, value=1.0, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, _label_key(labels))] = float(value)
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get(self, name, **labels):
+        """返回计数器或仪表的当前值（不存在时为0）"""
+        with self.lock:
+            return self.values.get((name, _label_key(labels)), 0.0)
+
+    def render(self):
+        """Prometheus 文本格式"""
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self.histograms.items()}
+        lines = []
+        for name in sorted({name for name, _ in values} | {name for name, _ in histograms}):
+            kind, help_text = METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, key), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(key)} {value:g}")
+            for (metric, key), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', f'{bound:g}')])} {bucket_count}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total:g}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+_trace_lock = threading.Lock()
+_trace_file = None
+_local = threading.local()
+
+
+def set_trace_file(path):
+    """设置 JSONL 追踪文件（追加写入），None 表示关闭追踪"""
+    global _trace_file
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            _trace_file = open(path, "a", encoding="utf-8")
+
+
+def _write_span(name, current, parent, start, duration, attrs):
+    if _trace_file is None:
+        return
+    record = {"name": name, "span_id": current["span_id"], "parent_id": parent and parent["span_id"],
+              "trace_id": current["trace_id"], "start": round(start, 6), "duration": round(duration, 6),
+              "thread": threading.current_thread().name, "attrs": attrs}
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.write(line)
+            _trace_file.flush()
+
+
+def _new_span(parent):
+    span_id = uuid.uuid4().hex[:16]
+    return {"span_id": span_id, "trace_id": parent["trace_id"] if parent else span_id}
+
+
+def _current_parent():
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def record_span(name, start, duration, **attrs):
+    """
+    记录一个已经结束的阶段（如流式回答，无法用 with 包住）：计入 aide_stage_seconds，开启追踪时写入一行JSON
+
+    参数:
+        start (float): 开始时间（time.time()）
+    """
+    metrics.observe("aide_stage_seconds", duration, stage=name)
+    parent = _current_parent()
+    _write_span(name, _new_span(parent), parent, start, duration, attrs)
+
+
+@contextmanager
+def span(name, timings=None, **attrs):
+    """
+    记录代码块的耗时；产出的字典可在块内补充属性。同一线程内嵌套的 span 在追踪文件中记录父子关系。
+    若提供 timings 字典，结束时写入 {阶段名最后一段: 耗时}（如 "analyze.context" 写入 "context"）
+    """
+    parent = _current_parent()
+    current = _new_span(parent)
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    _local.stack.append(current)
+    start_wall, start = time.time(), time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        _local.stack.pop()
+        duration = time.perf_counter() - start
+        if timings is not None:
+            timings[name.rsplit(".", 1)[-1]] = duration
+        metrics.observe("aide_stage_seconds", duration, stage=name)
+        _write_span(name, current, parent, start_wall, duration, attrs)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """在后台线程提供 http://host:port/metrics，返回 server"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    print(f"指标已发布在 http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+if os.environ.get("AIDE_TRACE_FILE"):
+    set_trace_file(os.environ["AIDE_TRACE_FILE"])
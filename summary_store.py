@@ -0,0 +1,340 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+class SummaryStore:
+    """
+    基于 SQLite(WAL模式) 的摘要存储（.aide_doc/summaries.db）
+
+    摘要按内容寻址：summaries 表每个文件一行，保存摘要索引条目(哈希、签名等)；摘要正文以内容哈希为键保存在
+    contents 表中，内容相同的文件（移动、复制、重复的文件）共用一份摘要。
+    目录摘要单独保存在 directories 表中，生成摘要失败的文件记录在 failures 表中等待重试；
+    只写入变化的条目，写入在事务中完成，进程中断也不会留下半写的数据。
+    """
+
+    # 表结构版本（PRAGMA user_version）；1 起摘要正文移入 contents 表
+    SCHEMA_VERSION = 1
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # 通过内存映射读取数据库文件，按需取摘要时不必逐页 read()
+        self.conn.execute("PRAGMA mmap_size=268435456")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "rel_path TEXT PRIMARY KEY, hash TEXT, entry TEXT NOT NULL, summary TEXT, updated REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "rel_dir TEXT PRIMARY KEY, hash TEXT, summary TEXT NOT NULL, tokens INTEGER, updated REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS failures ("
+                "rel_path TEXT PRIMARY KEY, attempts INTEGER NOT NULL, error TEXT, next_retry REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS contents (hash TEXT PRIMARY KEY, summary TEXT NOT NULL, "
+                              "updated REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS summaries_hash ON summaries (hash)")
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+                # 旧版本按路径保存的摘要正文移入 contents 表（没有哈希的条目保留原样）
+                self.conn.execute("INSERT OR IGNORE INTO contents (hash, summary, updated) "
+                                  "SELECT hash, summary, updated FROM summaries "
+                                  "WHERE summary IS NOT NULL AND hash IS NOT NULL")
+                self.conn.execute("UPDATE summaries SET summary = NULL WHERE hash IS NOT NULL")
+                self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+    def load_index(self):
+        """返回 {相对路径: 摘要索引条目}"""
+        with self.lock:
+            rows = self.conn.execute("SELECT rel_path, entry FROM summaries").fetchall()
+        return {rel_path: json.loads(entry) for rel_path, entry in rows}
+
+    def load_all(self):
+        """返回 ({相对路径: 摘要索引条目}, {相对路径: 摘要})"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT s.rel_path, s.entry, COALESCE(c.summary, s.summary) "
+                "FROM summaries s LEFT JOIN contents c ON c.hash = s.hash"
+            ).fetchall()
+        index, summary = {}, {}
+        for rel_path, entry, summary_text in rows:
+            index[rel_path] = json.loads(entry)
+            if summary_text is not None:
+                summary[rel_path] = summary_text
+        return index, summary
+
+    def get(self, rel_path):
+        """返回单个文件的摘要，不存在时返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT COALESCE(c.summary, s.summary) FROM summaries s LEFT JOIN contents c ON c.hash = s.hash "
+                "WHERE s.rel_path = ?", (rel_path,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_by_hash(self, content_hash):
+        """返回内容哈希对应的摘要（任一路径曾为该内容生成过摘要即可），不存在时返回None"""
+        with self.lock:
+            row = self.conn.execute("SELECT summary FROM contents WHERE hash = ?", (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def iter_summaries(self, batch_size=1000):
+        """按路径顺序分批读取全部摘要，逐条产出 (相对路径, 摘要)，不会一次性读入内存"""
+        last = ""
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT s.rel_path, COALESCE(c.summary, s.summary) AS summary_text "
+                    "FROM summaries s LEFT JOIN contents c ON c.hash = s.hash "
+                    "WHERE s.rel_path > ? AND summary_text IS NOT NULL ORDER BY s.rel_path LIMIT ?", (last, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def upsert(self, entries):
+        """
+        写入或更新若干条目
+
+        参数:
+            entries (dict): {相对路径: (摘要索引条目, 摘要)}，摘要以条目的哈希为键写入 contents 表；
+                            摘要为None时只更新条目
+        """
+        if not entries:
+            return
+        now = time.time()
+        rows, contents = [], []
+        for rel_path, (entry, summary_text) in entries.items():
+            content_hash = entry.get("hash")
+            if summary_text is not None and content_hash:
+                contents.append((content_hash, summary_text, now))
+                summary_text = None
+            rows.append((rel_path, content_hash, json.dumps(entry, ensure_ascii=False), summary_text, now))
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO contents (hash, summary, updated) VALUES (?, ?, ?)",
+                                  contents)
+            self.conn.executemany(
+                "INSERT INTO summaries (rel_path, hash, entry, summary, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(rel_path) DO UPDATE SET hash = excluded.hash, entry = excluded.entry, "
+                "summary = COALESCE(excluded.summary, summaries.summary), updated = excluded.updated",
+                rows
+            )
+
+    def delete(self, rel_paths):
+        """删除路径的条目；摘要正文留在 contents 表中（文件移动后可以沿用），由 collect_garbage 回收"""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM summaries WHERE rel_path = ?", [(p,) for p in rel_paths])
+
+    def collect_garbage(self):
+        """删除已没有任何路径引用的摘要正文，返回删除的数量"""
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM contents WHERE hash NOT IN (SELECT hash FROM summaries WHERE hash IS NOT NULL)"
+            ).rowcount
+
+    def load_directories(self):
+        """返回 {目录相对路径: {"hash", "summary", "tokens"}}"""
+        with self.lock:
+            rows = self.conn.execute("SELECT rel_dir, hash, summary, tokens FROM directories").fetchall()
+        return {rel_dir: {"hash": dir_hash, "summary": summary_text, "tokens": tokens}
+                for rel_dir, dir_hash, summary_text, tokens in rows}
+
+    def upsert_directories(self, entries):
+        """
+        写入或更新目录摘要
+
+        参数:
+            entries (dict): {目录相对路径: {"hash", "summary", "tokens"}}
+        """
+        if not entries:
+            return
+        now = time.time()
+        rows = [(rel_dir, entry["hash"], entry["summary"], entry["tokens"], now) for rel_dir, entry in entries.items()]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO directories (rel_dir, hash, summary, tokens, updated) "
+                                  "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def delete_directories(self, rel_dirs):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM directories WHERE rel_dir = ?", [(d,) for d in rel_dirs])
+
+    def record_failures(self, errors, base_delay=60.0, max_delay=3600.0):
+        """
+        记录生成摘要失败的文件，下次重试时间按失败次数指数增长
+
+        参数:
+            errors (dict): {相对路径: 错误信息}
+        """
+        if not errors:
+            return
+        now = time.time()
+        with self.lock, self.conn:
+            for rel_path, error in errors.items():
+                row = self.conn.execute("SELECT attempts FROM failures WHERE rel_path = ?", (rel_path,)).fetchone()
+                attempts = (row[0] if row else 0) + 1
+                next_retry = now + min(max_delay, base_delay * 2 ** (attempts - 1))
+                self.conn.execute("INSERT OR REPLACE INTO failures (rel_path, attempts, error, next_retry) "
+                                  "VALUES (?, ?, ?, ?)", (rel_path, attempts, str(error)[:500], next_retry))
+
+    def clear_failures(self, rel_paths):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM failures WHERE rel_path = ?", [(p,) for p in rel_paths])
+
+    def due_failures(self, now=None):
+        """返回已到重试时间的失败文件"""
+        now = time.time() if now is None else now
+        with self.lock:
+            rows = self.conn.execute("SELECT rel_path FROM failures WHERE next_retry <= ? ORDER BY next_retry",
+                                     (now,)).fetchall()
+        return [row[0] for row in rows]
+
+    def failure_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM failures").fetchone()[0]
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                              (key, json.dumps(value, ensure_ascii=False)))
+
+    def migrate_from_files(self, index_file, summary_dir):
+        """
+        从旧的 summary_index.json + summaries/*.summary.txt 布局导入，
+        导入后将旧索引文件重命名为 .migrated 并删除已导入的摘要文件，返回导入的条目数
+        """
+        if not os.path.exists(index_file):
+            return 0
+        try:
+            with open(index_file, 'r', encoding='utf-8') as f:
+                old_index = json.load(f)
+        except Exception as e:
+            print(f"无法读取旧摘要索引 {index_file}: {str(e)}")
+            return 0
+
+        entries = {}
+        for rel_path, entry in old_index.items():
+            summary_path = os.path.join(summary_dir, rel_path + ".summary.txt")
+            summary_text = None
+            if os.path.exists(summary_path):
+                try:
+                    with open(summary_path, 'r', encoding='utf-8') as f:
+                        summary_text = f.read()
+                except Exception as e:
+                    print(f"无法读取摘要文件 {summary_path}: {str(e)}")
+            # 没有摘要正文的条目不导入，下次扫描时重新生成
+            if summary_text is not None:
+                entries[rel_path] = (entry, summary_text)
+        self.upsert(entries)
+        os.replace(index_file, index_file + ".migrated")
+        for rel_path in entries:
+            try:
+                os.remove(os.path.join(summary_dir, rel_path + ".summary.txt"))
+            except OSError:
+                pass
+        # 删除清空后的目录（自底向上）
+        for dirpath, _, _ in sorted(os.walk(summary_dir), key=lambda item: -len(item[0])):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+        print(f"已将 {len(entries)} 条摘要从旧格式迁移到 {self.db_path}")
+        return len(entries)
+
+
+class LazySummaries(Mapping):
+    """
+    按需读取的摘要字典：启动时只知道有哪些文件，摘要正文在第一次访问时从 SummaryStore 读取，
+    并保存在容量为 cache_size 的 LRU 中；新生成但尚未保存的摘要单独保存，不会被淘汰
+    """
+
+    def __init__(self, store=None, keys=(), cache_size=4096):
+        self.store = store
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.known = set(keys)
+        self.cache = OrderedDict()
+        self.unsaved = {}
+
+    def __getitem__(self, rel_path):
+        with self.lock:
+            if rel_path not in self.known:
+                raise KeyError(rel_path)
+            if rel_path in self.unsaved:
+                return self.unsaved[rel_path]
+            if rel_path in self.cache:
+                self.cache.move_to_end(rel_path)
+                return self.cache[rel_path]
+        summary_text = self.store.get(rel_path) if self.store is not None else None
+        if summary_text is None:
+            raise KeyError(rel_path)
+        with self.lock:
+            self._remember(rel_path, summary_text)
+        return summary_text
+
+    def __contains__(self, rel_path):
+        return rel_path in self.known
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.known))
+
+    def __len__(self):
+        return len(self.known)
+
+    def _remember(self, rel_path, summary_text):
+        self.cache[rel_path] = summary_text
+        self.cache.move_to_end(rel_path)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def put(self, rel_path, summary_text):
+        """加入新生成的摘要（保存前一直驻留内存）"""
+        with self.lock:
+            self.known.add(rel_path)
+            self.cache.pop(rel_path, None)
+            self.unsaved[rel_path] = summary_text
+
+    def unsaved_summary(self, rel_path):
+        """返回尚未保存的摘要，没有时返回None"""
+        with self.lock:
+            return self.unsaved.get(rel_path)
+
+    def discard(self, rel_path):
+        """移除已删除文件的摘要"""
+        with self.lock:
+            self.known.discard(rel_path)
+            self.cache.pop(rel_path, None)
+            self.unsaved.pop(rel_path, None)
+
+    def mark_saved(self, rel_paths):
+        """摘要已写入存储，转入LRU缓存"""
+        with self.lock:
+            for rel_path in rel_paths:
+                summary_text = self.unsaved.pop(rel_path, None)
+                if summary_text is not None:
+                    self._remember(rel_path, summary_text)
@@ -1,73 +1,354 @@
+import hashlib
+import json
 import os
+import random
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
 import chardet
-from pathlib import Path
-import fnmatch
 
+from metrics import metrics
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+# 默认忽略的目录和文件（优先级高于 .gitignore 中的规则）
+DEFAULT_IGNORE_PATTERNS = ['.git', '.aide_doc', 'build.spec', 'requirements.txt']
 
-def parse_gitignore(root_dir):
+
+def read_gitignore(gitignore_path):
     """
-    解析项目中的.gitignore文件，返回需要忽略的模式列表
+    读取单个.gitignore文件，返回其中的模式列表（忽略空行和注释）
     """
-    gitignore_path = os.path.join(root_dir, '.gitignore')
     ignore_patterns = []
-
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path, 'r', encoding='utf-8') as f:
+    if os.path.isfile(gitignore_path):
+        with open(gitignore_path, 'r', encoding='utf-8', errors='replace') as f:
             for line in f:
                 line = line.strip()
                 if line and not line.startswith('#'):
                     ignore_patterns.append(line)
-
-    # 添加默认忽略的目录
-    ignore_patterns.extend(['.git', '.aide_doc', 'build.spec', 'requirements.txt'])
     return ignore_patterns
 
 
-def should_ignore(path, ignore_patterns):
+def translate_gitignore_pattern(pattern):
     """
-    检查路径是否应该被忽略
+    将一条 gitignore 模式转换为正则表达式
+
+    返回:
+        tuple: (正则字符串, 是否为取反模式, 是否只匹配目录)，空模式返回 None
     """
-    path = Path(path)
-    for pattern in ignore_patterns:
-        # 处理目录模式 (以/结尾)
-        if pattern.endswith('/'):
-            dir_pattern = pattern.rstrip('/')
-            if fnmatch.fnmatch(path.name, dir_pattern) or \
-                    any(fnmatch.fnmatch(part, dir_pattern) for part in path.parts):
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        return None
+
+    # 模式开头或中间含有/时，相对于.gitignore所在目录匹配；否则匹配任意层级
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+                j = i + 2
+                if j < n and pattern[j] == '/':
+                    # "**/" 匹配零或多层目录
+                    res.append('(?:.*/)?')
+                    i = j + 1
+                    continue
+                if j == n:
+                    # 结尾的 "/**" 匹配目录下的所有内容
+                    res.append('.*')
+                    i = j
+                    continue
+            while i < n and pattern[i] == '*':
+                i += 1
+            res.append('[^/]*')
+            continue
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j == -1:
+                res.append('\\[')
+            else:
+                stuff = pattern[i + 1:j].replace('\\', '\\\\')
+                if stuff[0] in '!^':
+                    stuff = '^' + stuff[1:]
+                res.append('[' + stuff + ']')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+
+    regex = ''.join(res)
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return regex, negate, dir_only
+
+
+class GitIgnoreMatcher:
+    """
+    按 git 语义匹配忽略规则：支持取反(!)、锚定(/)、** 以及子目录中的.gitignore
+
+    每个.gitignore文件中的所有模式被编译成一个合并的正则（目录和文件各一个），
+    按倒序排列，第一个命中的分组即最后一条匹配的模式，从而实现"后者优先"。
+    """
+
+    def __init__(self, root_dir, extra_patterns=None):
+        self.root_dir = os.path.abspath(root_dir)
+        # {相对目录('' 表示根目录): (目录正则, 文件正则, {分组名: 是否取反})}
+        self.levels = {}
+        patterns = read_gitignore(os.path.join(self.root_dir, '.gitignore'))
+        patterns.extend(DEFAULT_IGNORE_PATTERNS if extra_patterns is None else extra_patterns)
+        self._add_level('', patterns)
+
+    def _add_level(self, rel_dir, patterns):
+        compiled = [translate_gitignore_pattern(p) for p in patterns]
+        compiled = [c for c in compiled if c is not None]
+        if not compiled:
+            return
+        negations = {}
+        dir_parts, file_parts = [], []
+        for index in range(len(compiled) - 1, -1, -1):
+            regex, negate, dir_only = compiled[index]
+            name = f"p{index}"
+            negations[name] = negate
+            dir_parts.append(f"(?P<{name}>{regex})")
+            if not dir_only:
+                file_parts.append(f"(?P<{name}>{regex})")
+        dir_regex = re.compile('|'.join(dir_parts), re.DOTALL)
+        file_regex = re.compile('|'.join(file_parts), re.DOTALL) if file_parts else None
+        self.levels[rel_dir] = (dir_regex, file_regex, negations)
+
+    def load_directory(self, rel_dir):
+        """
+        加载子目录中的.gitignore（os.walk 自顶向下遍历时对每个目录调用一次）
+        """
+        rel_dir = rel_dir.replace(os.sep, '/').strip('/')
+        if rel_dir in ('', '.') or rel_dir in self.levels:
+            return
+        patterns = read_gitignore(os.path.join(self.root_dir, rel_dir, '.gitignore'))
+        if patterns:
+            self._add_level(rel_dir, patterns)
+
+    def is_ignored(self, rel_path, is_dir=False):
+        """
+        判断单个目录项是否被忽略（不检查其父目录，父目录由遍历时剪枝保证）
+        """
+        rel_path = rel_path.replace(os.sep, '/').strip('/')
+        # 从最深的.gitignore开始匹配，深层规则优先
+        parent = rel_path
+        while True:
+            parent = parent.rpartition('/')[0] if '/' in parent else ''
+            level = self.levels.get(parent)
+            if level is not None:
+                dir_regex, file_regex, negations = level
+                regex = dir_regex if is_dir else file_regex
+                sub_path = rel_path[len(parent) + 1:] if parent else rel_path
+                match = regex.fullmatch(sub_path) if regex is not None else None
+                if match is not None:
+                    return not negations[match.lastgroup]
+            if not parent:
+                return False
+
+    def is_path_ignored(self, rel_path):
+        """
+        判断任意相对路径是否被忽略（依次检查每一级父目录）
+        """
+        parts = rel_path.replace(os.sep, '/').strip('/').split('/')
+        for depth in range(1, len(parts)):
+            prefix = '/'.join(parts[:depth])
+            self.load_directory('/'.join(parts[:depth - 1]))
+            if self.is_ignored(prefix, is_dir=True):
                 return True
-        # 处理普通模式
-        elif fnmatch.fnmatch(path.name, pattern) or \
-                any(fnmatch.fnmatch(part, pattern) for part in path.parts):
-            return True
-    return False
+        self.load_directory('/'.join(parts[:-1]))
+        return self.is_ignored('/'.join(parts), is_dir=False)
 
 
-def scan_project_files(root_dir, text_extensions=None):
+def file_signature(stat_result):
+    """
+    由 os.stat 结果生成文件签名 [大小, 修改时间(ns), inode]，签名不变则认为文件未修改
     """
-    递归扫描项目目录，读取所有文本文件内容并返回字典
+    return [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
+
+
+# 最近这段时间内修改过的文件可能仍在写入，其签名不可信，总是重新读取
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+# 编码检测只使用文件开头的这部分字节
+CHARDET_PREFIX_BYTES = 64 * 1024
+# 在文件开头的这部分字节中出现\0则视为二进制文件
+BINARY_SNIFF_BYTES = 8 * 1024
+
+_BOMS = [
+    (b'\xff\xfe\x00\x00', 'utf-32'), (b'\x00\x00\xfe\xff', 'utf-32'),
+    (b'\xff\xfe', 'utf-16'), (b'\xfe\xff', 'utf-16'),
+]
+
+
+def _hash_functions():
+    functions = {
+        "md5": lambda data: hashlib.md5(data).hexdigest(),
+        "blake2b": lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+    }
+    if blake3 is not None:
+        functions["blake3"] = lambda data: blake3.blake3(data).hexdigest()
+    if xxhash is not None:
+        functions["xxh3"] = xxhash.xxh3_128_hexdigest
+    return functions
+
+
+# {算法名: 计算字节内容十六进制摘要的函数}
+HASH_FUNCTIONS = _hash_functions()
+# 内容指纹使用可用算法中最快的一个（xxhash > blake3 > hashlib.blake2b）
+HASH_ALGORITHM = next(name for name in ("xxh3", "blake3", "blake2b") if name in HASH_FUNCTIONS)
+# 旧版本摘要索引的条目没有 "hash_algorithm"，其哈希为解码后按UTF-8重新编码的内容的MD5
+LEGACY_HASH_ALGORITHM = "md5"
+
+
+def fingerprint(data, algorithm=HASH_ALGORITHM):
+    """
+    计算字节内容的指纹（十六进制）；algorithm 不可用（未安装对应的库）时返回None
+    """
+    function = HASH_FUNCTIONS.get(algorithm)
+    if function is None:
+        return None
+    start = time.perf_counter()
+    digest = function(data)
+    metrics.observe("aide_hash_seconds", time.perf_counter() - start)
+    return digest
+
+
+def decode_bytes(raw_data):
+    """
+    将文件字节解码为文本：优先 BOM 和严格 UTF-8，失败时才对前缀运行 chardet
+
+    返回:
+        tuple: (文本内容, 编码)，二进制文件返回 (None, None)
+    """
+    for bom, encoding in _BOMS:
+        if raw_data.startswith(bom):
+            return raw_data.decode(encoding, errors='replace'), encoding
+    if b'\x00' in raw_data[:BINARY_SNIFF_BYTES]:
+        return None, None
+    try:
+        return raw_data.decode('utf-8-sig'), 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    encoding = chardet.detect(raw_data[:CHARDET_PREFIX_BYTES])['encoding'] or 'utf-8'
+    try:
+        return raw_data.decode(encoding, errors='replace'), encoding
+    except LookupError:
+        return raw_data.decode('utf-8', errors='replace'), 'utf-8'
+
+
+def read_file_bytes(file_path):
+    """读取文件的原始字节"""
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def read_text_file(file_path):
+    """
+    只打开一次文件读取全部字节，计算原始字节的内容指纹并解码
+
+    返回:
+        tuple: (文本内容或None(二进制文件), 耗时信息字典)，指纹在耗时信息的 "hash" 中
+    """
+    start = time.perf_counter()
+    raw_data = read_file_bytes(file_path)
+    read_done = time.perf_counter()
+    content_hash = fingerprint(raw_data)
+    decode_start = time.perf_counter()
+    content, encoding = decode_bytes(raw_data)
+    timing = {
+        "read": read_done - start,
+        "decode": time.perf_counter() - decode_start,
+        "bytes": len(raw_data),
+        "encoding": encoding,
+        "hash": content_hash,
+    }
+    metrics.inc("aide_file_read_bytes_total", len(raw_data))
+    metrics.observe("aide_file_read_seconds", timing["read"], stage="read")
+    metrics.observe("aide_file_read_seconds", timing["decode"], stage="decode")
+    return content, timing
+
+
+class ProjectFile:
+    """
+    扫描得到的文件记录，内容只有在调用 load() 时才会读取
+    """
+    __slots__ = ('rel_path', 'file_path', 'signature', 'changed')
+
+    def __init__(self, rel_path, file_path, signature, changed=True):
+        self.rel_path = rel_path
+        self.file_path = file_path
+        self.signature = signature
+        self.changed = changed
+
+    def load(self):
+        """
+        读取并解码文件内容
+
+        返回:
+            tuple: (文本内容或None(二进制文件), 耗时信息字典)，同 read_text_file，原始字节的内容指纹在 "hash" 中
+        """
+        return read_text_file(self.file_path)
+
+
+def iter_project_files(root_dir, text_extensions=None, known_signatures=None):
+    """
+    递归遍历项目目录，逐个产出 ProjectFile 记录而不读取文件内容
     自动忽略 .gitignore 中指定的文件和目录
 
     参数:
         root_dir (str): 项目根目录路径
         text_extensions (list): 要处理的文本文件扩展名列表
-
-    返回:
-        dict: {相对文件路径: 文件内容} 的字典
+        known_signatures (dict): {相对文件路径: 文件签名}，签名未变化的记录 changed 为 False
     """
-    file_dict = {}
     root_dir = os.path.abspath(root_dir)
-    ignore_patterns = parse_gitignore(root_dir)
+    matcher = GitIgnoreMatcher(root_dir)
+    now_ns = time.time_ns()
 
     for root, dirs, files in os.walk(root_dir, topdown=True):
+        rel_root = os.path.relpath(root, root_dir)
+        rel_root = '' if rel_root == '.' else rel_root
+        matcher.load_directory(rel_root)
+
         # 修改dirs列表以确保不进入被忽略的目录
-        dirs[:] = [d for d in dirs if not should_ignore(os.path.join(root, d), ignore_patterns)]
+        dirs[:] = [d for d in dirs if not matcher.is_ignored(os.path.join(rel_root, d), is_dir=True)]
 
         for file in files:
             file_path = os.path.join(root, file)
-            rel_path = os.path.relpath(file_path, root_dir)
+            rel_path = os.path.join(rel_root, file)
 
             # 检查文件是否应该被忽略
-            if should_ignore(rel_path, ignore_patterns):
+            if matcher.is_ignored(rel_path):
                 continue
 
             # 检查文件扩展名
@@ -75,21 +356,378 @@ def scan_project_files(root_dir, text_extensions=None):
             if text_extensions is not None and ext.lower() not in text_extensions:
                 continue
 
-            try:
-                # 自动检测文件编码
-                with open(file_path, 'rb') as f:
-                    raw_data = f.read()
-                    encoding = chardet.detect(raw_data)['encoding'] or 'utf-8'
+            # 统一使用当前操作系统的分隔符格式
+            record = _make_record(os.path.normpath(rel_path), file_path, known_signatures, now_ns)
+            if record is not None:
+                yield record
 
-                # 使用检测到的编码读取文件内容
-                with open(file_path, 'r', encoding=encoding, errors='replace') as f:
-                    content = f.read()
 
-                # 统一使用当前操作系统的分隔符格式
-                normalized_path = os.path.normpath(rel_path)
-                file_dict[normalized_path] = content
+def _make_record(rel_path, file_path, known_signatures, now_ns):
+    try:
+        signature = file_signature(os.stat(file_path))
+    except OSError as e:
+        print(f"无法读取文件 {file_path}: {str(e)}")
+        return None
+    # 签名未变化（且不是刚刚修改的文件）则认为内容未变
+    changed = not (known_signatures and known_signatures.get(rel_path) == signature
+                   and now_ns - signature[1] > RACY_WINDOW_NS)
+    return ProjectFile(rel_path, file_path, signature, changed)
+
+
+def run_git(root_dir, *args):
+    """在 root_dir 中执行 git 命令并返回标准输出；git 不可用或命令失败时抛出 ValueError"""
+    try:
+        result = subprocess.run(["git", "-C", root_dir, *args], capture_output=True, text=True,
+                                encoding='utf-8', errors='replace', check=False)
+    except OSError as e:
+        raise ValueError(f"无法执行git: {str(e)}")
+    if result.returncode != 0:
+        raise ValueError(f"git {' '.join(args)} 失败: {result.stderr.strip()}")
+    return result.stdout
+
+
+def git_changed_files(root_dir, since):
+    """
+    返回自提交 since 以来（含工作区未提交的修改和未跟踪的文件）发生变化的文件，
+    路径相对于 root_dir（root_dir 可以是仓库的子目录，只返回其中的文件）；已删除的文件也会列出
+    """
+    # 关闭重命名检测，否则 --name-only 只列出新路径，被移走的旧路径不会出现
+    changed = run_git(root_dir, "diff", "--name-only", "--no-renames", "--relative", "-z", since, "--").split("\0")
+    untracked = run_git(root_dir, "ls-files", "--others", "--exclude-standard", "-z").split("\0")
+    return sorted({os.path.normpath(path) for path in changed + untracked if path})
+
+
+def is_git_repository(root_dir):
+    """root_dir 本身是否为git仓库的根目录（.git 为目录，或工作树/子模块中指向仓库的 .git 文件）"""
+    return os.path.exists(os.path.join(root_dir, ".git"))
+
+
+def git_head(root_dir):
+    """返回当前提交的哈希；仓库还没有提交时返回None"""
+    try:
+        return run_git(root_dir, "rev-parse", "--verify", "--quiet", "HEAD").strip() or None
+    except ValueError:
+        return None
 
-            except Exception as e:
-                print(f"无法读取文件 {file_path}: {str(e)}")
 
-    return file_dict
\ No newline at end of file
+def git_project_files(root_dir):
+    """
+    从git索引读取已跟踪的文件和未被忽略的未跟踪文件（代替遍历整个目录），路径相对于 root_dir；
+    已跟踪但在工作区中被删除的文件也会列出
+    """
+    paths = run_git(root_dir, "ls-files", "--cached", "--others", "--exclude-standard", "-z").split("\0")
+    return sorted({os.path.normpath(path) for path in paths if path})
+
+
+def stat_project_files(root_dir, rel_paths, text_extensions=None, known_signatures=None, matcher=None):
+    """
+    只检查给定的相对路径（如文件监视器报告的变更），产出与 iter_project_files 相同的记录；
+    不存在、被忽略或扩展名不匹配的路径会被跳过
+    """
+    root_dir = os.path.abspath(root_dir)
+    if matcher is None:
+        matcher = GitIgnoreMatcher(root_dir)
+    now_ns = time.time_ns()
+    for rel_path in rel_paths:
+        rel_path = os.path.normpath(rel_path)
+        file_path = os.path.join(root_dir, rel_path)
+        _, ext = os.path.splitext(rel_path)
+        if text_extensions is not None and ext.lower() not in text_extensions:
+            continue
+        if not os.path.isfile(file_path) or matcher.is_path_ignored(rel_path):
+            continue
+        record = _make_record(rel_path, file_path, known_signatures, now_ns)
+        if record is not None:
+            yield record
+
+
+class FileCache:
+    """
+    按需读取的文件内容缓存：按总字符数限制大小，超出时淘汰最久未使用的文件，
+    文件签名变化时自动重新读取
+    """
+
+    def __init__(self, root_dir, max_chars=8 * 1024 * 1024):
+        self.root_dir = root_dir
+        self.max_chars = max_chars
+        self.size = 0
+        self.entries = OrderedDict()  # {相对路径: (签名, 内容, 原始字节的内容指纹)}
+        self.lock = threading.Lock()
+
+    def get(self, rel_path):
+        """返回文件内容，二进制文件返回None"""
+        return self.load(rel_path)[0]
+
+    def load(self, rel_path):
+        """返回 (文件内容, 原始字节的内容指纹)，二进制文件的内容为None"""
+        file_path = os.path.join(self.root_dir, rel_path)
+        signature = file_signature(os.stat(file_path))
+        with self.lock:
+            entry = self.entries.get(rel_path)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(rel_path)
+                return entry[1], entry[2]
+
+        content, timing = read_text_file(file_path)
+        self.put(rel_path, signature, content, timing["hash"])
+        return content, timing["hash"]
+
+    def put(self, rel_path, signature, content, content_hash=None):
+        size = len(content) if content else 0
+        with self.lock:
+            old = self.entries.pop(rel_path, None)
+            if old is not None:
+                self.size -= len(old[1]) if old[1] else 0
+            if size > self.max_chars:
+                return
+            self.entries[rel_path] = (signature, content, content_hash)
+            self.size += size
+            while self.size > self.max_chars:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted) if evicted else 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, rel_path):
+        return rel_path in self.entries
+
+
+class ResponseCache:
+    """
+    回答缓存：以发送给模型的完整消息（含项目概览版本）为键，相同的问题直接返回上次的回答
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {键: 回答}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model, messages):
+        payload = json.dumps([model, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def estimate_tokens(text):
+    """
+    粗略估算文本的token数量（中文字符约0.6个token，其他字符约0.3个token）
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+
+_tokenizer = None
+
+
+def count_tokens(text):
+    """
+    计算文本的token数量：安装了 tiktoken 时使用真实分词器，否则退回 estimate_tokens
+    """
+    global _tokenizer
+    if not text:
+        return 0
+    if _tokenizer is None:
+        try:
+            import tiktoken
+            _tokenizer = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _tokenizer = False
+    if _tokenizer is False:
+        return estimate_tokens(text)
+    return len(_tokenizer.encode(text, disallowed_special=()))
+
+
+class TokenBucket:
+    """
+    令牌桶：以固定速率补充令牌，acquire 在令牌不足时阻塞等待
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # 单次请求超过桶容量时按容量计算，避免永远等待
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """
+    同时限制每分钟请求数(RPM)与每分钟token数(TPM)，为None表示不限制
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens=0):
+        if self.request_bucket is not None:
+            self.request_bucket.acquire(1)
+        if self.token_bucket is not None and tokens:
+            self.token_bucket.acquire(tokens)
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器打开期间直接拒绝的请求"""
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续 failure_threshold 次请求（重试用尽后）失败后打开，reset_timeout 秒内的请求直接失败；
+    之后放行一个试探请求（半开），成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self.probing:
+                raise CircuitOpenError(f"连续失败 {self.failures} 次，暂停请求（约 {max(remaining, 0):.0f} 秒后重试）")
+            self.probing = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+def retry_after_seconds(error):
+    """从错误附带的响应头中读取 Retry-After（秒），没有时返回None"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        # HTTP 日期格式
+        try:
+            from email.utils import parsedate_to_datetime
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class RetryPolicy:
+    """
+    失败重试：指数退避加随机抖动，优先遵循服务端的 Retry-After；配合熔断器在持续失败时快速失败
+
+    is_retryable(error) 判断错误是否值得重试（如429、5xx、连接超时），其余错误直接抛出。
+    """
+
+    def __init__(self, is_retryable, max_retries=5, base_delay=1.0, max_delay=60.0, circuit_breaker=None):
+        self.is_retryable = is_retryable
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = circuit_breaker
+
+    def delay(self, attempt, error=None):
+        retry_after = retry_after_seconds(error) if error is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # full jitter: [0, base * 2^attempt)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_call()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                if not retryable or attempt >= self.max_retries:
+                    if self.circuit_breaker is not None:
+                        # 重试用尽才计为一次失败（限流等偶发错误不会触发熔断）；
+                        # 参数错误等不可重试的错误说明服务本身可用，不计入熔断
+                        if retryable:
+                            self.circuit_breaker.record_failure()
+                        else:
+                            self.circuit_breaker.record_success()
+                    raise
+                wait = self.delay(attempt, e)
+                attempt += 1
+                print(f"请求失败({type(e).__name__})，{wait:.1f} 秒后第 {attempt} 次重试")
+                time.sleep(wait)
+                continue
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_success()
+            return result